@@ -1,46 +1,397 @@
+import asyncio
 import base64
-from typing import Optional
+import json
+import random
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+from typing import AsyncIterator, Optional
 
-import requests
+import httpx
 
+from ai import usage as usage_ledger
 from config import (
     DEEPSEEK_API_KEY,
     DEEPSEEK_MODEL,
     DEEPSEEK_VISION_MODEL,
     DEEPSEEK_BASE_URL,
+    DEEPSEEK_HTTP2,
+    DEEPSEEK_POOL_SIZE,
+    DEEPSEEK_POOL_KEEPALIVE,
+    DEEPSEEK_MAX_PER_HOST,
+    DEEPSEEK_RETRIES,
+    DEEPSEEK_RETRY_BASE_SEC,
+    DEEPSEEK_RETRY_MAX_SEC,
+    DEEPSEEK_BREAKER_THRESHOLD,
+    DEEPSEEK_BREAKER_COOLDOWN_SEC,
+    DEEPSEEK_HEDGE,
+    DEEPSEEK_LATENCY_BUDGET_SEC,
 )
 
 
-def generate_text(prompt: str, system: Optional[str] = None, max_tokens: int = 900, model: Optional[str] = None) -> str:
-    """Text-only requests via DeepSeek (OpenAI-compatible /chat/completions)."""
-    if not DEEPSEEK_API_KEY:
-        return "⚠️ DeepSeek API key is not configured."
+# One shared keep-alive pool for the whole process (created lazily on first call).
+_client: Optional[httpx.AsyncClient] = None
 
-    url = f"{DEEPSEEK_BASE_URL.rstrip('/')}/chat/completions"
-    headers = {
-        "Authorization": f"Bearer {DEEPSEEK_API_KEY}",
-        "Content-Type": "application/json",
-    }
+# Caps in-flight requests to the DeepSeek host. With HTTP/2 many requests share
+# one connection, so the connection pool alone does not bound concurrency.
+_host_slots = asyncio.Semaphore(DEEPSEEK_MAX_PER_HOST)
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def get_client() -> httpx.AsyncClient:
+    """Shared async HTTP client for DeepSeek (HTTP/2 when `h2` is installed)."""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            base_url=DEEPSEEK_BASE_URL.rstrip("/"),
+            headers={
+                "Authorization": f"Bearer {DEEPSEEK_API_KEY}",
+                "Content-Type": "application/json",
+            },
+            http2=DEEPSEEK_HTTP2 and _http2_available(),
+            limits=httpx.Limits(
+                max_connections=DEEPSEEK_POOL_SIZE,
+                max_keepalive_connections=DEEPSEEK_POOL_KEEPALIVE,
+                keepalive_expiry=60,
+            ),
+            timeout=httpx.Timeout(60, connect=10),
+        )
+    return _client
+
+
+async def close_client() -> None:
+    """Close the shared pool (called on application shutdown)."""
+    global _client
+    for t in list(_detached):
+        t.cancel()
+    if _client is not None and not _client.is_closed:
+        await _client.aclose()
+    _client = None
+
+
+# ----------------
+# RESILIENCE: retries, circuit breaker, hedging
+# ----------------
+
+_RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class UpstreamUnavailable(Exception):
+    """DeepSeek is failing; the circuit breaker is open and calls fail fast."""
+
+
+class CircuitBreaker:
+    """Opens after `threshold` consecutive upstream failures, for `cooldown` seconds.
+
+    After the cooldown a single probe call is let through (half-open); its
+    outcome closes the breaker again or restarts the cooldown.
+    """
+
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = max(1, threshold)
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.cooldown:
+            return "open"
+        return "half_open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self._probing:
+            self._probing = True
+            return True
+        return False
+
+    def success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    def failure(self) -> None:
+        self.failures += 1
+        self._probing = False
+        if self.opened_at is not None or self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+
+    def abort(self) -> None:
+        """The call was cancelled: no verdict, but free the probe slot."""
+        self._probing = False
+
+
+breaker = CircuitBreaker(DEEPSEEK_BREAKER_THRESHOLD, DEEPSEEK_BREAKER_COOLDOWN_SEC)
+
+_latencies = deque(maxlen=200)  # seconds, successful calls (streams: until the last token)
+_stats = {"calls": 0, "retries": 0, "failures": 0, "fast_fails": 0, "hedges": 0, "hedge_wins": 0}
+
+
+def upstream_available() -> bool:
+    """False while the breaker is open: handlers should not charge quota or wait."""
+    return breaker.state != "open"
+
+
+def upstream_degraded() -> bool:
+    """Breaker open or recent p95 latency over budget: callers may prefer stale cache."""
+    p95 = _p95()
+    return breaker.state == "open" or (p95 is not None and p95 > DEEPSEEK_LATENCY_BUDGET_SEC)
+
+
+def upstream_stats() -> dict:
+    return dict(_stats, breaker=breaker.state, p95_ms=int(1000 * (_p95() or 0)))
+
+
+def _p95() -> Optional[float]:
+    if len(_latencies) < 20:
+        return None
+    ordered = sorted(_latencies)
+    return ordered[int(len(ordered) * 0.95) - 1]
+
+
+def _retry_delay(attempt: int, retry_after: Optional[str] = None) -> Optional[float]:
+    """Seconds before the next attempt; None if Retry-After asks for more than
+    DEEPSEEK_RETRY_MAX_SEC (give up instead of retrying early)."""
+    if retry_after:
+        try:
+            wait = float(retry_after)
+        except ValueError:
+            try:
+                wait = parsedate_to_datetime(retry_after).timestamp() - time.time()
+            except (TypeError, ValueError):
+                wait = None
+        if wait is not None:
+            return max(wait, 0.0) if wait <= DEEPSEEK_RETRY_MAX_SEC else None
+    # Full jitter: uniform in [0, base * 2^attempt], capped.
+    return random.uniform(0, min(DEEPSEEK_RETRY_MAX_SEC, DEEPSEEK_RETRY_BASE_SEC * (2 ** attempt)))
+
+
+def _is_upstream_failure(e: BaseException) -> bool:
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code in _RETRY_STATUSES
+    return isinstance(e, (httpx.TransportError, asyncio.TimeoutError))
 
+
+def _settle(e: Optional[BaseException]) -> None:
+    if e is None:
+        breaker.success()
+    elif isinstance(e, (asyncio.CancelledError, GeneratorExit)):
+        breaker.abort()
+    elif _is_upstream_failure(e):
+        _stats["failures"] += 1
+        breaker.failure()
+    else:
+        breaker.success()  # 4xx etc.: upstream is up, the request was bad
+
+
+def _check_breaker() -> None:
+    _stats["calls"] += 1
+    if not breaker.allow():
+        _stats["fast_fails"] += 1
+        raise UpstreamUnavailable(f"DeepSeek circuit breaker is {breaker.state}")
+
+
+async def _post_with_retries(payload: dict, timeout: float) -> dict:
+    for attempt in range(DEEPSEEK_RETRIES + 1):
+        last = attempt >= DEEPSEEK_RETRIES
+        try:
+            async with _host_slots:
+                r = await get_client().post("/chat/completions", json=payload, timeout=timeout)
+        except httpx.TransportError:
+            if last:
+                raise
+            delay = _retry_delay(attempt)
+        else:
+            delay = None
+            if r.status_code in _RETRY_STATUSES and not last:
+                delay = _retry_delay(attempt, r.headers.get("Retry-After"))
+            if delay is None:
+                r.raise_for_status()
+                return r.json()
+        _stats["retries"] += 1
+        await asyncio.sleep(delay)
+    raise RuntimeError("unreachable")
+
+
+# Losing hedge requests left to finish in the background (strong refs until done).
+_detached: set = set()
+
+
+def _detach_loser(task: asyncio.Future, model: str) -> None:
+    """Lets a losing hedge request finish so its tokens still reach the usage ledger."""
+    def done(t: asyncio.Future) -> None:
+        _detached.discard(t)
+        if not t.cancelled() and t.exception() is None:
+            usage_ledger.record(model, t.result().get("usage"))
+
+    _detached.add(task)
+    task.add_done_callback(done)  # runs in the caller's context, so the usage tag still applies
+
+
+async def _hedged(payload: dict, timeout: float) -> dict:
+    """Sends a second identical request if the first is slower than p95; first answer wins.
+
+    If the caller is cancelled or every request fails, all of them are cancelled.
+    """
+    delay = _p95()
+    tasks = [asyncio.ensure_future(_post_with_retries(payload, timeout))]
+    try:
+        if delay is not None:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                _stats["hedges"] += 1
+                tasks.append(asyncio.ensure_future(_post_with_retries(payload, timeout)))
+        pending = set(tasks)
+        error: Optional[BaseException] = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for t in done:
+                if t.exception() is None:
+                    if t is not tasks[0]:
+                        _stats["hedge_wins"] += 1
+                    for other in tasks:
+                        if other is not t:
+                            _detach_loser(other, payload["model"])
+                    tasks = []
+                    return t.result()
+                error = t.exception()
+        raise error
+    finally:
+        for t in tasks:
+            t.cancel()
+
+
+async def _chat_completion(payload: dict, timeout: float) -> dict:
+    _check_breaker()
+    started = time.monotonic()
+    try:
+        if DEEPSEEK_HEDGE and breaker.state == "closed":
+            data = await _hedged(payload, timeout)
+        else:
+            data = await _post_with_retries(payload, timeout)
+    except BaseException as e:
+        _settle(e)
+        raise
+    _settle(None)
+    _latencies.append(time.monotonic() - started)
+    return data
+
+
+def _text_payload(prompt: str, system: Optional[str], max_tokens: int, model: Optional[str]) -> dict:
     messages = []
     if system:
         messages.append({"role": "system", "content": system})
     messages.append({"role": "user", "content": prompt})
 
-    payload = {
+    return {
         "model": (model or DEEPSEEK_MODEL),
         "messages": messages,
         "max_tokens": max_tokens,
         "temperature": 0.7,
     }
 
-    r = requests.post(url, headers=headers, json=payload, timeout=60)
-    r.raise_for_status()
-    data = r.json()
-    return data["choices"][0]["message"]["content"].strip()
+
+async def generate_text(
+    prompt: str,
+    system: Optional[str] = None,
+    max_tokens: int = 900,
+    model: Optional[str] = None,
+    meta: Optional[dict] = None,
+) -> str:
+    """Text-only requests via DeepSeek (OpenAI-compatible /chat/completions).
+
+    If `meta` is given it receives the call's finish_reason.
+    """
+    if not DEEPSEEK_API_KEY:
+        return "⚠️ DeepSeek API key is not configured."
+
+    payload = _text_payload(prompt, system, max_tokens, model)
+    data = await _chat_completion(payload, timeout=60)
+    usage_ledger.record(payload["model"], data.get("usage"))
+    choice = data["choices"][0]
+    if meta is not None:
+        meta["finish_reason"] = choice.get("finish_reason")
+    return choice["message"]["content"].strip()
 
 
-def generate_vision(
+async def stream_text(
+    prompt: str,
+    system: Optional[str] = None,
+    max_tokens: int = 900,
+    model: Optional[str] = None,
+    meta: Optional[dict] = None,
+) -> AsyncIterator[str]:
+    """Same as generate_text, but yields content deltas as they arrive (SSE, stream=true)."""
+    if not DEEPSEEK_API_KEY:
+        yield "⚠️ DeepSeek API key is not configured."
+        return
+
+    payload = _text_payload(prompt, system, max_tokens, model)
+    payload["stream"] = True
+    payload["stream_options"] = {"include_usage": True}
+
+    _check_breaker()
+    started = time.monotonic()
+    yielded = False
+    try:
+        # Retries are only possible before the first token reaches the user.
+        for attempt in range(DEEPSEEK_RETRIES + 1):
+            last = attempt >= DEEPSEEK_RETRIES
+            retry_in = None
+            try:
+                async with _host_slots:
+                    async with get_client().stream("POST", "/chat/completions", json=payload, timeout=60) as r:
+                        if r.status_code in _RETRY_STATUSES and not last:
+                            retry_in = _retry_delay(attempt, r.headers.get("Retry-After"))
+                        if retry_in is None:
+                            r.raise_for_status()
+                            async for line in r.aiter_lines():
+                                # SSE frames: "data: {...}", blank keep-alives, ": comments", "data: [DONE]"
+                                if not line.startswith("data:"):
+                                    continue
+                                chunk = line[5:].strip()
+                                if chunk == "[DONE]":
+                                    break
+                                event = json.loads(chunk)
+                                if event.get("usage"):
+                                    usage_ledger.record(payload["model"], event["usage"])
+                                choices = event.get("choices") or []
+                                if choices and choices[0].get("finish_reason") and meta is not None:
+                                    meta["finish_reason"] = choices[0]["finish_reason"]
+                                delta = (choices[0].get("delta") or {}).get("content") if choices else None
+                                if delta:
+                                    yielded = True
+                                    yield delta
+            except httpx.TransportError:
+                if yielded or last:
+                    raise
+                retry_in = _retry_delay(attempt)
+            if retry_in is None:
+                break
+            _stats["retries"] += 1
+            await asyncio.sleep(retry_in)
+    except BaseException as e:
+        _settle(e)
+        raise
+    _settle(None)
+    # Total time, like the non-streaming calls: p95 and the hedge delay stay comparable.
+    _latencies.append(time.monotonic() - started)
+
+
+async def generate_vision(
     prompt: str,
     image_bytes: bytes,
     mime: str = "image/jpeg",
@@ -57,12 +408,6 @@ def generate_vision(
     if not DEEPSEEK_VISION_MODEL:
         return "⚠️ DeepSeek vision model is not configured."
 
-    url = f"{DEEPSEEK_BASE_URL.rstrip('/')}/chat/completions"
-    headers = {
-        "Authorization": f"Bearer {DEEPSEEK_API_KEY}",
-        "Content-Type": "application/json",
-    }
-
     b64 = base64.b64encode(image_bytes).decode("utf-8")
     data_url = f"data:{mime};base64,{b64}"
 
@@ -87,7 +432,6 @@ def generate_vision(
         "temperature": 0.3,
     }
 
-    r = requests.post(url, headers=headers, json=payload, timeout=90)
-    r.raise_for_status()
-    data = r.json()
+    data = await _chat_completion(payload, timeout=90)
+    usage_ledger.record(payload["model"], data.get("usage"))
     return data["choices"][0]["message"]["content"].strip()
@@ -0,0 +1,68 @@
+import asyncio
+import io
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Sequence, Tuple
+
+try:
+    from PIL import Image, ImageOps
+except Exception:  # pragma: no cover
+    Image = None  # type: ignore
+    ImageOps = None  # type: ignore
+
+from config import VISION_MIN_SIDE, VISION_MAX_SIDE, VISION_JPEG_QUALITY, VISION_PREP_WORKERS
+
+# Decoding/resizing is CPU work: keep it off the event loop. Pillow releases the
+# GIL in its codecs and resamplers, so threads are enough.
+_pool = ThreadPoolExecutor(max_workers=VISION_PREP_WORKERS, thread_name_prefix="vision-prep")
+
+_stats = {"images": 0, "bytes_in": 0, "bytes_out": 0}
+
+
+def pick_photo_size(sizes: Sequence):
+    """Smallest Telegram PhotoSize whose shorter side is still >= VISION_MIN_SIDE.
+
+    Telegram sends sizes ascending; falls back to the largest one.
+    """
+    if not sizes:
+        return None
+    for size in sorted(sizes, key=lambda s: (s.width or 0) * (s.height or 0)):
+        if min(size.width or 0, size.height or 0) >= VISION_MIN_SIDE:
+            return size
+    return max(sizes, key=lambda s: (s.width or 0) * (s.height or 0))
+
+
+def _prepare(raw) -> Tuple[bytes, str]:
+    if Image is None:
+        return bytes(raw), "image/jpeg"
+    try:
+        with Image.open(io.BytesIO(raw)) as im:
+            im = ImageOps.exif_transpose(im)  # apply camera rotation before EXIF is dropped
+            if im.mode not in ("RGB", "L"):
+                im = im.convert("RGB")
+            im.thumbnail((VISION_MAX_SIDE, VISION_MAX_SIDE), Image.LANCZOS)
+            out = io.BytesIO()
+            # Re-encoding without exif=/icc_profile= strips all metadata.
+            im.save(out, format="JPEG", quality=VISION_JPEG_QUALITY, optimize=True)
+    except Exception:
+        logging.exception("vision preprocessing failed, sending original")
+        return bytes(raw), "image/jpeg"
+    return out.getvalue(), "image/jpeg"
+
+
+async def prepare_image(raw) -> Tuple[bytes, str]:
+    """Downscale + recompress + strip metadata in the worker pool. Returns (bytes, mime)."""
+    data, mime = await asyncio.get_running_loop().run_in_executor(_pool, _prepare, raw)
+    _stats["images"] += 1
+    _stats["bytes_in"] += len(raw)
+    _stats["bytes_out"] += len(data)
+    return data, mime
+
+
+async def run_in_pool(fn, *args):
+    """Runs other blocking CPU work (image or prompt hashing) in the same worker pool."""
+    return await asyncio.get_running_loop().run_in_executor(_pool, fn, *args)
+
+
+def stats() -> dict:
+    return dict(_stats)
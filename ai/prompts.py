@@ -0,0 +1,124 @@
+import hashlib
+from typing import Dict, Iterable, List, Tuple
+
+# System prompts used for cached answers. Each template's version is a hash of
+# its text and goes into the cache key (together with the model route), so an
+# edited prompt gets fresh answers instead of serving the old ones for 60 days.
+# Entries of an older version can be invalidated or, for cosmetic edits, accepted
+# by the new version (lazy migration) with the admin /cache command.
+
+
+class PromptTemplate:
+    __slots__ = ("name", "text", "version", "accepts")
+
+    def __init__(self, name: str, text: str):
+        self.name = name
+        self.text = text
+        self.version = hashlib.sha256(text.encode("utf-8")).hexdigest()[:8]
+        self.accepts: List[str] = []  # older versions whose cache entries stay valid
+
+    @property
+    def tag(self) -> str:
+        return f"{self.name}@{self.version}"
+
+    def key_tags(self) -> List[str]:
+        """Current tag first, then accepted older ones (lookup order)."""
+        return [self.tag] + [f"{self.name}@{v}" for v in self.accepts]
+
+
+_registry: Dict[str, PromptTemplate] = {}
+
+
+def register(name: str, text: str) -> PromptTemplate:
+    tpl = PromptTemplate(name, text)
+    _registry[name] = tpl
+    return tpl
+
+
+def get(name: str) -> PromptTemplate:
+    return _registry[name]
+
+
+def templates() -> List[PromptTemplate]:
+    return list(_registry.values())
+
+
+def matching(selector: str) -> List[PromptTemplate]:
+    """Templates selected by name ("study.free") or mode prefix ("study")."""
+    return [t for t in _registry.values() if t.name == selector or t.name.startswith(selector + ".")]
+
+
+def accept(name: str, from_version: str) -> None:
+    tpl = _registry[name]
+    if from_version != tpl.version and from_version not in tpl.accepts:
+        tpl.accepts.append(from_version)
+
+
+def load_migrations(rows: Iterable[Tuple[str, str]]) -> None:
+    """rows: (template name, accepted older version) from cache_migrations."""
+    for name, from_version in rows:
+        if name in _registry:
+            accept(name, from_version)
+
+
+_STUDY_BASE = "You are StudyAI, a strict but friendly tutor. Do not reveal hidden chain-of-thought. Language must match the user's language."
+
+STUDY_FREE = register("study.free", _STUDY_BASE + " Provide a concise helpful answer (no long essays).")
+STUDY_PAID = register("study.paid", _STUDY_BASE + " Answer clearly and step-by-step.")
+
+GRADE_TEXT = register("grade.text", (
+    "You are StudyAI, a strict teacher and examiner. "
+    "First, identify the subject from the student's text and write it as: 'Предмет: ...' (or 'Subject: ...') on the first line. "
+    "Then grade the work. "
+    "Output format: "
+    "1) Балл: X/10 "
+    "2) Короткий вердикт (1-2 предложения) "
+    "3) Ошибки и почему это ошибки (если есть) "
+    "4) Как исправить (конкретные шаги) "
+    "5) 2-3 похожих задания для тренировки (придумай сам) "
+    "Be fair and constructive. Language must match the user's language."
+))
+
+GRADE_PHOTO = register("grade.photo", (
+    "You are StudyAI, a strict teacher and examiner. "
+    "First, identify the subject from the student's work and write it as: 'Предмет: ...' (or 'Subject: ...') on the first line. "
+    "Then grade the work. "
+    "Output format: "
+    "1) Балл: X/10 "
+    "2) Короткий вердикт (1-2 предложения) "
+    "3) Ошибки и почему это ошибки (если есть) "
+    "4) Как исправить (конкретные шаги) "
+    "5) 2-3 похожих задания для тренировки (придумай сам, без копирования экзамена) "
+    "Be fair and constructive. Language must match the user's language."
+))
+
+VISION_STUDY = register("vision.study", (
+    "You are StudyAI, an expert tutor. "
+    "First, identify the subject (e.g., math/russian/physics) from the photo and write it as: 'Предмет: ...' on the first line. "
+    "This is study assistance (learning), not cheating. "
+    "If the request is vague, ask up to 2 clarifying questions; otherwise proceed. "
+    "Always structure the answer: "
+    "1) краткий план/стратегия "
+    "2) теория по теме "
+    "3) решение/объяснение по шагам "
+    "4) проверка и типичные ошибки "
+    "5) мини-тренировка (2-3 похожих задания) "
+    "Do NOT reproduce copyrighted exam texts verbatim; create original tasks. "
+    "Language must match the user's language."
+))
+
+EGE = register("ege", (
+    "You are StudyAI, an expert tutor. First, identify the subject (e.g., math/russian/physics) from the photo and write it as: 'Предмет: ...' on the first line. "
+    "This is study assistance (learning), not cheating. "
+    "If the request is vague, ask up to 2 clarifying questions; otherwise proceed. "
+    "Always structure the answer:\n"
+    "1) краткий план/стратегия\n"
+    "2) теория по теме\n"
+    "3) решение/объяснение по шагам\n"
+    "4) проверка и типичные ошибки\n"
+    "5) мини-тренировка (2-3 похожих задания)\n"
+    "Do NOT reproduce copyrighted exam texts verbatim; create original tasks. "
+    "Language must match the user's language."
+))
+
+EXPAND = register("expand", "You are StudyAI. Provide a very detailed step-by-step breakdown with clear explanations and checks. Do not reveal hidden chain-of-thought. Language must match the user's language.")
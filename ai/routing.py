@@ -0,0 +1,66 @@
+import logging
+import re
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+from config import (
+    DEEPSEEK_MODEL,
+    DEEPSEEK_MODEL_FREE,
+    ENABLE_MODEL_CASCADE,
+    CASCADE_ESCALATE_PLANS,
+)
+
+# Cheap-first cascade: every request is answered by DEEPSEEK_MODEL_FREE first and
+# only re-asked on DEEPSEEK_MODEL when the cheap answer fails local checks.
+
+_SUBJECT_HEADER = re.compile(r"^\s*(Предмет|Subject)\s*:\s*\S", re.IGNORECASE | re.MULTILINE)
+
+_REFUSAL = re.compile(
+    r"(i can(?:no|')t (?:help|assist|answer)|i(?:'m| am) (?:unable|not able) to|as an ai\b|as a language model"
+    r"|не могу (?:помочь|ответить|выполнить)|я не (?:могу|в состоянии) (?:помочь|решить)|как (?:языковая )?модель ии"
+    r"|к сожалению,? я не могу)",
+    re.IGNORECASE,
+)
+
+# Modes whose system prompt requires a "Предмет: ..." first line.
+_NEEDS_SUBJECT = {"grade"}
+
+_stats: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+
+
+def route_models(plan_key: str) -> List[str]:
+    """Models to try in order for a plan."""
+    if not ENABLE_MODEL_CASCADE or DEEPSEEK_MODEL_FREE == DEEPSEEK_MODEL:
+        return [DEEPSEEK_MODEL_FREE if plan_key == "free" else DEEPSEEK_MODEL]
+    if plan_key in CASCADE_ESCALATE_PLANS:
+        return [DEEPSEEK_MODEL_FREE, DEEPSEEK_MODEL]
+    return [DEEPSEEK_MODEL_FREE]
+
+
+def escalation_reason(mode: str, text: str, finish_reason: Optional[str]) -> Optional[str]:
+    """Why the cheap answer is not good enough, or None if it is."""
+    if finish_reason == "length":
+        return "truncated"
+    if len((text or "").strip()) < 20:
+        return "too_short"
+    if mode in _NEEDS_SUBJECT and not _SUBJECT_HEADER.search("\n".join(text.strip().splitlines()[:3])):
+        return "no_subject"
+    if _REFUSAL.search(text[:400]):
+        return "refusal"
+    return None
+
+
+def record(mode: str, model: str, reason: Optional[str], escalating: bool) -> None:
+    st = _stats[mode]
+    st["checked"] += 1
+    if reason is None:
+        st["passed"] += 1
+    else:
+        st[f"fail_{reason}"] += 1
+        if escalating:
+            st["escalated"] += 1
+            logging.info("routing: %s answer from %s escalated (%s)", mode, model, reason)
+
+
+def stats() -> Dict[str, Dict[str, int]]:
+    return {mode: dict(st) for mode, st in _stats.items()}
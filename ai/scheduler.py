@@ -0,0 +1,139 @@
+import asyncio
+import heapq
+import itertools
+import time
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from config import PLANS, LLM_MAX_CONCURRENCY, LLM_LANE_WEIGHTS, LLM_LANE_MAX_WAIT_SEC
+
+
+class QueueTimeout(Exception):
+    """Raised when a request waited longer than its lane allows."""
+
+
+class _Lane:
+    __slots__ = ("name", "weight", "max_wait", "last_tag", "depth", "served", "timeouts", "wait_total", "wait_max")
+
+    def __init__(self, name: str, weight: float, max_wait: float):
+        self.name = name
+        self.weight = max(weight, 0.01)
+        self.max_wait = max_wait
+        self.last_tag = 0.0
+        self.depth = 0
+        self.served = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def record_wait(self, waited: float) -> None:
+        self.served += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+
+
+class GenerationScheduler:
+    """Bounded pool of upstream LLM slots shared by per-plan lanes.
+
+    Waiting requests are ordered by weighted fair queuing: each request gets a
+    virtual finish tag advancing by 1/weight within its lane, so a lane with
+    weight 8 is served ~8x as often as a weight-1 lane when both are backlogged,
+    and paid requests overtake a queue of free ones.
+    """
+
+    def __init__(self, capacity: int, lanes: Dict[str, _Lane], default_lane: str = "free"):
+        self.capacity = max(1, capacity)
+        self._lanes = lanes
+        self._default = default_lane
+        self._active = 0
+        self._vtime = 0.0
+        self._heap: List[tuple] = []
+        self._seq = itertools.count()
+
+    def _lane(self, name: Optional[str]) -> _Lane:
+        return self._lanes.get(name or "") or self._lanes[self._default]
+
+    def _position(self, tag: float, seq: int) -> int:
+        return 1 + sum(1 for t, s, fut, _ in self._heap if (t, s) < (tag, seq) and not fut.done())
+
+    def _dispatch(self) -> None:
+        while self._heap and self._active < self.capacity:
+            tag, _, fut, lane = heapq.heappop(self._heap)
+            if fut.done():  # timed out or cancelled while queued
+                continue
+            self._vtime = max(self._vtime, tag)
+            self._active += 1
+            lane.depth -= 1
+            fut.set_result(None)
+
+    def _release(self) -> None:
+        self._active -= 1
+        self._dispatch()
+
+    async def acquire(self, lane_name: Optional[str], on_queued: Optional[Callable[[int], Awaitable[None]]] = None) -> None:
+        lane = self._lane(lane_name)
+        started = time.monotonic()
+        if self._active < self.capacity and not self._heap:
+            self._active += 1
+            lane.record_wait(0.0)
+            return
+
+        tag = max(self._vtime, lane.last_tag) + 1.0 / lane.weight
+        lane.last_tag = tag
+        seq = next(self._seq)
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._heap, (tag, seq, fut, lane))
+        lane.depth += 1
+
+        if on_queued:
+            try:
+                await on_queued(self._position(tag, seq))
+            except Exception:
+                pass
+
+        try:
+            await asyncio.wait_for(fut, timeout=max(0.0, lane.max_wait - (time.monotonic() - started)))
+        except asyncio.TimeoutError:
+            lane.depth -= 1
+            lane.timeouts += 1
+            raise QueueTimeout(f"lane {lane.name}: waited more than {lane.max_wait}s")
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self._release()  # slot was granted just as the caller went away
+            else:
+                lane.depth -= 1
+            raise
+        lane.record_wait(time.monotonic() - started)
+
+    @asynccontextmanager
+    async def slot(self, lane_name: Optional[str], on_queued: Optional[Callable[[int], Awaitable[None]]] = None):
+        await self.acquire(lane_name, on_queued)
+        try:
+            yield
+        finally:
+            self._release()
+
+    def stats(self) -> Dict[str, dict]:
+        out = {}
+        for name, lane in self._lanes.items():
+            out[name] = {
+                "depth": lane.depth,
+                "served": lane.served,
+                "timeouts": lane.timeouts,
+                "avg_wait_ms": int(1000 * lane.wait_total / lane.served) if lane.served else 0,
+                "max_wait_ms": int(1000 * lane.wait_max),
+            }
+        return out
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+
+scheduler = GenerationScheduler(
+    LLM_MAX_CONCURRENCY,
+    {
+        k: _Lane(k, LLM_LANE_WEIGHTS.get(k, 1), LLM_LANE_MAX_WAIT_SEC.get(k, LLM_LANE_MAX_WAIT_SEC["free"]))
+        for k in PLANS
+    },
+)
@@ -0,0 +1,40 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Tuple
+
+
+class SingleFlight:
+    """Collapses concurrent calls with the same key into one upstream call.
+
+    The first caller for a key starts the work; everyone arriving while it is
+    in flight awaits the same task and gets the same result (or exception).
+    The work runs as its own task, so a cancelled caller does not cancel it
+    for the others.
+    """
+
+    def __init__(self):
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self.leaders = 0
+        self.shared = 0
+
+    def inflight(self, key: str) -> bool:
+        return key in self._inflight
+
+    def _forget(self, key: str, task: asyncio.Future) -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+
+    async def do(self, key: str, factory: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """Returns (result, shared); shared is True when another caller did the work."""
+        task = self._inflight.get(key)
+        shared = task is not None
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t, k=key: self._forget(k, t))
+            self.leaders += 1
+        else:
+            self.shared += 1
+        return await asyncio.shield(task), shared
+
+    def stats(self) -> Dict[str, int]:
+        return {"inflight": len(self._inflight), "leaders": self.leaders, "shared": self.shared}
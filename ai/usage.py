@@ -0,0 +1,121 @@
+import asyncio
+import contextvars
+import datetime as dt
+import logging
+from typing import Dict, Optional, Tuple
+
+import db
+from config import DEEPSEEK_PRICES, STAR_USD_RATE, USAGE_FLUSH_SEC, PROFIT_GUARD_MIN_COST_USD
+from monetization.profit_guard import should_reduce_limits
+
+# Who the current generation is billed to. Set by handlers; tasks spawned from a
+# handler (single-flight leaders, hedges) inherit it.
+_tag: contextvars.ContextVar[Tuple[int, str]] = contextvars.ContextVar("usage_tag", default=(0, "other"))
+
+# (day, user_id, mode, model) -> [calls, prompt, completion, cache_hit, cost_usd]
+_pending: Dict[tuple, list] = {}
+
+# Cached "cost today vs revenue today", refreshed by the flush loop.
+_snapshot = {"day": None, "cost_usd": 0.0, "revenue_stars": 0, "revenue_usd": 0.0, "reduce_limits": False}
+
+
+def tag(user_id: int, mode: str) -> None:
+    _tag.set((int(user_id or 0), mode))
+
+
+def call_cost(model: str, usage: dict) -> float:
+    """USD cost of one call from the API `usage` block."""
+    price = DEEPSEEK_PRICES.get(model) or DEEPSEEK_PRICES["default"]
+    prompt = int(usage.get("prompt_tokens") or 0)
+    hit = int(usage.get("prompt_cache_hit_tokens") or 0)
+    miss = int(usage.get("prompt_cache_miss_tokens") or max(prompt - hit, 0))
+    out = int(usage.get("completion_tokens") or 0)
+    return (hit * price["hit"] + miss * price["miss"] + out * price["out"]) / 1_000_000
+
+
+def record(model: str, usage: Optional[dict]) -> None:
+    """Accumulates one API response's usage in memory (flushed in batches)."""
+    if not usage:
+        return
+    uid, mode = _tag.get()
+    key = (dt.datetime.utcnow().date(), uid, mode, model or "unknown")
+    row = _pending.setdefault(key, [0, 0, 0, 0, 0.0])
+    cost = call_cost(model, usage)
+    row[0] += 1
+    row[1] += int(usage.get("prompt_tokens") or 0)
+    row[2] += int(usage.get("completion_tokens") or 0)
+    row[3] += int(usage.get("prompt_cache_hit_tokens") or 0)
+    row[4] += cost
+    if _snapshot["day"] == key[0]:
+        _snapshot["cost_usd"] += cost
+
+
+def _take() -> Dict[tuple, list]:
+    global _pending
+    batch, _pending = _pending, {}
+    return batch
+
+
+def _restore(batch: Dict[tuple, list]) -> None:
+    # Merged with whatever arrived meanwhile.
+    for key, vals in batch.items():
+        cur = _pending.setdefault(key, [0, 0, 0, 0, 0.0])
+        for i, v in enumerate(vals):
+            cur[i] += v
+
+
+def _write(batch: Dict[tuple, list]) -> None:
+    rows = [(day, uid, mode, model, *vals) for (day, uid, mode, model), vals in batch.items()]
+    db.add_usage_rows(rows)
+
+
+def _apply_snapshot(cost_usd, revenue_stars) -> None:
+    today = dt.datetime.utcnow().date()
+    cost_usd = float(cost_usd or 0) + sum(v[4] for k, v in _pending.items() if k[0] == today)
+    revenue_usd = int(revenue_stars or 0) * STAR_USD_RATE
+    _snapshot.update(
+        day=today,
+        cost_usd=cost_usd,
+        revenue_stars=int(revenue_stars or 0),
+        revenue_usd=revenue_usd,
+        reduce_limits=should_reduce_limits(cost_usd, revenue_usd, PROFIT_GUARD_MIN_COST_USD),
+    )
+
+
+async def flush() -> None:
+    """Writes pending aggregates to usage_ledger in one batched statement (off the loop)."""
+    batch = _take()
+    if not batch:
+        return
+    try:
+        await db.run(_write, batch)
+    except Exception:
+        _restore(batch)
+        raise
+
+
+async def refresh_snapshot() -> dict:
+    """Reloads today's API cost and Stars revenue and re-evaluates profit_guard."""
+    cost_usd, revenue_stars = await db.aio.cost_and_revenue_today()
+    _apply_snapshot(cost_usd, revenue_stars)
+    return dict(_snapshot)
+
+
+def snapshot() -> dict:
+    return dict(_snapshot)
+
+
+def limits_reduced() -> bool:
+    """profit_guard verdict for today (cached; no DB I/O)."""
+    return bool(_snapshot["reduce_limits"])
+
+
+async def run_flusher() -> None:
+    """Background loop: flush the ledger and refresh the profit snapshot."""
+    while True:
+        try:
+            await flush()
+            await refresh_snapshot()
+        except Exception:
+            logging.exception("usage ledger flush failed")
+        await asyncio.sleep(USAGE_FLUSH_SEC)
@@ -0,0 +1,151 @@
+import asyncio
+import datetime as dt
+import logging
+from typing import Dict, List
+
+import db
+from config import ANALYTICS_FLUSH_MS, ANALYTICS_FLUSH_ROWS, ANALYTICS_MAX_PENDING
+
+# Write-behind buffer for analytics writes that used to be single-row INSERTs on
+# the hot path: activity counters, offer events and user history. Handlers only
+# append here; run_flusher writes everything in three batched statements.
+#
+# Memory is bounded by ANALYTICS_MAX_PENDING rows: a producer that finds the
+# buffer full waits for a flush (backpressure); if the DB is down and the buffer
+# is still full, the row is dropped and logged rather than growing forever.
+# New history rows show up in the history screen after the next flush (~ANALYTICS_FLUSH_MS).
+
+# (user_id, day, mode, exam, subject) -> count
+_activity: Dict[tuple, int] = {}
+# (user_id, ts, event, offer_key, variant, meta)
+_offers: List[tuple] = []
+# (user_id, kind, prompt, response, subject, created_at)
+_history: List[tuple] = []
+
+_wakeup = asyncio.Event()
+_flush_lock = asyncio.Lock()
+_stats = {"flushes": 0, "rows": 0, "dropped": 0, "errors": 0}
+_closing = False
+
+
+def pending() -> int:
+    return len(_activity) + len(_offers) + len(_history)
+
+
+async def _reserve() -> bool:
+    """Makes room for one row; False if the buffer is full and cannot be flushed."""
+    if pending() >= ANALYTICS_MAX_PENDING:
+        try:
+            await flush()
+        except Exception:
+            logging.exception("analytics flush failed")
+        if pending() >= ANALYTICS_MAX_PENDING:
+            _stats["dropped"] += 1
+            return False
+    return True
+
+
+def _added() -> None:
+    if pending() >= ANALYTICS_FLUSH_ROWS:
+        _wakeup.set()
+
+
+async def inc_activity(user_id: int, mode: str, exam: str | None = None, subject: str | None = None) -> None:
+    key = (int(user_id or 0), dt.date.today(), mode, exam or "", subject or "")
+    if key not in _activity and not await _reserve():
+        logging.warning("analytics buffer full, dropping activity %s", mode)
+        return
+    _activity[key] = _activity.get(key, 0) + 1
+    _added()
+
+
+async def log_offer_event(user_id: int, event: str, offer_key: str, variant: str | None = None, meta: dict | None = None) -> None:
+    if not await _reserve():
+        logging.warning("analytics buffer full, dropping offer event %s/%s", event, offer_key)
+        return
+    _offers.append((int(user_id or 0), dt.datetime.now(), event, offer_key, variant, meta))
+    _added()
+
+
+async def add_history(user_id: int, kind: str, prompt: str, response: str, subject: str | None = None) -> None:
+    if not await _reserve():
+        logging.warning("analytics buffer full, dropping history row")
+        return
+    _history.append((user_id, kind, prompt, response, subject, dt.datetime.now()))
+    _added()
+
+
+def _take():
+    global _activity, _offers, _history
+    batch = (_activity, _offers, _history)
+    _activity, _offers, _history = {}, [], []
+    return batch
+
+
+def _restore(activity, offers, history) -> None:
+    # Merged with whatever arrived meanwhile; older rows first.
+    for key, n in activity.items():
+        _activity[key] = _activity.get(key, 0) + n
+    _offers[:0] = offers
+    _history[:0] = history
+
+
+async def flush() -> int:
+    """Writes everything buffered (off the loop). Returns the number of rows written.
+
+    Each table is its own transaction; on failure only the unwritten parts are
+    put back, so counters are never applied twice.
+    """
+    async with _flush_lock:
+        activity, offers, history = _take()
+        rows = len(activity) + len(offers) + len(history)
+        if not rows:
+            return 0
+        try:
+            if activity:
+                await db.aio.add_activity_rows([(*key, n) for key, n in activity.items()])
+                activity = {}
+            if offers:
+                await db.aio.add_offer_events(offers)
+                offers = []
+            if history:
+                await db.aio.add_history_rows(history)
+                history = []
+        except Exception:
+            _stats["errors"] += 1
+            _restore(activity, offers, history)
+            raise
+        _stats["flushes"] += 1
+        _stats["rows"] += rows
+        return rows
+
+
+def stats() -> dict:
+    return {**_stats, "pending": pending()}
+
+
+async def run_flusher() -> None:
+    """Background loop: flush every ANALYTICS_FLUSH_MS, or sooner once ANALYTICS_FLUSH_ROWS are queued.
+
+    Stopped by close(), never cancelled: a cancelled flush could lose or double-write a batch.
+    """
+    while not _closing:
+        try:
+            await asyncio.wait_for(_wakeup.wait(), ANALYTICS_FLUSH_MS / 1000)
+        except asyncio.TimeoutError:
+            pass
+        _wakeup.clear()
+        try:
+            await flush()
+        except Exception:
+            logging.exception("analytics flush failed")
+
+
+async def close(flusher: asyncio.Task | None = None) -> None:
+    """Stops the flusher after its current batch and writes whatever is still buffered."""
+    global _closing
+    _closing = True
+    _wakeup.set()
+    if flusher is not None:
+        await flusher
+    await flush()
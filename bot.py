@@ -29,8 +29,7 @@ def startup_healthcheck():
     # DB smoke test
     try:
         import db as _db
-        _db.init_db()
-        logging.info("✅ PostgreSQL: OK (init_db succeeded)")
+        logging.info("✅ PostgreSQL: OK (schema version %s)", _db.schema_version())
     except Exception as e:
         logging.exception("❌ PostgreSQL: FAILED (%s)", e)
 
@@ -44,23 +43,46 @@ from uuid import uuid4
 import random
 import hashlib
 import re
+import time
+import threading
+import asyncio
+from contextlib import aclosing, asynccontextmanager
 
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton, LabeledPrice
 from telegram.constants import ParseMode
+from telegram.error import BadRequest, RetryAfter
 from telegram.ext import (
     Application, CommandHandler, CallbackQueryHandler, MessageHandler,
     PreCheckoutQueryHandler, ContextTypes, filters
 )
 
+import analytics
 import db
 from config import (
     TELEGRAM_BOT_TOKEN, PLANS, TOPUPS, STARS_CURRENCY,
     OWNER_USER_ID, ADMIN_CHAT_ID, MIN_PAYOUT_STARS, REVENUE_DAYS_DEFAULT,
-    DEEPSEEK_MODEL, DEEPSEEK_MODEL_FREE, MAX_TOKENS,
+    MAX_TOKENS,
     ENABLE_TEXT_CACHE, TEXT_CACHE_TTL_DAYS,
+    ENABLE_STREAMING, STREAM_EDIT_INTERVAL_SEC, BOT_CONCURRENT_UPDATES,
+    FREE_REDUCED_MAX_TOKENS, VISION_PHASH_MAX_DISTANCE, TEXT_CACHE_WARM_TOP_N,
+    CACHE_KEY_LEGACY_FALLBACK, ENABLE_NEAR_DUP_CACHE,
+    TEXT_CACHE_MAX_ROWS, TEXT_CACHE_MAX_BYTES, TEXT_CACHE_COMPACT_SEC, TEXT_CACHE_AGING_HOURS, TEXT_CACHE_HIT_FLUSH_SEC,
+    TEXT_CACHE_STALE_DAYS, DEEPSEEK_VISION_MODEL,
+    HISTORY_RETENTION_MONTHS, OFFER_EVENTS_RETENTION_MONTHS, PARTITION_RETENTION_MODE, PARTITION_MONTHS_AHEAD,
 )
 from i18n import detect_lang, tr
-from ai.deepseek import generate_text, generate_vision
+from ai.deepseek import generate_text, generate_vision, stream_text, close_client, upstream_available, upstream_degraded, upstream_stats, UpstreamUnavailable
+from ai.singleflight import SingleFlight
+from ai.scheduler import scheduler, QueueTimeout
+from ai import usage as usage_ledger
+from ai import routing
+from ai import image_prep
+from ai.image_prep import pick_photo_size, prepare_image
+from cache.phash import dhash, phash_index, to_signed
+from cache.text_tier import text_cache
+from cache.normalize import KEY_VERSION, normalize_prompt
+from cache.minhash import question_index, split_prompt
+from ai import prompts
 from security.anti_abuse import check_rate_limit, is_duplicate_burst, clamp_text
 from monetization.smart_paywall import PAYWALL_TRIGGER_COUNT, paywall_keyboard, paywall_keyboard_full, paywall_message_early, paywall_message_soft, paywall_message_limit, paywall_trigger_count_for_user
 from monetization.personal_offers import choose_offer, build_offer_text, offer_keyboard, promo_expires_at, PROMO_BONUSES
@@ -82,6 +104,314 @@ def make_cache_key(prefix: str, *parts: str) -> str:
     digest = hashlib.sha256(raw.encode("utf-8")).hexdigest()
     return f"{prefix}:{digest}"
 
+def template_parts(tpl, models) -> list[str]:
+    """Cache-key parts pinning the system prompt version and the model route."""
+    return [f"tpl={tpl.tag}", "models=" + ">".join(models or [])]
+
+def make_prompt_cache_keys(prefix: str, *parts: str, prompt: str, lang: str, tpl, models):
+    """(key, fallback_keys) for a user prompt.
+
+    The key covers the normalized prompt, the prompt template version and the
+    model route. Fallbacks, in lookup order: the same request under template
+    versions accepted via /cache migrate, then (while CACHE_KEY_LEGACY_FALLBACK
+    is on) the keys used before templates and before normalization.
+    """
+    norm = normalize_prompt(prompt, lang)
+    route = "models=" + ">".join(models or [])
+    keys = [make_cache_key(f"{prefix}:{KEY_VERSION}", *parts, f"tpl={tag}", route, norm) for tag in tpl.key_tags()]
+    if CACHE_KEY_LEGACY_FALLBACK:
+        keys.append(make_cache_key(f"{prefix}:{KEY_VERSION}", *parts, norm))
+        keys.append(make_cache_key(prefix, *parts, prompt))
+    return keys[0], keys[1:]
+
+async def near_question(*parts: str, prompt: str, lang: str):
+    """(scope, signature) of a prompt for the near-duplicate index, or None if there is nothing to match on."""
+    if not ENABLE_NEAR_DUP_CACHE:
+        return None
+    math, words = split_prompt(prompt, lang)
+    if not math and not words:
+        return None
+    # MinHash is a pure-Python loop over every shingle: off the event loop, like the photo dHash.
+    sig = await image_prep.run_in_pool(question_index.signature, words)
+    return make_cache_key("qscope", *parts, math), sig
+
+async def cached_near_text(near):
+    """text_cache row of the most similar cached question, if any."""
+    if not near:
+        return None
+    found = question_index.lookup(near[0], near[1], TEXT_CACHE_TTL_DAYS)
+    if not found:
+        return None
+    row = await text_cache.get(found[1], ttl_days=TEXT_CACHE_TTL_DAYS)
+    if row is None:
+        question_index.discard(found[1])
+    return row
+
+async def cached_text(cache_key: str, fallback_keys=(), tpl=None):
+    """text_cache row for cache_key; a hit on a fallback key is promoted to cache_key (lazy migration)."""
+    row = await text_cache.get(cache_key, ttl_days=TEXT_CACHE_TTL_DAYS)
+    for key in fallback_keys:
+        if row is not None:
+            break
+        row = await text_cache.get(key, ttl_days=TEXT_CACHE_TTL_DAYS)
+        if row:
+            try:
+                await text_cache.set(cache_key, row["response"], model=row.get("model"), tpl=tpl.tag if tpl else None)
+            except Exception:
+                logging.exception("cache key promotion failed")
+    return row
+
+
+
+TG_MAX_MESSAGE_LEN = 4096
+
+# Identical in-flight generations (same cache key) share one upstream call.
+text_flights = SingleFlight()
+vision_flights = SingleFlight()
+
+
+def split_message(text: str, limit: int = TG_MAX_MESSAGE_LEN) -> list[str]:
+    """Splits a long answer into Telegram-sized parts, preferring line breaks, then spaces."""
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut < limit // 2:
+            cut = text.rfind(" ", 0, limit)
+        if cut < limit // 2:
+            cut = limit
+        parts.append(text[:cut].rstrip())
+        text = text[cut:].lstrip()
+    parts.append(text)
+    return parts
+
+
+async def reply_long(msg, text: str, reply_markup=None):
+    """reply_text for answers that may exceed one message; the keyboard goes on the last part."""
+    parts = split_message(text)
+    for i, part in enumerate(parts):
+        await msg.reply_text(part, reply_markup=reply_markup if i == len(parts) - 1 else None)
+
+
+async def _edit_progress(message, text: str, reply_markup=None):
+    try:
+        await message.edit_text(text[:TG_MAX_MESSAGE_LEN], reply_markup=reply_markup)
+    except BadRequest as e:
+        # Same text twice (e.g. a whitespace-only delta) is harmless.
+        if "not modified" not in str(e).lower():
+            raise
+
+
+async def _generate_reply(lang: str, prompt: str, *, system: str, max_tokens: int, model: str, meta: dict) -> tuple[str, bool]:
+    try:
+        reply = await generate_text(prompt, system=system, max_tokens=max_tokens, model=model, meta=meta)
+        return reply, bool(reply) and "⚠️" not in reply
+    except UpstreamUnavailable:
+        return tr(lang, "upstream_down"), False
+    except Exception:
+        return tr(lang, "error_generic"), False
+
+
+async def _stream_into(placeholder, lang: str, prompt: str, *, system: str, max_tokens: int, model: str, meta: dict) -> tuple[str, bool]:
+    text = ""
+    next_edit = time.monotonic() + STREAM_EDIT_INTERVAL_SEC
+    try:
+        # aclosing: an aborted stream releases its host slot and HTTP stream right away.
+        async with aclosing(stream_text(prompt, system=system, max_tokens=max_tokens, model=model, meta=meta)) as stream:
+            async for delta in stream:
+                text += delta
+                now = time.monotonic()
+                if now < next_edit or not text.strip():
+                    continue
+                next_edit = now + STREAM_EDIT_INTERVAL_SEC
+                try:
+                    await _edit_progress(placeholder, text + " ▌")
+                except RetryAfter as e:
+                    next_edit = now + float(e.retry_after)
+                except Exception:
+                    # A failed progress edit must not abort the generation; the final edit still runs.
+                    logging.warning("streaming progress edit failed", exc_info=True)
+        reply = text.strip()
+        ok = bool(reply) and "⚠️" not in reply
+    except UpstreamUnavailable:
+        reply, ok = tr(lang, "upstream_down"), False
+    except Exception:
+        logging.exception("Streaming generation failed")
+        reply, ok = tr(lang, "error_generic"), False
+
+    if not reply:
+        reply, ok = tr(lang, "error_generic"), False
+    return reply, ok
+
+
+async def _finish_stream(placeholder, reply: str, reply_markup=None):
+    """Edits the placeholder into the final answer; text past one message follows as replies."""
+    first, *rest = split_message(reply)
+    markup = None if rest else reply_markup
+    try:
+        await _edit_progress(placeholder, first, reply_markup=markup)
+    except RetryAfter as e:
+        await asyncio.sleep(float(e.retry_after))
+        await _edit_progress(placeholder, first, reply_markup=markup)
+    for i, part in enumerate(rest):
+        await placeholder.reply_text(part, reply_markup=reply_markup if i == len(rest) - 1 else None)
+
+
+def plan_max_tokens(plan_key: str, default: int) -> int:
+    """Token cap for a plan; FREE is tightened while profit_guard says API cost is too close to revenue."""
+    cap = MAX_TOKENS.get(plan_key, default)
+    if plan_key == "free" and usage_ledger.limits_reduced():
+        cap = min(cap, FREE_REDUCED_MAX_TOKENS)
+    return cap
+
+
+def lane_for(uid: int, plan_key: str) -> str:
+    """Scheduler lane for a request (owner rides the top lane)."""
+    return "ultra" if is_owner(uid) else plan_key
+
+
+@asynccontextmanager
+async def upstream_slot(msg, lang: str, lane: str):
+    """Holds a generation slot; tells the user their queue position if they have to wait."""
+    notice = None
+
+    async def on_queued(position: int):
+        nonlocal notice
+        notice = await msg.reply_text(tr(lang, "queued_position").format(n=position))
+
+    async with scheduler.slot(lane, on_queued=on_queued):
+        if notice is not None:
+            try:
+                await notice.delete()
+            except Exception:
+                pass
+        yield
+
+
+async def _store_answer(cache_key: str, reply: str, model: str, near=None, tpl=None):
+    tag = tpl.tag if tpl else None
+    if near:
+        await text_cache.set(cache_key, reply, model=model, tpl=tag, minhash=near[1].tobytes(), lsh_scope=near[0])
+        question_index.add(near[0], near[1], cache_key)
+    else:
+        await text_cache.set(cache_key, reply, model=model, tpl=tag)
+
+
+async def _stale_answer(cache_key: str) -> str | None:
+    """Expired (but kept) cached answer for cache_key, if stale serving is enabled."""
+    if TEXT_CACHE_STALE_DAYS <= 0:
+        return None
+    try:
+        row = await text_cache.get_stale(cache_key, TEXT_CACHE_TTL_DAYS, TEXT_CACHE_STALE_DAYS)
+    except Exception:
+        logging.exception("stale cache lookup failed")
+        return None
+    return row["response"] if row else None
+
+
+_stale_refreshes: dict[str, asyncio.Task] = {}
+
+
+def _schedule_refresh(cache_key: str, prompt: str, *, system: str, max_tokens: int, models: list[str], mode: str, near=None, tpl=None):
+    """Regenerates a stale entry in the background once the upstream is reachable again."""
+    if cache_key in _stale_refreshes:
+        return
+
+    async def regenerate():
+        async with scheduler.slot("free"):
+            for i, model in enumerate(models):
+                meta = {}
+                reply = await generate_text(prompt, system=system, max_tokens=max_tokens, model=model, meta=meta)
+                if not reply or "⚠️" in reply:
+                    return reply, False, False
+                last = i == len(models) - 1
+                reason = routing.escalation_reason(mode, reply, meta.get("finish_reason"))
+                routing.record(mode, model, reason, escalating=not last)
+                if reason is None or last:
+                    break
+        await _store_answer(cache_key, reply, model, near, tpl)
+        return reply, True, False
+
+    async def run():
+        try:
+            for _ in range(120):  # up to ~10 min for the breaker to close
+                await asyncio.sleep(5)
+                if upstream_available():
+                    break
+            await text_flights.do(cache_key, regenerate)
+        except Exception:
+            logging.exception("stale cache refresh failed")
+        finally:
+            _stale_refreshes.pop(cache_key, None)
+
+    _stale_refreshes[cache_key] = asyncio.create_task(run())
+
+
+async def send_answer(msg, lang: str, prompt: str, *, system: str, max_tokens: int, models: list[str], mode: str, lane: str = "free", reply_markup=None, cache_key: str | None = None, near=None, tpl=None) -> tuple[str, bool]:
+    """Generate a text answer and send it as a reply to `msg`.
+
+    The upstream call waits for a slot in the plan's scheduler lane.
+    `models` is the cascade from route_models(): each next model is only asked
+    when the previous answer fails the routing checks for `mode`.
+    With ENABLE_STREAMING a placeholder is posted and edited as tokens arrive.
+    With a cache_key, concurrent identical requests share one upstream call and
+    the result is written to text_cache once; if the upstream is degraded or the
+    call fails, an expired cached answer is served instead and refreshed later.
+    Returns (reply, ok); ok is False for error/config messages that must not be cached.
+    """
+    def refresh():
+        _schedule_refresh(cache_key, prompt, system=system, max_tokens=max_tokens, models=models, mode=mode, near=near, tpl=tpl)
+
+    if cache_key and upstream_degraded():
+        stale = await _stale_answer(cache_key)
+        if stale:
+            await reply_long(msg, stale, reply_markup=reply_markup)
+            refresh()
+            return stale, True
+
+    async def produce():
+        placeholder = None
+        try:
+            async with upstream_slot(msg, lang, lane):
+                for i, model in enumerate(models):
+                    meta = {}
+                    if ENABLE_STREAMING:
+                        if placeholder is None:
+                            placeholder = await msg.reply_text("✍️ …")
+                        reply, ok = await _stream_into(placeholder, lang, prompt, system=system, max_tokens=max_tokens, model=model, meta=meta)
+                    else:
+                        reply, ok = await _generate_reply(lang, prompt, system=system, max_tokens=max_tokens, model=model, meta=meta)
+                    if not ok:
+                        break
+                    last = i == len(models) - 1
+                    reason = routing.escalation_reason(mode, reply, meta.get("finish_reason"))
+                    routing.record(mode, model, reason, escalating=not last)
+                    if reason is None or last:
+                        break
+                    if placeholder is not None:
+                        await _finish_stream(placeholder, "🔁 …")
+        except QueueTimeout:
+            reply, ok = tr(lang, "queue_busy"), False
+        fresh = ok
+        if not ok and cache_key:
+            stale = await _stale_answer(cache_key)
+            if stale:
+                reply, ok = stale, True
+                refresh()
+        if placeholder is not None:
+            await _finish_stream(placeholder, reply, reply_markup=reply_markup)
+        if fresh and cache_key:
+            await _store_answer(cache_key, reply, model, near, tpl)
+        return reply, ok, placeholder is not None
+
+    if cache_key:
+        (reply, ok, streamed), shared = await text_flights.do(cache_key, produce)
+    else:
+        (reply, ok, streamed), shared = await produce(), False
+
+    # The streaming leader already edited its placeholder into the final answer.
+    if shared or not streamed:
+        await reply_long(msg, reply, reply_markup=reply_markup)
+    return reply, ok
 
 
 def extract_subject(text: str) -> str | None:
@@ -115,8 +445,11 @@ def get_lang(update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
     return lang
 
 
-def maybe_personal_offer(update: Update, context: ContextTypes.DEFAULT_TYPE, plan_key: str):
-    """Show a personalized upgrade offer occasionally, and set a short-lived promo bonus."""
+async def maybe_personal_offer(update: Update, context: ContextTypes.DEFAULT_TYPE, plan_key: str, rc: dict | None = None):
+    """Show a personalized upgrade offer occasionally, and set a short-lived promo bonus.
+
+    rc: the handler's db.load_request_context snapshot (loaded here if not given).
+    """
     uid = update.effective_user.id
     if is_owner(uid):
         return
@@ -126,11 +459,12 @@ def maybe_personal_offer(update: Update, context: ContextTypes.DEFAULT_TYPE, pla
     if last_ts and (now - last_ts).total_seconds() < 6 * 3600:
         return
 
-    usage = db.get_usage(uid)
-    focus = db.get_top_focus(uid)
-    focus_text = focus_to_text(focus)
+    if rc is None:
+        rc = await db.aio.load_request_context(uid)
+    usage = rc["usage"]
+    focus_text = focus_to_text(rc["focus"])
     text_used = int(usage.get("text_used", 0) or 0)
-    photo_used = int(usage.get("photo_used", 0) or 0)
+    photo_used = int(usage.get("img_used", 0) or 0)
 
     plan = PLANS.get(plan_key, PLANS.get("free"))
     daily_text = int(plan.get("daily_text", 0) or 0)
@@ -141,12 +475,11 @@ def maybe_personal_offer(update: Update, context: ContextTypes.DEFAULT_TYPE, pla
         return
 
     # if a promo is already active, avoid overwriting too often
-    active = db.get_active_promo(uid)
-    if active:
+    if rc["promo"]:
         return
 
     expires = promo_expires_at()
-    db.set_promo(uid, promo_kind, target_plan, expires)
+    await db.aio.set_promo(uid, promo_kind, target_plan, expires)
     context.user_data["last_offer_ts"] = now
 
     lang = get_lang(update, context)
@@ -154,7 +487,7 @@ def maybe_personal_offer(update: Update, context: ContextTypes.DEFAULT_TYPE, pla
     try:
         # use message context: if called from callback, fall back
         if getattr(update, "message", None):
-            return update.message.reply_text(text, reply_markup=offer_keyboard())
+            await update.message.reply_text(text, reply_markup=offer_keyboard())
     except Exception:
         pass
 
@@ -279,15 +612,15 @@ def ege_actions_menu(lang: str):
         [InlineKeyboardButton("← сменить предмет", callback_data="mode:ege")],
     ])
 
-def sub_menu(lang: str, uid: int | None = None):
+async def sub_menu(lang: str, uid: int | None = None):
     buttons = []
 
     # Determine which plan to highlight as recommended (A/B)
-    rec_winner = db.get_experiment_winner("recommend_plan")
+    rec_winner = await db.aio.get_experiment_winner("recommend_plan")
     _, rec_plan = recommend_plan_for_user(uid or 0, winner=rec_winner)
 
     # First purchase special (if eligible)
-    if uid is not None and db.first_purchase_eligible(uid):
+    if uid is not None and await db.aio.first_purchase_eligible(uid):
         p = PLANS["start_first"]
         label = f"{p['name'][lang]} — {p['price_stars']}⭐"
         if rec_plan == "start":
@@ -295,7 +628,7 @@ def sub_menu(lang: str, uid: int | None = None):
         buttons.append([InlineKeyboardButton(label, callback_data="buy:sub:start_first")])
 
     # START price A/B (unless discounted first purchase is shown above)
-    price_winner = db.get_experiment_winner("start_price")
+    price_winner = await db.aio.get_experiment_winner("start_price")
     var, price = start_price_for_user(uid or 0, winner=price_winner)
     p = dict(PLANS["start"])
     p["price_stars"] = price
@@ -316,14 +649,14 @@ def sub_menu(lang: str, uid: int | None = None):
 
 
 
-def topup_menu(lang: str, uid: int | None = None):
+async def topup_menu(lang: str, uid: int | None = None):
     buttons = []
     for key, item in (sorted(TOPUPS.items(), key=lambda kv: (0 if kv[0] == "week_pack" else 1, kv[0]))):
         if key == "week_pack":
-            winner = db.get_experiment_winner("week_deal")
+            winner = await db.aio.get_experiment_winner("week_deal")
             var, deal = week_deal_for_user(uid or 0, winner=winner)
             try:
-                db.log_offer_event(uid or 0, "impression", "week_deal", var)
+                await analytics.log_offer_event(uid or 0, "impression", "week_deal", var)
             except Exception:
                 pass
             title = deal["title"][lang]
@@ -348,7 +681,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 inviter_id = None
         except Exception:
             inviter_id = None
-    db.upsert_user(update.effective_user.id, lang=lang, inviter_id=inviter_id)
+    await db.aio.upsert_user(update.effective_user.id, lang=lang, inviter_id=inviter_id)
     await update.message.reply_text(
         f"<b>{tr(lang,'welcome_title')}</b>\\n\\n{tr(lang,'welcome_body')}",
         reply_markup=main_menu(lang, update.effective_user.id),
@@ -366,7 +699,7 @@ async def revenue_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
             days = max(1, min(365, int(context.args[0])))
         except Exception:
             days = REVENUE_DAYS_DEFAULT
-    total, by_day, by_kind = db.revenue_summary(days=days)
+    total, by_day, by_kind = await db.aio.revenue_summary(days=days)
     lines = [f"{tr(lang,'revenue')} ({days}d): <b>{total}⭐</b>", "", "<b>By kind</b>:"]
     for r in by_kind:
         lines.append(f"- {r['kind']}: {int(r['stars'])}⭐")
@@ -381,7 +714,7 @@ async def payouts_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id):
         return
     lang = get_lang(update, context)
-    rows = db.list_new_payouts(limit=10)
+    rows = await db.aio.list_new_payouts(limit=10)
     if not rows:
         await update.message.reply_text("No new payout requests.")
         return
@@ -398,13 +731,69 @@ async def payouts_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
 # User: create payout request
+# Admin: prompt template versions & cache invalidation
+async def cache_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/cache — templates and cached entries per version
+    /cache invalidate <template|mode|legacy> [version] — delete cached answers
+    /cache migrate <template> <old_version> — keep serving old-version answers (promoted lazily)"""
+    if not is_admin(update.effective_user.id):
+        return
+    args = context.args or []
+    if not args:
+        counts = {}
+        try:
+            for r in await db.aio.text_cache_template_counts():
+                counts[r["tpl"]] = int(r["n"])
+        except Exception:
+            logging.exception("text_cache template counts failed")
+        lines = ["<b>🧾 Шаблоны промптов</b>"]
+        for tpl in prompts.templates():
+            old = sum(n for tag, n in counts.items() if tag and tag.startswith(tpl.name + "@") and tag != tpl.tag)
+            acc = f", принимает {', '.join(tpl.accepts)}" if tpl.accepts else ""
+            lines.append(f"• {tpl.name} <code>{tpl.version}</code>: {counts.get(tpl.tag, 0)} в кэше, старых версий {old}{acc}")
+        lines.append(f"• без шаблона (legacy): {counts.get(None, 0)}")
+        await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
+        return
+
+    action, selector = args[0], (args[1] if len(args) > 1 else "")
+    version = args[2] if len(args) > 2 else None
+    if action == "invalidate" and selector == "legacy":
+        deleted = await db.aio.invalidate_text_cache(None, None)
+        text_cache.discard_where(lambda row: not row.get("tpl"))
+        await update.message.reply_text(f"Удалено записей без шаблона: {deleted}")
+        return
+    if action == "invalidate" and selector:
+        names = [t.name for t in prompts.matching(selector)]
+        if not names:
+            await update.message.reply_text("Нет такого шаблона/режима.")
+            return
+        deleted = 0
+        for name in names:
+            deleted += await db.aio.invalidate_text_cache(name, version)
+            prefix = f"{name}@{version}" if version else f"{name}@"
+            text_cache.discard_where(lambda row, p=prefix: (row.get("tpl") or "").startswith(p))
+        await update.message.reply_text(f"Удалено записей: {deleted} ({', '.join(names)})")
+        return
+    if action == "migrate" and selector and version:
+        try:
+            prompts.get(selector)
+        except KeyError:
+            await update.message.reply_text("Нет такого шаблона.")
+            return
+        await db.aio.add_cache_migration(selector, version)
+        prompts.accept(selector, version)
+        await update.message.reply_text(f"{selector}: ответы версии {version} будут переиспользоваться (переносятся при обращении).")
+        return
+    await update.message.reply_text(cache_cmd.__doc__)
+
+
 async def payout_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     lang = get_lang(update, context)
     uid = update.effective_user.id
     if is_owner(uid):
         await update.message.reply_text("✅ Owner mode: unlimited & free. Payout not needed.")
         return
-    user = db.get_user(uid)
+    user = await db.aio.get_user(uid)
     if not user:
         await update.message.reply_text(tr(lang,"error_generic")); return
 
@@ -414,7 +803,7 @@ async def payout_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except Exception: amount = None
 
     if amount is None:
-        history = db.list_user_payouts(uid, limit=5)
+        history = await db.aio.list_user_payouts(uid, limit=5)
         hist_lines = []
         for h in history:
             note = f" — {h['admin_note']}" if h.get("admin_note") else ""
@@ -426,7 +815,7 @@ async def payout_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    ok, code = db.can_request_payout(uid)
+    ok, code = await db.aio.can_request_payout(uid)
     if not ok:
         if code=="too_small":
             await update.message.reply_text(tr(lang,"payout_too_small")+f" (min {MIN_PAYOUT_STARS}⭐)")
@@ -442,7 +831,7 @@ async def payout_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(tr(lang,"payout_not_enough")); return
 
     try:
-        pid = db.create_payout_request(uid, amount)
+        pid = await db.aio.create_payout_request(uid, amount)
     except Exception:
         await update.message.reply_text(tr(lang,"error_generic")); return
 
@@ -469,13 +858,14 @@ async def skip_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     if context.user_data.get("pending_reject_pid"):
         pid = context.user_data.pop("pending_reject_pid")
-        db.reject_payout(pid, note="Rejected by admin")
+        await db.aio.reject_payout(pid, note="Rejected by admin")
         await update.message.reply_text("Skipped. Rejected.")
     else:
         await update.message.reply_text("Nothing to skip.")
 
+        plan_key = "ultra"
         if not is_owner(uid):
-            plan_key, *_ = db.remaining_today(uid)
+            plan_key = (await db.aio.load_request_context(uid))["plan"]
             if plan_key == "free":
                 await query.answer()
                 await query.message.reply_text("Полный разбор доступен по подписке.", reply_markup=paywall_keyboard())
@@ -484,32 +874,27 @@ async def skip_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.answer()
         await query.message.reply_text("Готовлю полный разбор…")
 
-        plan_key = "ultra"
-        if not is_owner(uid):
-            plan_key, *_ = db.remaining_today(uid)
-
         max_tokens = MAX_TOKENS.get(plan_key, 1400)
-        model = DEEPSEEK_MODEL
+        models = routing.route_models(plan_key)
 
-        system = "You are StudyAI. Provide a very detailed step-by-step breakdown with clear explanations and checks. Do not reveal hidden chain-of-thought. Language must match the user's language."
+        tpl = prompts.EXPAND
+        system = tpl.text
         prompt = f"Сделай ПОЛНЫЙ разбор и объяснение.\n\n{last_prompt}"
 
-        cache_key = make_cache_key("text", f"mode=expand:{last_mode}", f"lang={lang}", prompt)
+        cache_key, fallback_keys = make_prompt_cache_keys("text", f"mode=expand:{last_mode}", f"lang={lang}", prompt=prompt, lang=lang, tpl=tpl, models=models)
         if ENABLE_TEXT_CACHE and not is_owner(uid):
-            row = db.get_text_cache(cache_key, ttl_days=TEXT_CACHE_TTL_DAYS)
+            row = await cached_text(cache_key, fallback_keys, tpl)
             if row and row.get("response"):
                 await query.message.reply_text(row["response"])
                 return
 
-        try:
-            reply = generate_text(prompt, system=system, max_tokens=max_tokens, model=model)
-        except Exception:
-            reply = tr(lang, "error_generic")
-
-        if ENABLE_TEXT_CACHE and not is_owner(uid) and reply and "⚠️" not in reply:
-            db.set_text_cache(cache_key, reply, model=model)
-
-        await query.message.reply_text(reply)
+        cacheable = ENABLE_TEXT_CACHE and not is_owner(uid)
+        reply, ok = await send_answer(query.message, lang, prompt, system=system, max_tokens=max_tokens, models=models, mode="expand", lane=lane_for(uid, plan_key), cache_key=cache_key if cacheable else None, tpl=tpl)
+        if ok:
+            try:
+                await analytics.add_history(uid, "text", prompt, reply, subject=extract_subject(reply))
+            except Exception:
+                pass
         return
 
 async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -522,6 +907,7 @@ async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Full breakdown on demand (two-level answers)
     if data == "action:expand":
         uid = q.from_user.id
+        usage_ledger.tag(uid, "expand")
 
         last_prompt = context.user_data.get("last_prompt")
         last_mode = context.user_data.get("last_mode", "study")
@@ -530,8 +916,9 @@ async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await q.answer("Нет запроса для разбора.")
             return
 
+        plan_key = "ultra"
         if not is_owner(uid):
-            plan_key, *_ = db.remaining_today(uid)
+            plan_key = (await db.aio.load_request_context(uid))["plan"]
             if plan_key == "free":
                 await q.answer()
                 await q.message.reply_text("Полный разбор доступен по подписке.", reply_markup=paywall_keyboard())
@@ -540,32 +927,27 @@ async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await q.answer()
         await q.message.reply_text("Готовлю полный разбор…")
 
-        plan_key = "ultra"
-        if not is_owner(uid):
-            plan_key, *_ = db.remaining_today(uid)
-
         max_tokens = MAX_TOKENS.get(plan_key, 1400)
-        model = DEEPSEEK_MODEL
+        models = routing.route_models(plan_key)
 
-        system = "You are StudyAI. Provide a very detailed step-by-step breakdown with clear explanations and checks. Do not reveal hidden chain-of-thought. Language must match the user's language."
+        tpl = prompts.EXPAND
+        system = tpl.text
         expand_prompt = f"Сделай ПОЛНЫЙ разбор и объяснение.\n\n{last_prompt}"
 
-        cache_key = make_cache_key("text", f"mode=expand:{last_mode}", f"lang={lang}", expand_prompt)
+        cache_key, fallback_keys = make_prompt_cache_keys("text", f"mode=expand:{last_mode}", f"lang={lang}", prompt=expand_prompt, lang=lang, tpl=tpl, models=models)
         if ENABLE_TEXT_CACHE and not is_owner(uid):
-            row = db.get_text_cache(cache_key, ttl_days=TEXT_CACHE_TTL_DAYS)
+            row = await cached_text(cache_key, fallback_keys, tpl)
             if row and row.get("response"):
                 await q.message.reply_text(row["response"])
                 return
 
-        try:
-            reply = generate_text(expand_prompt, system=system, max_tokens=max_tokens, model=model)
-        except Exception:
-            reply = tr(lang, "error_generic")
-
-        if ENABLE_TEXT_CACHE and not is_owner(uid) and reply and "⚠️" not in reply:
-            db.set_text_cache(cache_key, reply, model=model)
-
-        await q.message.reply_text(reply)
+        cacheable = ENABLE_TEXT_CACHE and not is_owner(uid)
+        reply, ok = await send_answer(q.message, lang, expand_prompt, system=system, max_tokens=max_tokens, models=models, mode="expand", lane=lane_for(uid, plan_key), cache_key=cache_key if cacheable else None, tpl=tpl)
+        if ok:
+            try:
+                await analytics.add_history(uid, "text", expand_prompt, reply, subject=extract_subject(reply))
+            except Exception:
+                pass
         return
 
     # --- OGE/EGE flow ---
@@ -597,14 +979,14 @@ async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
 
         subject_human = subject_label(subject)
-        prompts = {
+        action_prompts = {
             "theory": f"Дай краткую, но понятную теорию для подготовки к {exam.upper()} по предмету {subject_human}.",
             "practice": f"Дай практические задания (разного типа) для подготовки к {exam.upper()} по предмету {subject_human}.",
             "test": f"Составь мини-тест (10 вопросов) для подготовки к {exam.upper()} по предмету {subject_human}.",
             "check": f"Я пришлю решение/ответ. Проверь и объясни ошибки. Контекст: {exam.upper()} по предмету {subject_human}.",
             "analysis": f"Сделай разбор типовых заданий и частых ошибок для {exam.upper()} по предмету {subject_human}.",
         }
-        prompt = prompts.get(action)
+        prompt = action_prompts.get(action)
         if not prompt:
             await q.answer("Неизвестное действие")
             return
@@ -618,12 +1000,12 @@ async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await q.edit_message_text("Not allowed."); return
         _, _, action, pid_s = data.split(":", 3)
         pid = int(pid_s)
-        req = db.get_payout(pid)
+        req = await db.aio.get_payout(pid)
         if not req:
             await q.edit_message_text("Not found."); return
 
         if action=="paid":
-            ok = db.approve_payout(pid)
+            ok = await db.aio.approve_payout(pid)
             await q.edit_message_text(tr(lang,"admin_payout_paid") if ok else "Already processed.")
             try:
                 await context.bot.send_message(chat_id=int(req["user_id"]), text=tr(lang,"user_payout_paid"))
@@ -656,9 +1038,9 @@ async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         await q.edit_message_text(tr(lang,"chill_menu"), reply_markup=chill_menu(lang)); return
     if data=="menu:sub":
-        await q.edit_message_text("⭐", reply_markup=sub_menu(lang, uid)); return
+        await q.edit_message_text("⭐", reply_markup=await sub_menu(lang, uid)); return
     if data=="menu:topup":
-        await q.edit_message_text("🛒", reply_markup=topup_menu(lang, uid)); return
+        await q.edit_message_text("🛒", reply_markup=await topup_menu(lang, uid)); return
     if data=="menu:help":
         await q.edit_message_text(tr(lang,"help"), reply_markup=main_menu(lang, update.effective_user.id)); return
     if data=="menu:profile":
@@ -670,13 +1052,13 @@ async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
         uid = q.from_user.id
         subjects_rows = []
         try:
-            subjects_rows = db.list_history_subjects(uid, limit=8)
+            subjects_rows = await db.aio.list_history_subjects(uid, limit=8)
         except Exception:
             subjects_rows = []
         subjects = [r.get("subject") for r in (subjects_rows or []) if r.get("subject")]
         context.user_data["hist_subjects"] = subjects
         subject = "__all__"
-        rows = db.list_history_filtered(uid, subject=subject, limit=10) if hasattr(db, "list_history_filtered") else db.list_history(uid, limit=10)
+        rows = await db.aio.list_history_filtered(uid, subject=subject, limit=10) if hasattr(db, "list_history_filtered") else await db.aio.list_history(uid, limit=10)
         if not rows:
             await q.edit_message_text("🕘 История пуста. Сделай пару запросов — и они появятся здесь.", reply_markup=profile_menu(lang))
             return
@@ -705,7 +1087,7 @@ async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if sel != "__all__" and sel not in subjects:
             # fallback: keep showing all
             subject = "__all__"
-        rows = db.list_history_filtered(uid, subject=subject, limit=10) if hasattr(db, "list_history_filtered") else db.list_history(uid, limit=10)
+        rows = await db.aio.list_history_filtered(uid, subject=subject, limit=10) if hasattr(db, "list_history_filtered") else await db.aio.list_history(uid, limit=10)
         if not rows:
             await q.answer("Пусто")
             return
@@ -818,16 +1200,69 @@ async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
             [InlineKeyboardButton("📊 Дашборд", callback_data="admin:dash")],
             [InlineKeyboardButton("💰 Revenue (7d)", callback_data="admin:revenue:7")],
             [InlineKeyboardButton("📋 Новые выплаты", callback_data="admin:payouts")],
+            [InlineKeyboardButton("⚙️ Нагрузка", callback_data="admin:perf")],
             [InlineKeyboardButton(tr(lang,"back"), callback_data="menu:main")],
         ])
         await q.edit_message_text("🛠 Админ-панель:", reply_markup=kb)
         return
 
+    if data=="admin:perf":
+        if not is_admin(q.from_user.id):
+            await q.edit_message_text("Not allowed.")
+            return
+        lines = [f"⚙️ Нагрузка\n\n🧵 DeepSeek слоты: <b>{scheduler.active}/{scheduler.capacity}</b>", "", "<b>Очереди</b> (глубина / обслужено / таймауты / ср. и макс. ожидание):"]
+        for lane, st in scheduler.stats().items():
+            lines.append(f"- {lane}: {st['depth']} / {st['served']} / {st['timeouts']} / {st['avg_wait_ms']}ms, {st['max_wait_ms']}ms")
+        up = upstream_stats()
+        lines.append("")
+        lines.append(f"🔌 DeepSeek: breaker <b>{up['breaker']}</b>, p95 {up['p95_ms']}ms")
+        lines.append(f"  вызовы {up['calls']}, повторы {up['retries']}, сбои {up['failures']}, отказы {up['fast_fails']}, hedge {up['hedge_wins']}/{up['hedges']}")
+        rs = routing.stats()
+        if rs:
+            lines.append("")
+            lines.append("<b>Каскад моделей</b> (эскалации / проверено):")
+            for mode, st in sorted(rs.items()):
+                fails = ", ".join(f"{k[5:]} {v}" for k, v in sorted(st.items()) if k.startswith("fail_"))
+                lines.append(f"- {mode}: {st.get('escalated', 0)}/{st['checked']}" + (f" ({fails})" if fails else ""))
+        ip = image_prep.stats()
+        if ip["images"]:
+            lines.append("")
+            lines.append(f"🖼 Фото: {ip['images']} шт., {ip['bytes_in'] // 1024}KB → {ip['bytes_out'] // 1024}KB к отправке")
+        tc = text_cache.stats()
+        lines.append("")
+        lines.append(
+            f"💾 Кэш ответов: память {100 * tc['l1_ratio']:.0f}%, БД {100 * tc['l2_ratio']:.0f}%, "
+            f"промахи {tc['misses']} из {tc['lookups']} ({tc['entries']} в памяти, {tc['bytes'] // 1024}KB), "
+            f"устаревшие {tc['stale_hits']}"
+        )
+        bf = text_cache.filter_stats()
+        if bf:
+            lines.append(
+                f"🌸 Фильтр ключей: {bf['count']}/{bf['capacity']}, {bf['bytes'] // 1024}KB, "
+                f"ложные срабатывания ~{100 * bf['estimated_fp']:.2f}% (цель {100 * bf['target_fp']:.2f}%), "
+                f"сэкономлено запросов к БД {tc['filtered_misses']}"
+            )
+        qi = question_index.stats()
+        lines.append(f"🧬 Похожие вопросы: {qi['hits']}/{qi['lookups']} ({100 * qi['hit_rate']:.0f}%), в индексе {qi['entries']}, порог {qi['threshold']}")
+        ph = phash_index.stats()
+        lines.append(f"🧩 Похожие фото: {ph['hits']}/{ph['lookups']} ({100 * ph['hit_rate']:.0f}%), в индексе {ph['entries']}, порог {ph['max_distance']}")
+        an = analytics.stats()
+        lines.append(f"📝 Аналитика: в очереди {an['pending']}, записано {an['rows']} за {an['flushes']} раз, ошибки {an['errors']}, потеряно {an['dropped']}")
+        tf, vf = text_flights.stats(), vision_flights.stats()
+        lines.append("")
+        lines.append(f"🔗 Склейка одинаковых запросов: текст {tf['shared']}/{tf['leaders'] + tf['shared']}, фото {vf['shared']}/{vf['leaders'] + vf['shared']}")
+        await q.edit_message_text(
+            "\n".join(lines),
+            parse_mode=ParseMode.HTML,
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(tr(lang,"back"), callback_data="menu:admin")]])
+        )
+        return
+
     if data=="admin:dash":
         if not is_admin(q.from_user.id):
             await q.edit_message_text("Not allowed.")
             return
-        s = db.admin_summary()
+        s = await db.aio.admin_summary()
         msg = (
             "📊 Дашборд\n\n"
             f"👥 Всего пользователей: <b>{s['total_users']}</b>\n"
@@ -837,6 +1272,15 @@ async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"  • ДЗ по фото: <b>{s.get('photo_dz', 0)}</b>\n"\
             f"  • Оценка по фото: <b>{s.get('photo_grade', 0)}</b>"
         )
+        try:
+            pg = await usage_ledger.refresh_snapshot()
+        except Exception:
+            pg = usage_ledger.snapshot()
+        ratio = f"{100 * pg['cost_usd'] / pg['revenue_usd']:.0f}%" if pg["revenue_usd"] else "—"
+        msg += (
+            f"\n\n💸 API сегодня: <b>${pg['cost_usd']:.2f}</b> / выручка <b>${pg['revenue_usd']:.2f}</b> ({pg['revenue_stars']}⭐), {ratio}"
+            + ("\n⚠️ Лимиты FREE урезаны (profit guard)" if pg["reduce_limits"] else "")
+        )
         await q.edit_message_text(
             msg,
             parse_mode=ParseMode.HTML,
@@ -852,7 +1296,7 @@ async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
             days = int(data.split(":")[2])
         except Exception:
             days = REVENUE_DAYS_DEFAULT
-        total, by_day, by_kind = db.revenue_summary(days=days)
+        total, by_day, by_kind = await db.aio.revenue_summary(days=days)
         lines = [f"{tr(lang,'revenue')} ({days}d): <b>{total}⭐</b>", "", "<b>By kind</b>:"]
         for r in by_kind:
             lines.append(f"- {r['kind']}: {int(r['stars'])}⭐")
@@ -871,7 +1315,7 @@ async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not is_admin(q.from_user.id):
             await q.edit_message_text("Not allowed.")
             return
-        rows = db.list_new_payouts(limit=10)
+        rows = await db.aio.list_new_payouts(limit=10)
         if not rows:
             await q.edit_message_text(
                 "No new payout requests.",
@@ -894,8 +1338,18 @@ async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
         return
     if data=="chill:fact":
-        fact = generate_text("Give one short surprising fact (1 sentence).", system="You are a fun fact generator.")
-        await q.edit_message_text("😄 "+fact, reply_markup=chill_menu(lang)); return
+        usage_ledger.tag(uid, "chill")
+        try:
+            async with scheduler.slot("free"):
+                fact = "😄 " + await generate_text("Give one short surprising fact (1 sentence).", system="You are a fun fact generator.")
+        except QueueTimeout:
+            fact = tr(lang, "queue_busy")
+        except UpstreamUnavailable:
+            fact = tr(lang, "upstream_down")
+        except Exception:
+            logging.exception("chill fact generation failed")
+            fact = tr(lang, "error_generic")
+        await q.edit_message_text(fact, reply_markup=chill_menu(lang)); return
 
     if data.startswith("buy:sub:"):
         await send_invoice_subscription(q, context, data.split(":")[2], lang); return
@@ -910,8 +1364,8 @@ async def handle_admin_text(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return False
     note = update.message.text.strip()
     context.user_data.pop("pending_reject_pid", None)
-    req = db.get_payout(int(pid))
-    db.reject_payout(int(pid), note=note[:500])
+    req = await db.aio.get_payout(int(pid))
+    await db.aio.reject_payout(int(pid), note=note[:500])
     await update.message.reply_text(tr(get_lang(update, context),"admin_reject_done"))
     try:
         msg = tr(get_lang(update, context),"user_payout_rejected") + f"\\nПричина: {note[:500]}"
@@ -922,15 +1376,15 @@ async def handle_admin_text(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
 async def send_profile(q, context, lang: str):
     uid = q.from_user.id
-    user = db.get_user(uid)
+    rc = await db.aio.load_request_context(uid)
+    user = rc["user"]
     if not user:
         await q.edit_message_text(tr(lang,"error_generic"), reply_markup=main_menu(lang, uid)); return
     if is_owner(uid):
         msg = f"<b>{tr(lang,'profile')}</b>\n{tr(lang,'plan')}: <b>OWNER</b>\n{tr(lang,'today')}:\n— text: ∞\n— фото: ∞"
         await q.edit_message_text(msg, reply_markup=profile_menu(lang), parse_mode=ParseMode.HTML); return
 
-    plan, p, text_left, photo_left, *_rest = db.remaining_today(uid)
-    usage = _rest[-1] if _rest else {}
+    plan, text_left, photo_left = rc["plan"], rc["text_left"], rc["photo_left"]
     sub_until = user.get("sub_until")
     sub_str = sub_until.strftime("%Y-%m-%d") if sub_until else "-"
     msg = (
@@ -945,11 +1399,11 @@ async def send_profile(q, context, lang: str):
 
 async def send_ref(q, context, lang: str):
     uid = q.from_user.id
-    user = db.get_user(uid)
+    user = await db.aio.get_user(uid)
     me = await context.bot.get_me()
     ref = referral_link(me.username, uid)
     balance = user.get("ref_balance", 0) if user else 0
-    history = db.list_user_payouts(uid, limit=5)
+    history = await db.aio.list_user_payouts(uid, limit=5)
     hist_lines = []
     for h in history:
         note = f" — {h['admin_note']}" if h.get("admin_note") else ""
@@ -983,9 +1437,9 @@ async def send_invoice_topup(q, context, topup_key: str, lang: str):
     item = TOPUPS[topup_key]
     deal = get_week_deal() if topup_key=="week_pack" else None
     if item.get("requires_sub"):
-        plan, _ = db.get_limits(q.from_user.id)
+        plan = (await db.aio.load_request_context(q.from_user.id))["plan"]
         if plan=="free":
-            await q.edit_message_text(tr(lang,"need_sub_for_topup"), reply_markup=sub_menu(lang, q.from_user.id)); return
+            await q.edit_message_text(tr(lang,"need_sub_for_topup"), reply_markup=await sub_menu(lang, q.from_user.id)); return
     payload = f"topup:{topup_key}:{uuid4().hex}"
     prices = [LabeledPrice(label=(deal["title"][lang] if deal else item["title"][lang]), amount=(deal["stars"] if deal else item["stars"]))]
     await context.bot.send_invoice(
@@ -1007,10 +1461,10 @@ async def successful_payment(update: Update, context: ContextTypes.DEFAULT_TYPE)
     payload = sp.invoice_payload
     uid = update.effective_user.id
 
-    db.log_payment(uid, "payment", payload, sp.total_amount)
+    await db.aio.log_payment(uid, "payment", payload, sp.total_amount)
     if not is_owner(uid):
-        db.set_has_paid(uid)
-        db.credit_referral_on_purchase(uid, sp.total_amount)
+        await db.aio.set_has_paid(uid)
+        await db.aio.credit_referral_on_purchase(uid, sp.total_amount)
 
     try:
         kind, key, _ = payload.split(":",2)
@@ -1020,33 +1474,33 @@ async def successful_payment(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if kind=="sub":
         until = dt.datetime.utcnow() + dt.timedelta(days=30)
         real_key = "start" if key=="start_first" else key
-        db.set_plan(uid, real_key, until)
+        await db.aio.set_plan(uid, real_key, until)
         if key=="start_first":
             try:
-                db.mark_first_purchase_used(uid)
+                await db.aio.mark_first_purchase_used(uid)
             except Exception:
                 pass
         # apply promo bonus if active
-        promo = db.get_active_promo(uid)
+        promo = await db.aio.get_active_promo(uid)
         if promo and promo.get('target_plan') == real_key:
             pk = promo.get('promo_kind')
             bonus = PROMO_BONUSES.get(pk) or {}
             if bonus:
-                db.add_bonus(uid, bonus.get('add_text',0), bonus.get('add_photo', bonus.get('add_img',0)))
-            db.clear_promo(uid)
+                await db.aio.add_bonus(uid, bonus.get('add_text',0), bonus.get('add_photo', bonus.get('add_img',0)))
+            await db.aio.clear_promo(uid)
     elif kind=="topup":
         if key=="week_pack":
-            winner = db.get_experiment_winner("week_deal")
+            winner = await db.aio.get_experiment_winner("week_deal")
             var, deal = week_deal_for_user(uid or 0, winner=winner)
             try:
-                db.log_offer_event(uid or 0, "impression", "week_deal", var)
+                await analytics.log_offer_event(uid or 0, "impression", "week_deal", var)
             except Exception:
                 pass
-            db.add_bonus(uid, deal.get("add_text",0), deal.get("add_photo", deal.get("add_img",0)))
+            await db.aio.add_bonus(uid, deal.get("add_text",0), deal.get("add_photo", deal.get("add_img",0)))
         else:
             item = TOPUPS.get(key)
             if item:
-                db.add_bonus(uid, item.get("add_text",0), item.get("add_photo", item.get("add_img",0)))
+                await db.aio.add_bonus(uid, item.get("add_text",0), item.get("add_photo", item.get("add_img",0)))
 
     await update.message.reply_text(tr(lang,"paid_ok"), reply_markup=main_menu(lang, update.effective_user.id))
 
@@ -1092,6 +1546,24 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         await handle_study(update, context, text)
 
+async def _remember_file(file_key: str, file_id: str, text_key: str):
+    """Maps a Telegram file (by file_unique_id) to its vision text_cache entry."""
+    try:
+        await db.aio.set_image_cache(file_key, file_id, text_key)
+    except Exception:
+        logging.exception("image_cache write failed")
+
+
+async def refund_quota(uid: int, quota, kind: str):
+    """Returns the unit taken by db.consume_quota when no answer was delivered."""
+    if not quota:
+        return
+    try:
+        await db.aio.refund_quota(uid, kind, quota["day"])
+    except Exception:
+        logging.exception("quota refund failed")
+
+
 async def on_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Homework photo checking via DeepSeek vision model."""
     if await handle_admin_text(update, context):
@@ -1103,110 +1575,146 @@ async def on_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     mode = context.user_data.get("mode", "study")
+    usage_ledger.tag(uid, "photo_grade" if mode == "grade" else "photo_dz")
 
     # Photo (homework) counts against PHOTO quota (daily_img) to separate it from text.
     # When user hits the photo limit, show a dedicated photo top-up offer (higher conversion).
     # Also: first photo grading in ✅ mode can be granted once for free (marketing trigger).
     lang = get_lang(update, context)
+    # Smallest photo size that is still readable (documents are taken as-is);
+    # checked before any quota is charged.
+    source = pick_photo_size(update.message.photo) or update.message.document
+    if source is None:
+        await update.message.reply_text(tr(lang, "error_generic"))
+        return
+
     trial_free_grade_photo = False
+    plan_key = "free"
+    quota = None
     if not is_owner(uid):
-        plan, p, text_left, photo_left, usage = db.remaining_today(uid)
-        if photo_left <= 0:
-            if mode == "grade" and hasattr(db, "is_grade_photo_trial_used") and (not db.is_grade_photo_trial_used(uid)):
+        rc = await db.aio.load_request_context(uid)
+        plan_key = rc["plan"]
+        if rc["photo_left"] <= 0:
+            if mode == "grade" and not (rc["user"] or {}).get("grade_photo_trial_used"):
                 # One-time free photo grading (doesn't consume quota)
                 try:
-                    db.set_grade_photo_trial_used(uid)
+                    await db.aio.set_grade_photo_trial_used(uid)
                 except Exception:
                     pass
                 trial_free_grade_photo = True
             else:
                 await update.message.reply_text(tr(lang, "photo_limit_msg"), reply_markup=photo_offer_keyboard(lang))
                 return
-        else:
-            db.inc_usage(uid, "photo", 1)
+        elif upstream_available():
+            # While DeepSeek is down only cached answers are served, free of charge.
+            quota = await db.aio.consume_quota(uid, plan_key, "photo")
+            if quota is None:
+                await update.message.reply_text(tr(lang, "photo_limit_msg"), reply_markup=photo_offer_keyboard(lang))
+                return
 
     caption = (update.message.caption or "").strip()
     user_hint = clamp_text(caption) if caption else ""
 
-    # Download highest-res photo
-    photo = update.message.photo[-1]
-    file = await photo.get_file()
-    data = await file.download_as_bytearray()
-    img_bytes = bytes(data)
     if mode == "grade":
-        system = (
-            "You are StudyAI, a strict teacher and examiner. "
-            "First, identify the subject from the student's work and write it as: 'Предмет: ...' (or 'Subject: ...') on the first line. "
-            "Then grade the work. "
-            "Output format: "
-            "1) Балл: X/10 "
-            "2) Короткий вердикт (1-2 предложения) "
-            "3) Ошибки и почему это ошибки (если есть) "
-            "4) Как исправить (конкретные шаги) "
-            "5) 2-3 похожих задания для тренировки (придумай сам, без копирования экзамена) "
-            "Be fair and constructive. Language must match the user's language."
-        )
+        tpl = prompts.GRADE_PHOTO
         prompt_base = "Проверь и оцени решение/работу на фото."
     else:
-        system = (
-            "You are StudyAI, an expert tutor. "
-            "First, identify the subject (e.g., math/russian/physics) from the photo and write it as: 'Предмет: ...' on the first line. "
-            "This is study assistance (learning), not cheating. "
-            "If the request is vague, ask up to 2 clarifying questions; otherwise proceed. "
-            "Always structure the answer: "
-            "1) краткий план/стратегия "
-            "2) теория по теме "
-            "3) решение/объяснение по шагам "
-            "4) проверка и типичные ошибки "
-            "5) мини-тренировка (2-3 похожих задания) "
-            "Do NOT reproduce copyrighted exam texts verbatim; create original tasks. "
-            "Language must match the user's language."
-        )
+        tpl = prompts.VISION_STUDY
         prompt_base = "Проверь домашнее задание на фото."
+    system = tpl.text
     prompt = prompt_base
     if user_hint:
         prompt += f"\nПояснение пользователя: {user_hint}"
 
-    cache_key = make_cache_key("vision", f"lang={lang}", prompt, hashlib.sha256(img_bytes).hexdigest())
-    if ENABLE_TEXT_CACHE and not is_owner(uid):
-        row = db.get_text_cache(cache_key, ttl_days=TEXT_CACHE_TTL_DAYS)
-        if row and row.get("response"):
-            cached = row["response"]
-            subj = extract_subject(cached)
-            kind = "grade" if mode == "grade" else "vision"
-            try:
-                db.add_history(uid, kind, prompt, cached, subject=subj)
-            except Exception:
-                pass
-            await update.message.reply_text(cached, reply_markup=full_breakdown_keyboard())
+    cacheable = ENABLE_TEXT_CACHE and not is_owner(uid)
+
+    async def serve_cached(cached: str):
+        subj = extract_subject(cached)
+        kind = "grade" if mode == "grade" else "vision"
+        try:
+            await analytics.add_history(uid, kind, prompt, cached, subject=subj)
+        except Exception:
+            pass
+        await update.message.reply_text(cached, reply_markup=full_breakdown_keyboard())
+
+    # Forwarded/reposted photos keep Telegram's file_unique_id: answer them
+    # without downloading the file at all.
+    vparts = template_parts(tpl, [DEEPSEEK_VISION_MODEL])
+    file_key = make_cache_key("tgfile", f"lang={lang}", *vparts, prompt, source.file_unique_id)
+    if cacheable:
+        cached = await db.aio.get_image_cache_response(file_key, ttl_days=TEXT_CACHE_TTL_DAYS)
+        if cached:
+            await serve_cached(cached)
             return
 
-    try:
-        reply = generate_vision(prompt, img_bytes, system=system)
-    except Exception:
-        reply = tr(lang, "error_generic")
+    file = await source.get_file()
+    raw = await file.download_as_bytearray()
+
+    digest = hashlib.sha256(raw).hexdigest()
+    cache_key = make_cache_key("vision", f"lang={lang}", *vparts, prompt, digest)
+    fallback_keys = [make_cache_key("vision", f"lang={lang}", f"tpl={tag}", vparts[1], prompt, digest) for tag in tpl.key_tags()[1:]]
+    if CACHE_KEY_LEGACY_FALLBACK:
+        fallback_keys.append(make_cache_key("vision", f"lang={lang}", prompt, digest))
+    phash_scope = make_cache_key("vscope", f"lang={lang}", *vparts, prompt)
+    phash = None
+    if cacheable:
+        row = await cached_text(cache_key, fallback_keys, tpl)
+        if not row and VISION_PHASH_MAX_DISTANCE > 0:
+            # Same worksheet photographed by someone else: near-identical dHash.
+            phash = await image_prep.run_in_pool(dhash, raw)
+            near = phash_index.lookup(phash_scope, phash) if phash is not None else None
+            if near:
+                row = await text_cache.get(near[1], ttl_days=TEXT_CACHE_TTL_DAYS)
+                if not row:
+                    phash_index.discard(near[1])
+        if row and row.get("response"):
+            await _remember_file(file_key, source.file_id, row["key"])
+            await serve_cached(row["response"])
+            return
 
-    if ENABLE_TEXT_CACHE and not is_owner(uid) and reply and "⚠️" not in reply:
-        db.set_text_cache(cache_key, reply, model="vision")
+    async def produce():
+        try:
+            img_bytes, mime = await prepare_image(raw)
+            async with upstream_slot(update.message, lang, lane_for(uid, plan_key)):
+                reply = await generate_vision(prompt, img_bytes, mime=mime, system=system)
+        except QueueTimeout:
+            return tr(lang, "queue_busy"), False
+        except UpstreamUnavailable:
+            return tr(lang, "upstream_down"), False
+        except Exception:
+            return tr(lang, "error_generic"), False
+        ok = bool(reply) and "⚠️" not in reply
+        if ok and cacheable:
+            await text_cache.set(cache_key, reply, model="vision", tpl=tpl.tag, phash=to_signed(phash) if phash is not None else None, phash_scope=phash_scope if phash is not None else None)
+            if phash is not None:
+                phash_index.add(phash_scope, phash, cache_key)
+            await _remember_file(file_key, source.file_id, cache_key)
+        return reply, ok
+
+    # Same photo + caption + lang from several users at once -> one vision call.
+    (reply, ok), _ = await vision_flights.do(cache_key, produce)
+    if not ok:
+        await refund_quota(uid, quota, "photo")
 
     # Store for optional full breakdown (paid users)
     context.user_data["last_prompt"] = prompt
     context.user_data["last_mode"] = "grade" if mode == "grade" else "vision"
-    subj = extract_subject(reply)
-    kind = "grade" if mode == "grade" else "vision"
-    try:
-        db.add_history(uid, kind, prompt, reply, subject=subj)
-    except Exception:
-        pass
-    subj = extract_subject(reply)
-    try:
-        db.inc_activity(uid, "text_dz", subject=subj)
-    except Exception:
-        pass
-    try:
-        db.inc_activity(uid, "photo_grade" if mode == "grade" else "photo_dz", subject=subj)
-    except Exception:
-        pass
+    if ok:
+        # Error/busy replies stay out of the history and activity counters, as in the text handlers.
+        subj = extract_subject(reply)
+        kind = "grade" if mode == "grade" else "vision"
+        try:
+            await analytics.add_history(uid, kind, prompt, reply, subject=subj)
+        except Exception:
+            pass
+        try:
+            await analytics.inc_activity(uid, "text_dz", subject=subj)
+        except Exception:
+            pass
+        try:
+            await analytics.inc_activity(uid, "photo_grade" if mode == "grade" else "photo_dz", subject=subj)
+        except Exception:
+            pass
     await update.message.reply_text(reply, reply_markup=full_breakdown_keyboard())
 
     if trial_free_grade_photo:
@@ -1219,24 +1727,28 @@ async def on_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def handle_study(update: Update, context: ContextTypes.DEFAULT_TYPE, prompt: str):
     lang = get_lang(update, context)
     uid = update.effective_user.id
+    usage_ledger.tag(uid, "study")
     try:
-        db.inc_activity(uid, "text_dz")
+        await analytics.inc_activity(uid, "text_dz")
     except Exception:
         pass
 
     soft_paywall = False
     early_paywall = False
     plan_key = "free"
+    rc = None
+    quota = None
     max_tokens = MAX_TOKENS.get("free", 800)
-    model = DEEPSEEK_MODEL
+    models = routing.route_models("free")
 
     if not is_owner(uid):
-        plan_key, p, text_left, *_ = db.remaining_today(uid)
-        if text_left <= 0:
+        rc = await db.aio.load_request_context(uid)
+        plan_key = rc["plan"]
+        if rc["text_left"] <= 0:
             await update.message.reply_text(paywall_message_limit(), reply_markup=paywall_keyboard())
             return
-        u = db.get_usage(uid)
-        trig_winner = db.get_experiment_winner("paywall_trigger")
+        u = rc["usage"]
+        trig_winner = rc["winners"].get("paywall_trigger")
         _, paywall_trigger_count = paywall_trigger_count_for_user(uid, winner=trig_winner)
         # Early upsell after 2 free uses (only when trigger is 5)
 
@@ -1246,31 +1758,36 @@ async def handle_study(update: Update, context: ContextTypes.DEFAULT_TYPE, promp
         if plan_key == "free" and u.get("text_used", 0) == (paywall_trigger_count - 1):
             soft_paywall = True
 
-        db.inc_usage(uid, "text", 1)
+        if upstream_available():
+            quota = await db.aio.consume_quota(uid, plan_key, "text")
+            if quota is None:
+                await update.message.reply_text(paywall_message_limit(), reply_markup=paywall_keyboard())
+                return
 
-        max_tokens = MAX_TOKENS.get(plan_key, 900)
-        model = DEEPSEEK_MODEL_FREE if plan_key == "free" else DEEPSEEK_MODEL
+        max_tokens = plan_max_tokens(plan_key, 900)
+        models = routing.route_models(plan_key)
     else:
         max_tokens = MAX_TOKENS.get("ultra", 2200)
-        model = DEEPSEEK_MODEL
-
-    system = "You are StudyAI, a strict but friendly tutor. Do not reveal hidden chain-of-thought. Language must match the user's language."
+        models = routing.route_models("ultra")
 
     if plan_key == "free" and not is_owner(uid):
         # Two-level answers: concise first. Full breakdown is available via subscription.
-        system += " Provide a concise helpful answer (no long essays)."
+        tpl = prompts.STUDY_FREE
         max_tokens = min(max_tokens, 550)
     else:
-        system += " Answer clearly and step-by-step."
+        tpl = prompts.STUDY_PAID
+    system = tpl.text
 
     # Cache lookup (saves costs). Still counts towards limits.
-    cache_key = make_cache_key("text", f"mode=study", f"lang={lang}", prompt)
+    cache_key, fallback_keys = make_prompt_cache_keys("text", f"mode=study", f"lang={lang}", prompt=prompt, lang=lang, tpl=tpl, models=models)
+    near = None
     if ENABLE_TEXT_CACHE and not is_owner(uid):
-        row = db.get_text_cache(cache_key, ttl_days=TEXT_CACHE_TTL_DAYS)
+        near = await near_question("mode=study", f"lang={lang}", *template_parts(tpl, models), prompt=prompt, lang=lang)
+        row = await cached_text(cache_key, fallback_keys, tpl) or await cached_near_text(near)
         if row and row.get("response"):
             context.user_data['last_prompt'] = prompt
             context.user_data['last_mode'] = 'study'
-            db.add_history(uid, "text", prompt, row["response"])
+            await analytics.add_history(uid, "text", prompt, row["response"])
             await update.message.reply_text(row["response"], reply_markup=full_breakdown_keyboard())
             if early_paywall:
                 await update.message.reply_text(paywall_message_early(), reply_markup=paywall_keyboard())
@@ -1278,27 +1795,28 @@ async def handle_study(update: Update, context: ContextTypes.DEFAULT_TYPE, promp
                 await update.message.reply_text(paywall_message_soft(), reply_markup=paywall_keyboard())
             return
 
-    try:
-        reply = generate_text(prompt, system=system, max_tokens=max_tokens, model=model)
-    except Exception:
-        reply = tr(lang, "error_generic")
-
-    if ENABLE_TEXT_CACHE and not is_owner(uid) and reply and "⚠️" not in reply:
-        db.set_text_cache(cache_key, reply, model=model)
+    cacheable = ENABLE_TEXT_CACHE and not is_owner(uid)
+    reply, ok = await send_answer(update.message, lang, prompt, system=system, max_tokens=max_tokens, models=models, mode="study", lane=lane_for(uid, plan_key), reply_markup=full_breakdown_keyboard(), cache_key=cache_key if cacheable else None, near=near, tpl=tpl)
+    if not ok:
+        await refund_quota(uid, quota, "text")
 
     context.user_data['last_prompt'] = prompt
     context.user_data['last_mode'] = 'study'
 
     subj = extract_subject(reply)
+    if ok:
+        try:
+            await analytics.add_history(uid, "text", prompt, reply, subject=subj)
+        except Exception:
+            pass
     try:
-        db.inc_activity(uid, "text_dz", subject=subj)
+        await analytics.inc_activity(uid, "text_dz", subject=subj)
     except Exception:
         pass
     try:
-        db.inc_activity(uid, "photo_grade" if mode == "grade" else "photo_dz", subject=subj)
+        await analytics.inc_activity(uid, "photo_grade" if mode == "grade" else "photo_dz", subject=subj)
     except Exception:
         pass
-    await update.message.reply_text(reply, reply_markup=full_breakdown_keyboard())
 
     if early_paywall:
         await update.message.reply_text(paywall_message_early(), reply_markup=paywall_keyboard())
@@ -1306,10 +1824,10 @@ async def handle_study(update: Update, context: ContextTypes.DEFAULT_TYPE, promp
     if soft_paywall:
         await update.message.reply_text(paywall_message_soft(), reply_markup=paywall_keyboard())
 
-    await maybe_personal_offer(update, context, plan_key)
+    await maybe_personal_offer(update, context, plan_key, rc)
 
     # personalized offers (rare)
-    await maybe_personal_offer(update, context, plan_key)
+    await maybe_personal_offer(update, context, plan_key, rc)
 
 
 
@@ -1318,75 +1836,70 @@ async def handle_grade_text(update: Update, context: ContextTypes.DEFAULT_TYPE,
     """Teacher-style checking & scoring for text submissions."""
     lang = get_lang(update, context)
     uid = update.effective_user.id
+    usage_ledger.tag(uid, "grade")
     try:
-        db.inc_activity(uid, "text_grade")
+        await analytics.inc_activity(uid, "text_grade")
     except Exception:
         pass
 
     plan_key = "free"
+    rc = None
+    quota = None
     max_tokens = MAX_TOKENS.get("free", 800)
-    model = DEEPSEEK_MODEL
+    models = routing.route_models("free")
 
     if not is_owner(uid):
-        plan_key, p, text_left, *_ = db.remaining_today(uid)
-        if text_left <= 0:
+        rc = await db.aio.load_request_context(uid)
+        plan_key = rc["plan"]
+        if rc["text_left"] <= 0:
             await update.message.reply_text(paywall_message_limit(), reply_markup=paywall_keyboard())
             return
-        db.inc_usage(uid, "text", 1)
-        max_tokens = MAX_TOKENS.get(plan_key, 900)
-        model = DEEPSEEK_MODEL_FREE if plan_key == "free" else DEEPSEEK_MODEL
+        if upstream_available():
+            quota = await db.aio.consume_quota(uid, plan_key, "text")
+            if quota is None:
+                await update.message.reply_text(paywall_message_limit(), reply_markup=paywall_keyboard())
+                return
+        max_tokens = plan_max_tokens(plan_key, 900)
+        models = routing.route_models(plan_key)
     else:
         max_tokens = MAX_TOKENS.get("ultra", 2200)
-        model = DEEPSEEK_MODEL
-
-    system = (
-        "You are StudyAI, a strict teacher and examiner. "
-        "First, identify the subject from the student's text and write it as: 'Предмет: ...' (or 'Subject: ...') on the first line. "
-        "Then grade the work. "
-        "Output format: "
-        "1) Балл: X/10 "
-        "2) Короткий вердикт (1-2 предложения) "
-        "3) Ошибки и почему это ошибки (если есть) "
-        "4) Как исправить (конкретные шаги) "
-        "5) 2-3 похожих задания для тренировки (придумай сам) "
-        "Be fair and constructive. Language must match the user's language."
-    )
+        models = routing.route_models("ultra")
+
+    tpl = prompts.GRADE_TEXT
+    system = tpl.text
 
-    cache_key = make_cache_key("text", f"mode=grade", f"lang={lang}", prompt)
+    cache_key, fallback_keys = make_prompt_cache_keys("text", f"mode=grade", f"lang={lang}", prompt=prompt, lang=lang, tpl=tpl, models=models)
     if ENABLE_TEXT_CACHE and not is_owner(uid):
-        row = db.get_text_cache(cache_key, ttl_days=TEXT_CACHE_TTL_DAYS)
+        row = await cached_text(cache_key, fallback_keys, tpl)
         if row and row.get("response"):
             cached = row["response"]
             subj = extract_subject(cached)
             try:
-                db.add_history(uid, "grade", prompt, cached, subject=subj)
+                await analytics.add_history(uid, "grade", prompt, cached, subject=subj)
             except Exception:
                 pass
             await update.message.reply_text(cached, reply_markup=main_menu(lang, update.effective_user.id))
             return
 
-    try:
-        reply = generate_text(prompt, system=system, max_tokens=max_tokens, model=model)
-    except Exception:
-        reply = tr(lang, "error_generic")
-
-    if ENABLE_TEXT_CACHE and not is_owner(uid) and reply and "⚠️" not in reply:
-        db.set_text_cache(cache_key, reply, model=model or "text")
+    cacheable = ENABLE_TEXT_CACHE and not is_owner(uid)
+    reply, ok = await send_answer(update.message, lang, prompt, system=system, max_tokens=max_tokens, models=models, mode="grade", lane=lane_for(uid, plan_key), reply_markup=main_menu(lang, update.effective_user.id), cache_key=cache_key if cacheable else None, tpl=tpl)
+    if not ok:
+        await refund_quota(uid, quota, "text")
 
     context.user_data["last_prompt"] = prompt
     context.user_data["last_mode"] = "grade"
 
     subj = extract_subject(reply)
-    try:
-        db.add_history(uid, "grade", prompt, reply, subject=subj)
-    except Exception:
-        pass
+    if ok:
+        try:
+            await analytics.add_history(uid, "grade", prompt, reply, subject=subj)
+        except Exception:
+            pass
 
     try:
-        db.inc_activity(uid, "text_grade", subject=subj)
+        await analytics.inc_activity(uid, "text_grade", subject=subj)
     except Exception:
         pass
-    await update.message.reply_text(reply, reply_markup=main_menu(lang, update.effective_user.id))
 
 async def handle_ege(update: Update, context: ContextTypes.DEFAULT_TYPE, prompt: str):
     """
@@ -1395,11 +1908,12 @@ async def handle_ege(update: Update, context: ContextTypes.DEFAULT_TYPE, prompt:
     """
     lang = get_lang(update, context)
     uid = update.effective_user.id
+    usage_ledger.tag(uid, "ege")
     msg = update.effective_message  # works for both message and callback query
 
     # Analytics (best-effort)
     try:
-        db.inc_activity(uid, "ege", context.user_data.get("exam"), context.user_data.get("subject"))
+        await analytics.inc_activity(uid, "ege", context.user_data.get("exam"), context.user_data.get("subject"))
     except Exception:
         pass
 
@@ -1410,45 +1924,40 @@ async def handle_ege(update: Update, context: ContextTypes.DEFAULT_TYPE, prompt:
         prompt = f"Контекст: {exam_str}, предмет: {subject_label(subject)}.\nЗапрос: {prompt}"
 
     plan_key = "free"
+    rc = None
+    quota = None
     max_tokens = MAX_TOKENS.get("free", 900)
-    model = DEEPSEEK_MODEL
+    models = routing.route_models("free")
 
     # Paywall / limits (text quota)
     if not is_owner(uid):
-        plan_key, p, text_left, *_ = db.remaining_today(uid)
-        if text_left <= 0:
+        rc = await db.aio.load_request_context(uid)
+        plan_key = rc["plan"]
+        if rc["text_left"] <= 0:
             await msg.reply_text(paywall_message_limit(), reply_markup=paywall_keyboard())
             return
 
-        # Increment usage (1 text request)
-        try:
-            db.inc_usage(uid, "text", 1)
-        except Exception:
-            pass
+        # Take 1 text request; not charged while the upstream is down
+        if upstream_available():
+            quota = await db.aio.consume_quota(uid, plan_key, "text")
+            if quota is None:
+                await msg.reply_text(paywall_message_limit(), reply_markup=paywall_keyboard())
+                return
 
-        max_tokens = MAX_TOKENS.get(plan_key, 1200)
-        model = DEEPSEEK_MODEL_FREE if plan_key == "free" else DEEPSEEK_MODEL
+        max_tokens = plan_max_tokens(plan_key, 1200)
+        models = routing.route_models(plan_key)
     else:
         max_tokens = MAX_TOKENS.get("ultra", 2200)
-        model = DEEPSEEK_MODEL
-
-    system = (
-        "You are StudyAI, an expert tutor. First, identify the subject (e.g., math/russian/physics) from the photo and write it as: 'Предмет: ...' on the first line. "
-        "This is study assistance (learning), not cheating. "
-        "If the request is vague, ask up to 2 clarifying questions; otherwise proceed. "
-        "Always structure the answer:\n"
-        "1) краткий план/стратегия\n"
-        "2) теория по теме\n"
-        "3) решение/объяснение по шагам\n"
-        "4) проверка и типичные ошибки\n"
-        "5) мини-тренировка (2-3 похожих задания)\n"
-        "Do NOT reproduce copyrighted exam texts verbatim; create original tasks. "
-        "Language must match the user's language."
-    )
+        models = routing.route_models("ultra")
 
-    cache_key = make_cache_key("text", "mode=ege", f"lang={lang}", str(exam or ""), str(subject or ""), prompt)
+    tpl = prompts.EGE
+    system = tpl.text
+
+    cache_key, fallback_keys = make_prompt_cache_keys("text", "mode=ege", f"lang={lang}", str(exam or ""), str(subject or ""), prompt=prompt, lang=lang, tpl=tpl, models=models)
+    near = None
     if ENABLE_TEXT_CACHE and not is_owner(uid):
-        row = db.get_text_cache(cache_key, ttl_days=TEXT_CACHE_TTL_DAYS)
+        near = await near_question("mode=ege", f"lang={lang}", str(exam or ""), str(subject or ""), *template_parts(tpl, models), prompt=prompt, lang=lang)
+        row = await cached_text(cache_key, fallback_keys, tpl) or await cached_near_text(near)
         if row and row.get("response"):
             await update.effective_message.reply_text(row["response"])
             if early_paywall:
@@ -1457,31 +1966,165 @@ async def handle_ege(update: Update, context: ContextTypes.DEFAULT_TYPE, prompt:
                 await update.message.reply_text(paywall_message_soft(), reply_markup=paywall_keyboard())
             return
 
+    cacheable = ENABLE_TEXT_CACHE and not is_owner(uid)
+    reply, ok = await send_answer(update.effective_message, lang, prompt, system=system, max_tokens=max_tokens, models=models, mode="ege", lane=lane_for(uid, plan_key), cache_key=cache_key if cacheable else None, near=near, tpl=tpl)
+    if not ok:
+        await refund_quota(uid, quota, "text")
+    if ok:
+        try:
+            await analytics.add_history(uid, "ege", prompt, reply, subject=extract_subject(reply))
+        except Exception:
+            pass
+    if soft_paywall:
+        await update.message.reply_text(paywall_message_soft(), reply_markup=paywall_keyboard())
+
+    # personalized offers (rare)
+    await maybe_personal_offer(update, context, plan_key, rc)
+
+
+async def run_cache_maintenance():
+    """Background loop: flushes buffered cache hits, compacts text_cache and keeps
+    the in-memory indexes in step with the text_cache TTL."""
+    last_compact = time.monotonic()
+    last_aging = time.monotonic()
+    while True:
+        await asyncio.sleep(TEXT_CACHE_HIT_FLUSH_SEC)
+        try:
+            await text_cache.flush_hits()
+        except Exception:
+            logging.exception("text cache hit flush failed")
+        try:
+            await text_cache.refresh_filter()
+        except Exception:
+            logging.exception("text cache bloom filter refresh failed")
+        if time.monotonic() - last_compact < TEXT_CACHE_COMPACT_SEC:
+            continue
+        last_compact = time.monotonic()
+        age_hits = time.monotonic() - last_aging >= TEXT_CACHE_AGING_HOURS * 3600
+        try:
+            deleted = await db.run(
+                db.compact_text_cache, TEXT_CACHE_TTL_DAYS + max(TEXT_CACHE_STALE_DAYS, 0), TEXT_CACHE_MAX_ROWS, TEXT_CACHE_MAX_BYTES, age_hits
+            )
+            if age_hits:
+                last_aging = time.monotonic()
+            if deleted:
+                logging.info("text_cache compaction: %s rows deleted", deleted)
+            if age_hits:
+                # Deleted keys linger in the Bloom filter; rebuild it with the daily aging pass.
+                await text_cache.rebuild_filter()
+            question_index.prune(TEXT_CACHE_TTL_DAYS)
+            freed = await db.aio.gc_responses()
+            if freed:
+                logging.info("responses gc: %s unreferenced answers deleted", freed)
+        except Exception:
+            logging.exception("text cache compaction failed")
+
+
+# Set on shutdown so the backfill stops between batches instead of holding up db.shutdown().
+_backfill_stop = threading.Event()
+
+
+async def run_response_backfill():
+    """One-off background migration of inline answers into the shared store (no-op once done)."""
     try:
-        reply = generate_text(prompt, system=system, max_tokens=max_tokens, model=model)
+        moved = await db.aio.backfill_response_store(stop=_backfill_stop)
+        if moved:
+            logging.info("compressed %s stored answers", moved)
     except Exception:
-        reply = tr(lang, "error_generic")
+        logging.exception("response compression backfill failed")
 
-    if ENABLE_TEXT_CACHE and not is_owner(uid) and reply and "⚠️" not in reply:
-        db.set_text_cache(cache_key, reply, model=model)
 
-    await update.effective_message.reply_text(reply)
-    if soft_paywall:
-        await update.message.reply_text(paywall_message_soft(), reply_markup=paywall_keyboard())
+async def run_partition_maintenance():
+    """Background loop (daily): creates upcoming monthly partitions of user_history /
+    offer_events and removes the ones past retention."""
+    while True:
+        try:
+            created = await db.aio.ensure_partitions(PARTITION_MONTHS_AHEAD)
+            if created:
+                logging.info("partitions created: %s", ", ".join(created))
+            for table, keep in (("user_history", HISTORY_RETENTION_MONTHS), ("offer_events", OFFER_EVENTS_RETENTION_MONTHS)):
+                removed = await db.aio.apply_retention(table, keep, PARTITION_RETENTION_MODE)
+                if removed:
+                    logging.info("partitions %s (retention): %s", PARTITION_RETENTION_MODE, ", ".join(removed))
+        except Exception:
+            logging.exception("partition maintenance failed")
+        await asyncio.sleep(24 * 3600)
+
+
+async def on_startup(app: Application):
+    app.bot_data["usage_flusher"] = asyncio.create_task(usage_ledger.run_flusher())
+    app.bot_data["analytics_flusher"] = asyncio.create_task(analytics.run_flusher())
+    app.bot_data["partition_maintenance"] = asyncio.create_task(run_partition_maintenance())
+    try:
+        prompts.load_migrations(await db.aio.list_cache_migrations())
+    except Exception:
+        logging.exception("cache migrations load failed")
+    if ENABLE_TEXT_CACHE and VISION_PHASH_MAX_DISTANCE > 0:
+        try:
+            rows = await db.aio.load_vision_phashes(TEXT_CACHE_TTL_DAYS, phash_index.max_entries)
+            logging.info("vision phash index: %s entries", phash_index.load(rows))
+        except Exception:
+            logging.exception("vision phash index load failed")
+    if ENABLE_TEXT_CACHE and ENABLE_NEAR_DUP_CACHE:
+        try:
+            rows = await db.aio.load_text_minhashes(TEXT_CACHE_TTL_DAYS, question_index.max_entries)
+            logging.info("near-duplicate question index: %s entries", question_index.load(rows))
+        except Exception:
+            logging.exception("near-duplicate question index load failed")
+    app.bot_data["cache_maintenance"] = asyncio.create_task(run_cache_maintenance())
+    app.bot_data["response_backfill"] = asyncio.create_task(run_response_backfill())
+    if ENABLE_TEXT_CACHE:
+        try:
+            logging.info("text cache bloom filter: %s", await text_cache.rebuild_filter())
+        except Exception:
+            logging.exception("text cache bloom filter build failed")
+    if ENABLE_TEXT_CACHE and TEXT_CACHE_WARM_TOP_N > 0:
+        try:
+            rows = await db.aio.top_text_cache(TEXT_CACHE_WARM_TOP_N, TEXT_CACHE_TTL_DAYS)
+            logging.info("text cache L1 warmed: %s entries", text_cache.warm(rows))
+        except Exception:
+            logging.exception("text cache warmup failed")
 
-    # personalized offers (rare)
-    await maybe_personal_offer(update, context, plan_key)
+
+async def on_shutdown(app: Application):
+    _backfill_stop.set()
+    for name in ("usage_flusher", "cache_maintenance", "response_backfill", "partition_maintenance"):
+        task = app.bot_data.pop(name, None)
+        if task:
+            task.cancel()
+    try:
+        await usage_ledger.flush()
+    except Exception:
+        logging.exception("final usage ledger flush failed")
+    try:
+        await text_cache.flush_hits()
+    except Exception:
+        logging.exception("final text cache hit flush failed")
+    try:
+        await analytics.close(app.bot_data.pop("analytics_flusher", None))
+    except Exception:
+        logging.exception("final analytics flush failed")
+    await close_client()
+    await asyncio.to_thread(db.shutdown)  # waits for in-flight queries, then closes the pool
 
 
 def main():
     if not TELEGRAM_BOT_TOKEN:
         raise RuntimeError("TELEGRAM_BOT_TOKEN is not set")
     db.init_db()
-    app = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    app = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .concurrent_updates(BOT_CONCURRENT_UPDATES)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("payout", payout_cmd))
     app.add_handler(CommandHandler("payouts", payouts_cmd))
     app.add_handler(CommandHandler("revenue", revenue_cmd))
+    app.add_handler(CommandHandler("cache", cache_cmd))
     app.add_handler(CommandHandler("skip", skip_cmd))
     app.add_handler(CallbackQueryHandler(on_button))
     app.add_handler(PreCheckoutQueryHandler(precheckout))
@@ -0,0 +1,49 @@
+import hashlib
+import math
+
+
+class BloomFilter:
+    """Fixed-size Bloom filter over string keys (double hashing of one blake2b digest).
+
+    No deletes: removed keys only cost a false positive until the next rebuild.
+    """
+
+    __slots__ = ("capacity", "fp_rate", "m", "k", "count", "_bits")
+
+    def __init__(self, capacity: int, fp_rate: float):
+        self.capacity = max(int(capacity), 1)
+        self.fp_rate = fp_rate
+        self.m = max(int(math.ceil(-self.capacity * math.log(fp_rate) / (math.log(2) ** 2))), 8)
+        self.k = max(int(round(self.m / self.capacity * math.log(2))), 1)
+        self.count = 0
+        self._bits = bytearray((self.m + 7) // 8)
+
+    def _positions(self, key: str):
+        d = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(d[:8], "little")
+        h2 = int.from_bytes(d[8:], "little") | 1
+        for i in range(self.k):
+            yield (h1 + i * h2) % self.m
+
+    def add(self, key: str) -> None:
+        bits = self._bits
+        for pos in self._positions(key):
+            bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, key: str) -> bool:
+        bits = self._bits
+        return all(bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+    def estimated_fp_rate(self) -> float:
+        return (1 - math.exp(-self.k * self.count / self.m)) ** self.k
+
+    def stats(self) -> dict:
+        return {
+            "count": self.count,
+            "capacity": self.capacity,
+            "bytes": len(self._bits),
+            "k": self.k,
+            "target_fp": self.fp_rate,
+            "estimated_fp": self.estimated_fp_rate(),
+        }
@@ -0,0 +1,184 @@
+import hashlib
+import re
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Tuple
+
+from cache.normalize import normalize_prompt
+from config import NEAR_DUP_PERMUTATIONS, NEAR_DUP_BANDS, NEAR_DUP_THRESHOLD, NEAR_DUP_MAX_ENTRIES
+
+# Request phrasing that does not change the answer ("помогите решить ... пожалуйста").
+_FILLER = frozenset("""
+помогите помоги помогать пожалуйста пожалуйсто плиз пж пжл срочно надо нужно можно мне нам
+реши решить решите решение решения найди найти найдите вычисли вычислить посчитай посчитать
+объясни объяснить объясните подскажите подскажи как что это такое такой в на и с по к у о
+уравнение уравнения пример примеры задача задачу задание
+please pls help me solve find calculate compute explain the a an to of for with how what is
+equation example task
+""".split())
+
+_OPS = re.compile(r"\s*([+\-*/=^<>()×÷√%])\s*")
+_MATH_TOKEN = re.compile(r"\d|[+\-*/=^<>×÷√%]")
+_LETTERS = re.compile(r"[^\W\d_]+")
+
+_PRIME = (1 << 61) - 1
+_EMPTY = _PRIME  # min over an empty shingle set
+
+
+def split_prompt(prompt: str, lang: str) -> Tuple[str, list]:
+    """(math fingerprint, content words). The fingerprint (numbers, formulas)
+    must match exactly: "2x+3=7" and "2x+3=8" are different questions."""
+    text = _OPS.sub(r"\1", normalize_prompt(prompt, lang))
+    math, words = [], []
+    for tok in text.split():
+        if _MATH_TOKEN.search(tok):
+            math.append(tok.strip(".,;:?"))  # "!" stays: 5! is not 5
+        else:
+            words.extend(w for w in _LETTERS.findall(tok) if len(w) > 1 and w not in _FILLER)
+    return " ".join(math), words
+
+
+def _shingles(words: list) -> set:
+    # Word stems catch inflection ("уравнение"/"уравнения"), char 3-grams catch typos.
+    out = {"w:" + w[:5] for w in words}
+    joined = " ".join(words)
+    out.update("c:" + joined[i:i + 3] for i in range(max(len(joined) - 2, 0)))
+    return out
+
+
+class MinHasher:
+    def __init__(self, num_perm: int, seed: int = 1):
+        self.num_perm = num_perm
+        params = hashlib.blake2b(f"minhash:{seed}".encode(), digest_size=64).digest()
+        rnd = int.from_bytes(params, "big")
+        self._a, self._b = [], []
+        for i in range(num_perm):
+            h = hashlib.blake2b(rnd.to_bytes(64, "big") + i.to_bytes(4, "big"), digest_size=16).digest()
+            self._a.append(int.from_bytes(h[:8], "big") % (_PRIME - 1) + 1)
+            self._b.append(int.from_bytes(h[8:], "big") % _PRIME)
+
+    def signature(self, shingles: Iterable[str]) -> array:
+        sig = array("Q", [_EMPTY] * self.num_perm)
+        for s in shingles:
+            x = int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "big")
+            for i in range(self.num_perm):
+                v = (self._a[i] * x + self._b[i]) % _PRIME
+                if v < sig[i]:
+                    sig[i] = v
+        return sig
+
+
+def similarity(a: array, b: array) -> float:
+    """Estimated Jaccard similarity of the underlying shingle sets."""
+    return sum(x == y for x, y in zip(a, b)) / len(a)
+
+
+class LshIndex:
+    """Banded LSH over MinHash signatures of cached prompts, partitioned by scope
+    (mode + lang + exam/subject + math fingerprint).
+
+    Backed by text_cache.minhash / lsh_scope. Bounded by NEAR_DUP_MAX_ENTRIES
+    (oldest dropped first); entries past the text_cache TTL are skipped and pruned.
+    """
+
+    def __init__(self, num_perm: int, bands: int, threshold: float, max_entries: int):
+        self.hasher = MinHasher(num_perm)
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Tuple[str, array, float]]" = OrderedDict()  # key -> (scope, sig, created_ts)
+        self._buckets: Dict[int, set] = {}
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.hits = 0
+
+    def signature(self, words: list) -> array:
+        return self.hasher.signature(_shingles(words))
+
+    def _bands(self, scope: str, sig: array):
+        r = self.rows
+        for b in range(self.bands):
+            yield hash((scope, b, sig[b * r:(b + 1) * r].tobytes()))
+
+    def _insert(self, key: str, scope: str, sig: array) -> None:
+        for bucket in self._bands(scope, sig):
+            self._buckets.setdefault(bucket, set()).add(key)
+
+    def _remove(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for bucket in self._bands(entry[0], entry[1]):
+            keys = self._buckets.get(bucket)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._buckets[bucket]
+
+    def add(self, scope: str, sig: array, key: str, created_ts: Optional[float] = None) -> None:
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (scope, sig, created_ts or time.time())
+            self._insert(key, scope, sig)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def load(self, rows: Iterable[Tuple[str, str, bytes, float]]) -> int:
+        """rows: (key, scope, signature bytes, age_sec), oldest first."""
+        now = time.time()
+        for key, scope, raw, age_sec in rows:
+            sig = array("Q")
+            sig.frombytes(bytes(raw))
+            if len(sig) == self.hasher.num_perm:
+                self.add(scope, sig, key, created_ts=now - float(age_sec or 0))
+        return len(self._entries)
+
+    def discard(self, key: str) -> None:
+        with self._lock:
+            self._remove(key)
+
+    def prune(self, ttl_days: int) -> int:
+        """Drops entries older than the text_cache TTL. Entries are in insertion order."""
+        cutoff = time.time() - ttl_days * 86400
+        dropped = 0
+        with self._lock:
+            for key in [k for k, (_, _, ts) in self._entries.items() if ts < cutoff]:
+                self._remove(key)
+                dropped += 1
+        return dropped
+
+    def lookup(self, scope: str, sig: array, ttl_days: int) -> Optional[Tuple[float, str]]:
+        """(similarity, key) of the best cached prompt above threshold, or None."""
+        cutoff = time.time() - ttl_days * 86400
+        with self._lock:
+            self.lookups += 1
+            candidates = set()
+            for bucket in self._bands(scope, sig):
+                candidates |= self._buckets.get(bucket, set())
+            best = None
+            for key in candidates:
+                entry = self._entries.get(key)
+                if entry is None or entry[0] != scope or entry[2] < cutoff:
+                    continue
+                sim = similarity(sig, entry[1])
+                if sim >= self.threshold and (best is None or sim > best[0]):
+                    best = (sim, key)
+            if best:
+                self.hits += 1
+            return best
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "buckets": len(self._buckets),
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "hit_rate": (self.hits / self.lookups) if self.lookups else 0.0,
+            "threshold": self.threshold,
+        }
+
+
+question_index = LshIndex(NEAR_DUP_PERMUTATIONS, NEAR_DUP_BANDS, NEAR_DUP_THRESHOLD, NEAR_DUP_MAX_ENTRIES)
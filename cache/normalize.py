@@ -0,0 +1,65 @@
+import re
+import unicodedata
+
+# Bump when normalize_prompt changes: keys of different versions never collide.
+KEY_VERSION = "v4"
+
+# Latin letters that render like Cyrillic ones (after casefold). Applied only to
+# words that already contain Cyrillic, so English text is left alone.
+_LATIN_TO_CYRILLIC = str.maketrans({
+    "a": "а", "b": "в", "c": "с", "e": "е", "h": "н", "k": "к", "m": "м",
+    "o": "о", "p": "р", "t": "т", "x": "х", "y": "у",
+})
+_CYRILLIC = re.compile(r"[а-яё]")
+_WORD = re.compile(r"\w+")
+
+_SPACE = re.compile(r"\s+")
+# Only typographic group separators (no-break / narrow no-break space, as inserted by
+# keyboards and number formatting) are unambiguous: "12 345" or "1,2" may be two numbers.
+# Must run before NFKC, which turns them into plain spaces.
+_DIGIT_GROUPS = re.compile(r"(?<=\d)[\u00a0\u202f](?=\d{3}\b)")  # 1\u00a0000\u00a0000 -> 1000000
+_TRAILING = re.compile(r"[\s.,;:!?…]+$")
+# A trailing "!" right after a number, ")" or a one-letter variable is a factorial: 5!, (n+1)!, n!
+_FACTORIAL_BASE = re.compile(r"(?:\d|\)|(?<!\w)[^\W\d_])$")
+
+
+def _is_symbol(ch: str) -> bool:
+    # Emoji, pictographs, skin-tone modifiers, variation selectors and joiners;
+    # ASCII modifier symbols such as ^ and ` are kept (math).
+    cat = unicodedata.category(ch)
+    return cat in ("So", "Cs", "Co") or (cat == "Sk" and ord(ch) > 0xFFFF) or ch in "\u200d\ufe0e\ufe0f"
+
+
+def _fix_homoglyphs(match: re.Match) -> str:
+    word = match.group(0)
+    return word.translate(_LATIN_TO_CYRILLIC) if _CYRILLIC.search(word) else word
+
+
+def _strip_trailing(text: str) -> str:
+    m = _TRAILING.search(text)
+    if m is None:
+        return text
+    head = text[:m.start()]
+    bangs = m.group()[:len(m.group()) - len(m.group().lstrip("!"))]
+    if bangs and _FACTORIAL_BASE.search(head):
+        head += bangs
+    return head
+
+
+def normalize_prompt(text: str, lang: str = "ru") -> str:
+    """Deterministic canonical form of a user prompt for cache keys.
+
+    NFKC + casefold, emoji dropped, Latin look-alikes inside Cyrillic words
+    mapped to Cyrillic, no-break digit-group separators removed, whitespace
+    collapsed and trailing punctuation removed. Math operators (a trailing
+    factorial "!" included), commas and spaces between numbers are kept:
+    they can change the question.
+    """
+    text = _DIGIT_GROUPS.sub("", text or "")
+    text = unicodedata.normalize("NFKC", text).casefold()
+    text = "".join(ch for ch in text if not _is_symbol(ch))
+    if lang == "ru" or _CYRILLIC.search(text):
+        text = text.replace("ё", "е")
+        text = _WORD.sub(_fix_homoglyphs, text)
+    text = _SPACE.sub(" ", text).strip()
+    return _strip_trailing(text)
@@ -0,0 +1,206 @@
+import io
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Tuple
+
+try:
+    from PIL import Image
+except Exception:  # pragma: no cover
+    Image = None  # type: ignore
+
+from config import VISION_PHASH_MAX_DISTANCE, VISION_PHASH_MAX_ENTRIES
+
+
+def dhash(raw) -> Optional[int]:
+    """64-bit difference hash: 9x8 grayscale thumbnail, one bit per horizontal gradient.
+
+    Robust to rescaling, recompression and small lighting changes, which is what
+    differs between classmates' photos of the same worksheet page. Blocking.
+    """
+    if Image is None:
+        return None
+    try:
+        with Image.open(io.BytesIO(raw)) as im:
+            px = list(im.convert("L").resize((9, 8), Image.LANCZOS).getdata())
+    except Exception:
+        return None
+    h = 0
+    for row in range(8):
+        for col in range(8):
+            h = (h << 1) | (px[row * 9 + col] > px[row * 9 + col + 1])
+    return h
+
+
+def to_signed(h: int) -> int:
+    """Postgres BIGINT is signed."""
+    return h - (1 << 64) if h >= (1 << 63) else h
+
+
+def to_unsigned(h: int) -> int:
+    return h + (1 << 64) if h < 0 else h
+
+
+def _distance(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+class BKTree:
+    """Burkhard-Keller tree over Hamming distance: radius search visits only
+    children whose edge distance is within [d - r, d + r].
+
+    Removal leaves a tombstone (key None) so the tree shape stays valid; `dead`
+    counts them so the owner can rebuild once they dominate."""
+
+    __slots__ = ("root", "size", "dead")
+
+    def __init__(self):
+        self.root: Optional[list] = None  # [hash, key, {distance: child}]
+        self.size = 0  # nodes, tombstones included
+        self.dead = 0
+
+    def add(self, h: int, key: str) -> None:
+        if self.root is None:
+            self.root = [h, key, {}]
+            self.size = 1
+            return
+        node = self.root
+        while True:
+            d = _distance(h, node[0])
+            if d == 0:
+                if node[1] is None:
+                    self.dead -= 1
+                node[1] = key  # same picture, newer entry wins
+                return
+            child = node[2].get(d)
+            if child is None:
+                node[2][d] = [h, key, {}]
+                self.size += 1
+                return
+            node = child
+
+    def remove(self, h: int, key: str) -> bool:
+        """Tombstones the node for h if it still maps to key."""
+        node = self.root
+        while node is not None:
+            d = _distance(h, node[0])
+            if d == 0:
+                if node[1] != key:
+                    return False
+                node[1] = None
+                self.dead += 1
+                return True
+            node = node[2].get(d)
+        return False
+
+    def items(self) -> Iterable[Tuple[int, str]]:
+        """Live (hash, key) pairs."""
+        stack = [self.root] if self.root else []
+        while stack:
+            node = stack.pop()
+            if node[1] is not None:
+                yield node[0], node[1]
+            stack.extend(node[2].values())
+
+    def nearest(self, h: int, radius: int) -> Optional[Tuple[int, str]]:
+        """(distance, key) of the closest entry within radius, or None."""
+        best: Optional[Tuple[int, str]] = None
+        stack = [self.root] if self.root else []
+        while stack:
+            node = stack.pop()
+            d = _distance(h, node[0])
+            if node[1] is not None and d <= radius and (best is None or d < best[0]):
+                best = (d, node[1])
+                if d == 0:
+                    break
+            r = best[0] if best else radius
+            for edge, child in node[2].items():
+                if d - r <= edge <= d + r:
+                    stack.append(child)
+        return best
+
+
+class PhashIndex:
+    """In-memory near-duplicate index for vision cache entries, one BK-tree per scope
+    (scope = lang + mode + caption, so only identical requests match).
+
+    Backed by text_cache.phash / phash_scope; past VISION_PHASH_MAX_ENTRIES the
+    oldest entries are forgotten one by one.
+    """
+
+    def __init__(self, max_distance: int, max_entries: int):
+        self.max_distance = max_distance
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Tuple[str, int]]" = OrderedDict()  # key -> (scope, hash)
+        self._trees: Dict[str, BKTree] = {}
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.hits = 0
+
+    def _rebuild(self) -> None:
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        self._trees = {}
+        for key, (scope, h) in self._entries.items():
+            self._trees.setdefault(scope, BKTree()).add(h, key)
+
+    def load(self, rows: Iterable[Tuple[str, str, int]]) -> int:
+        """rows: (key, scope, signed phash), oldest first."""
+        with self._lock:
+            self._entries.clear()
+            for key, scope, h in rows:
+                self._entries[key] = (scope, to_unsigned(int(h)))
+            self._rebuild()
+            return len(self._entries)
+
+    def _forget(self, key: str) -> None:
+        """Drops key from its scope's tree; that tree alone is rebuilt once mostly tombstones."""
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        scope, h = entry
+        tree = self._trees.get(scope)
+        if tree is None or not tree.remove(h, key):
+            return
+        if tree.dead == tree.size:
+            del self._trees[scope]
+        elif tree.dead * 2 > tree.size:
+            fresh = BKTree()
+            for th, tkey in list(tree.items()):
+                fresh.add(th, tkey)
+            self._trees[scope] = fresh
+
+    def add(self, scope: str, h: int, key: str) -> None:
+        with self._lock:
+            if self._entries.get(key, (scope, h)) != (scope, h):
+                self._forget(key)  # same key, different photo/scope
+            self._entries[key] = (scope, h)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._forget(next(iter(self._entries)))  # oldest first, like discard
+            self._trees.setdefault(scope, BKTree()).add(h, key)
+
+    def discard(self, key: str) -> None:
+        """Forget an entry (expired or evicted from text_cache). Touches only its scope."""
+        with self._lock:
+            self._forget(key)
+
+    def lookup(self, scope: str, h: int) -> Optional[Tuple[int, str]]:
+        with self._lock:
+            self.lookups += 1
+            tree = self._trees.get(scope)
+            found = tree.nearest(h, self.max_distance) if tree else None
+            if found:
+                self.hits += 1
+            return found
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "hit_rate": (self.hits / self.lookups) if self.lookups else 0.0,
+            "max_distance": self.max_distance,
+        }
+
+
+phash_index = PhashIndex(VISION_PHASH_MAX_DISTANCE, VISION_PHASH_MAX_ENTRIES)
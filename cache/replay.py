@@ -0,0 +1,74 @@
+"""Offline replay of recorded prompts: cache hit rate with raw vs normalized keys.
+
+    python -m cache.replay prompts.jsonl        # {"prompt": ..., "kind": ..., "lang": ...} or plain lines
+    python -m cache.replay --db --days 30       # user_history (text/grade/ege)
+
+Simulates an unbounded cache: a request hits if an earlier one produced the same key.
+"""
+import argparse
+import json
+import sys
+from collections import Counter
+
+from cache.normalize import normalize_prompt
+from i18n import detect_lang
+
+
+def _read_file(path):
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if not line.strip():
+                continue
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                rec = None
+            if isinstance(rec, dict) and rec.get("prompt"):
+                yield rec.get("kind") or "text", rec.get("lang"), rec["prompt"]
+            else:
+                yield "text", None, line
+
+
+def _read_db(days):
+    import db
+    for row in db.recent_history_prompts(days, ("text", "grade", "ege")):
+        yield row["kind"], None, row["prompt"]
+
+
+def replay(records):
+    seen_raw, seen_norm = set(), set()
+    total = Counter()
+    for kind, lang, prompt in records:
+        lang = lang or detect_lang(None, prompt)
+        raw = (kind, lang, prompt.strip())
+        norm = (kind, lang, normalize_prompt(prompt, lang))
+        total["requests"] += 1
+        total["raw_hits"] += raw in seen_raw
+        total["norm_hits"] += norm in seen_norm
+        seen_raw.add(raw)
+        seen_norm.add(norm)
+    total["raw_keys"], total["norm_keys"] = len(seen_raw), len(seen_norm)
+    return total
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("path", nargs="?", help="prompts file (jsonl or one prompt per line)")
+    ap.add_argument("--db", action="store_true", help="read user_history instead of a file")
+    ap.add_argument("--days", type=int, default=30)
+    args = ap.parse_args(argv)
+    if not args.db and not args.path:
+        ap.error("give a prompts file or --db")
+
+    t = replay(_read_db(args.days) if args.db else _read_file(args.path))
+    n = t["requests"] or 1
+    print(f"requests:        {t['requests']}")
+    print(f"raw keys:        {t['raw_keys']}  hit rate {100 * t['raw_hits'] / n:.1f}%")
+    print(f"normalized keys: {t['norm_keys']}  hit rate {100 * t['norm_hits'] / n:.1f}%")
+    print(f"gain:            {100 * (t['norm_hits'] - t['raw_hits']) / n:+.1f} pp")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,220 @@
+import datetime as dt
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Tuple
+
+import db
+from cache.bloom import BloomFilter
+from config import TEXT_CACHE_L1_MAX_ENTRIES, TEXT_CACHE_L1_MAX_BYTES, TEXT_CACHE_BLOOM_CAPACITY, TEXT_CACHE_BLOOM_FP
+
+
+class TieredTextCache:
+    """In-process LRU (L1) in front of the Postgres text_cache table (L2).
+
+    Read-through and write-through; bounded by entry count and response bytes.
+    Entries keep their DB creation time so TEXT_CACHE_TTL_DAYS is honoured
+    exactly as the SQL lookup does. Hits on either tier are counted in memory
+    and written to text_cache.hits/last_hit in batches (flush_hits).
+
+    A Bloom filter of all text_cache keys (built by rebuild_filter) answers
+    definite misses without a DB round trip. Keys written by other replicas are
+    picked up by refresh_filter, so they look absent for one refresh interval at most.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lru: "OrderedDict[str, dict]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.l1_hits = 0
+        self.l2_hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.filtered_misses = 0
+        self._bloom: Optional[BloomFilter] = None  # None until the startup scan completes
+        self._building: Optional[BloomFilter] = None
+        self._synced = 0.0  # monotonic time the filter is complete up to
+        self._hits: Dict[str, Tuple[int, int, dt.datetime]] = {}  # key -> (hits, stale hits, last hit) not yet in the DB
+
+    # ---- L1 ----
+
+    def _put(self, row: dict) -> None:
+        if self.max_entries <= 0:
+            return
+        size = len(row["response"].encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._lru.pop(row["key"], None)
+            if old is not None:
+                self._bytes -= old["size"]
+            self._lru[row["key"]] = {**row, "size": size}
+            self._bytes += size
+            while self._lru and (len(self._lru) > self.max_entries or self._bytes > self.max_bytes):
+                _, ev = self._lru.popitem(last=False)
+                self._bytes -= ev["size"]
+
+    def _get_l1(self, key: str, ttl_days: int) -> Optional[dict]:
+        with self._lock:
+            row = self._lru.get(key)
+            if row is None:
+                return None
+            if time.time() - row["created_ts"] >= ttl_days * 86400:
+                self._lru.pop(key)
+                self._bytes -= row["size"]
+                return None
+            self._lru.move_to_end(key)
+            return row
+
+    def discard(self, key: str) -> None:
+        with self._lock:
+            row = self._lru.pop(key, None)
+            if row is not None:
+                self._bytes -= row["size"]
+
+    def discard_where(self, pred) -> int:
+        """Drops L1 entries matching pred(row) (e.g. an invalidated prompt template)."""
+        with self._lock:
+            keys = [k for k, row in self._lru.items() if pred(row)]
+            for k in keys:
+                self._bytes -= self._lru.pop(k)["size"]
+        return len(keys)
+
+    @staticmethod
+    def _from_db(row: dict) -> dict:
+        return {
+            "key": row["key"],
+            "response": row["response"],
+            "model": row.get("model"),
+            "tpl": row.get("tpl"),
+            "created_ts": time.time() - float(row.get("age_sec") or 0),
+        }
+
+    # ---- public ----
+
+    async def get(self, key: str, ttl_days: int = 60) -> Optional[dict]:
+        """Row dict ({key, response, model, ...}) or None. Hot keys cost no DB I/O."""
+        row = self._get_l1(key, ttl_days)
+        if row is not None:
+            self.l1_hits += 1
+            self._count_hit(key)
+            return row
+        if self._bloom is not None and key not in self._bloom:
+            self.misses += 1
+            self.filtered_misses += 1
+            return None
+        row = await db.aio.get_text_cache(key, ttl_days=ttl_days)
+        if row and row.get("response"):
+            self.l2_hits += 1
+            self._count_hit(key)
+            row = self._from_db(row)
+            self._put(row)
+            return row
+        self.misses += 1
+        return None
+
+    async def get_stale(self, key: str, ttl_days: int, stale_days: int) -> Optional[dict]:
+        """Row up to stale_days past the TTL (DB only; expired rows never enter L1)."""
+        if self._bloom is not None and key not in self._bloom:
+            return None
+        row = await db.aio.get_text_cache(key, ttl_days=ttl_days + stale_days)
+        if not row or not row.get("response"):
+            return None
+        self.stale_hits += 1
+        self._count_hit(key, stale=True)
+        return self._from_db(row)
+
+    async def set(self, key: str, response: str, model: Optional[str] = None, **extra) -> None:
+        await db.aio.set_text_cache(key, response, model=model, **extra)
+        for bloom in (self._bloom, self._building):
+            if bloom is not None:
+                bloom.add(key)
+        self._put({"key": key, "response": response, "model": model, "tpl": extra.get("tpl"), "created_ts": time.time()})
+
+    def warm(self, rows: Iterable[dict]) -> int:
+        """rows: most valuable first (e.g. by hits); they end up most recently used."""
+        rows = list(rows)
+        for row in reversed(rows):
+            if row.get("response"):
+                self._put(self._from_db(row))
+        return len(self._lru)
+
+    # ---- negative lookups ----
+
+    def _fill(self, bloom: BloomFilter, within_sec: Optional[float] = None) -> int:
+        n = 0
+        for key in db.iter_text_cache_keys(within_sec=within_sec):
+            bloom.add(key)
+            n += 1
+        return n
+
+    async def rebuild_filter(self) -> Optional[dict]:
+        """Builds a fresh Bloom filter from a streaming key scan and swaps it in."""
+        if TEXT_CACHE_BLOOM_CAPACITY <= 0:
+            return None
+        bloom = BloomFilter(TEXT_CACHE_BLOOM_CAPACITY, TEXT_CACHE_BLOOM_FP)
+        started = time.monotonic()
+        self._building = bloom
+        try:
+            await db.run(self._fill, bloom)
+        finally:
+            self._building = None
+        self._bloom = bloom
+        self._synced = started
+        return bloom.stats()
+
+    async def refresh_filter(self) -> int:
+        """Adds keys written since the last build or refresh, e.g. by another replica."""
+        bloom = self._bloom
+        if bloom is None:
+            return 0
+        started = time.monotonic()
+        # Doubled window: also covers rows whose transaction started before the last refresh.
+        n = await db.run(self._fill, bloom, 2 * (started - self._synced) + 1)
+        self._synced = started
+        return n
+
+    def filter_stats(self) -> Optional[dict]:
+        return self._bloom.stats() if self._bloom is not None else None
+
+    # ---- hit accounting ----
+
+    def _count_hit(self, key: str, stale: bool = False) -> None:
+        n, s, _ = self._hits.get(key, (0, 0, None))
+        self._hits[key] = (n, s + 1, dt.datetime.now()) if stale else (n + 1, s, dt.datetime.now())
+
+    async def flush_hits(self) -> int:
+        """Writes buffered hit counts in one batched UPDATE (off the loop)."""
+        batch, self._hits = self._hits, {}
+        if not batch:
+            return 0
+        rows = [(key, n, s, ts) for key, (n, s, ts) in batch.items()]
+        try:
+            await db.aio.add_text_cache_hits(rows)
+        except Exception:
+            for key, (n, s, ts) in batch.items():  # merged with hits counted meanwhile
+                m, t, ts2 = self._hits.get(key, (0, 0, ts))
+                self._hits[key] = (n + m, s + t, max(ts, ts2))
+            raise
+        return len(rows)
+
+    def stats(self) -> dict:
+        lookups = self.l1_hits + self.l2_hits + self.misses
+        return {
+            "entries": len(self._lru),
+            "bytes": self._bytes,
+            "lookups": lookups,
+            "l1_hits": self.l1_hits,
+            "l2_hits": self.l2_hits,
+            "misses": self.misses,
+            "stale_hits": self.stale_hits,
+            "filtered_misses": self.filtered_misses,
+            "pending_hits": len(self._hits),
+            "l1_ratio": (self.l1_hits / lookups) if lookups else 0.0,
+            "l2_ratio": (self.l2_hits / lookups) if lookups else 0.0,
+        }
+
+
+text_cache = TieredTextCache(TEXT_CACHE_L1_MAX_ENTRIES, TEXT_CACHE_L1_MAX_BYTES)
@@ -3,6 +3,17 @@ import os
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "")
 DATABASE_URL = os.getenv("DATABASE_URL", "")
 
+# Postgres connection pool (db.py). Blocking queries run in a dedicated thread pool of
+# DB_POOL_MAX workers so they never stall the bot's event loop.
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "2"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "16"))
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "15000"))
+# Pooled connections idle longer than this are pinged before reuse.
+DB_HEALTHCHECK_IDLE_SEC = float(os.getenv("DB_HEALTHCHECK_IDLE_SEC", "30"))
+
+# How many updates PTB handles at once (a slow generation must not block other chats)
+BOT_CONCURRENT_UPDATES = int(os.getenv("BOT_CONCURRENT_UPDATES", "256"))
+
 OWNER_USER_ID = int(os.getenv("OWNER_USER_ID", "0"))
 ADMIN_CHAT_ID = int(os.getenv("ADMIN_CHAT_ID", "0")) or OWNER_USER_ID
 
@@ -15,6 +26,58 @@ DEEPSEEK_BASE_URL = os.getenv("DEEPSEEK_BASE_URL", "https://api.deepseek.com")
 # DeepSeek (optional cheaper model for FREE to reduce costs)
 DEEPSEEK_MODEL_FREE = os.getenv("DEEPSEEK_MODEL_FREE", DEEPSEEK_MODEL)
 
+# Cheap-first cascade: answer with DEEPSEEK_MODEL_FREE, re-ask DEEPSEEK_MODEL only when
+# the cheap answer fails local checks (truncated, refusal, missing "Предмет:" header).
+ENABLE_MODEL_CASCADE = os.getenv("ENABLE_MODEL_CASCADE", "1") == "1"
+CASCADE_ESCALATE_PLANS = set(os.getenv("CASCADE_ESCALATE_PLANS", "start,start_first,pro,ultra").split(","))
+
+# DeepSeek HTTP pool (one shared keep-alive client per process)
+DEEPSEEK_HTTP2 = os.getenv("DEEPSEEK_HTTP2", "1") == "1"
+DEEPSEEK_POOL_SIZE = int(os.getenv("DEEPSEEK_POOL_SIZE", "100"))
+DEEPSEEK_POOL_KEEPALIVE = int(os.getenv("DEEPSEEK_POOL_KEEPALIVE", "40"))
+DEEPSEEK_MAX_PER_HOST = int(os.getenv("DEEPSEEK_MAX_PER_HOST", "400"))
+
+# DeepSeek resilience: retries on 429/5xx (honoring Retry-After), circuit breaker,
+# optional hedged requests (second request after the observed p95 latency).
+DEEPSEEK_RETRIES = int(os.getenv("DEEPSEEK_RETRIES", "2"))
+DEEPSEEK_RETRY_BASE_SEC = float(os.getenv("DEEPSEEK_RETRY_BASE_SEC", "0.5"))
+DEEPSEEK_RETRY_MAX_SEC = float(os.getenv("DEEPSEEK_RETRY_MAX_SEC", "8"))
+DEEPSEEK_BREAKER_THRESHOLD = int(os.getenv("DEEPSEEK_BREAKER_THRESHOLD", "5"))
+DEEPSEEK_BREAKER_COOLDOWN_SEC = float(os.getenv("DEEPSEEK_BREAKER_COOLDOWN_SEC", "30"))
+DEEPSEEK_HEDGE = os.getenv("DEEPSEEK_HEDGE", "0") == "1"
+# Upstream counts as degraded (stale cache preferred) above this recent p95 latency.
+DEEPSEEK_LATENCY_BUDGET_SEC = float(os.getenv("DEEPSEEK_LATENCY_BUDGET_SEC", "25"))
+
+# Token prices, USD per 1M tokens (prompt cache hit / cache miss / output).
+DEEPSEEK_PRICES = {
+    "default": {
+        "hit": float(os.getenv("DEEPSEEK_PRICE_HIT", "0.07")),
+        "miss": float(os.getenv("DEEPSEEK_PRICE_MISS", "0.27")),
+        "out": float(os.getenv("DEEPSEEK_PRICE_OUT", "1.10")),
+    },
+    "deepseek-reasoner": {"hit": 0.14, "miss": 0.55, "out": 2.19},
+}
+# What one Telegram Star brings us in USD (after fees), to compare cost vs revenue.
+STAR_USD_RATE = float(os.getenv("STAR_USD_RATE", "0.013"))
+# Usage ledger: aggregated in memory, written to the DB every N seconds.
+USAGE_FLUSH_SEC = int(os.getenv("USAGE_FLUSH_SEC", "30"))
+# Analytics writes (activity counters, offer events, history) are buffered and written
+# in batches every ANALYTICS_FLUSH_MS or ANALYTICS_FLUSH_ROWS rows; producers wait for a
+# flush once ANALYTICS_MAX_PENDING rows are queued.
+ANALYTICS_FLUSH_MS = int(os.getenv("ANALYTICS_FLUSH_MS", "1000"))
+ANALYTICS_FLUSH_ROWS = int(os.getenv("ANALYTICS_FLUSH_ROWS", "500"))
+ANALYTICS_MAX_PENDING = int(os.getenv("ANALYTICS_MAX_PENDING", "20000"))
+# user_history / offer_events are partitioned by month; partitions older than the
+# retention (full months, 0 = keep forever) are dropped, or detached for archiving.
+HISTORY_RETENTION_MONTHS = int(os.getenv("HISTORY_RETENTION_MONTHS", "12"))
+OFFER_EVENTS_RETENTION_MONTHS = int(os.getenv("OFFER_EVENTS_RETENTION_MONTHS", "6"))
+PARTITION_RETENTION_MODE = os.getenv("PARTITION_RETENTION_MODE", "drop")  # drop | detach
+PARTITION_MONTHS_AHEAD = int(os.getenv("PARTITION_MONTHS_AHEAD", "2"))
+# FREE answer token cap while profit_guard says costs are too close to revenue.
+FREE_REDUCED_MAX_TOKENS = int(os.getenv("FREE_REDUCED_MAX_TOKENS", "350"))
+# ...but only once today's API spend exceeds this floor (no revenue yet is not a reason alone).
+PROFIT_GUARD_MIN_COST_USD = float(os.getenv("PROFIT_GUARD_MIN_COST_USD", "1.0"))
+
 # Token caps per plan (reduces cost for FREE)
 MAX_TOKENS = {
     "free": 600,
@@ -26,6 +89,38 @@ MAX_TOKENS = {
 # Cache settings (saves money)
 ENABLE_TEXT_CACHE = os.getenv("ENABLE_TEXT_CACHE", "1") == "1"
 TEXT_CACHE_TTL_DAYS = int(os.getenv("TEXT_CACHE_TTL_DAYS", "60"))
+# In-process LRU in front of text_cache (0 entries disables); warmed with the top-N rows by hits.
+TEXT_CACHE_L1_MAX_ENTRIES = int(os.getenv("TEXT_CACHE_L1_MAX_ENTRIES", "5000"))
+TEXT_CACHE_L1_MAX_BYTES = int(os.getenv("TEXT_CACHE_L1_MAX_MB", "64")) * 1024 * 1024
+TEXT_CACHE_WARM_TOP_N = int(os.getenv("TEXT_CACHE_WARM_TOP_N", "1000"))
+# Bloom filter of text_cache keys: definite misses skip the DB (0 capacity disables).
+TEXT_CACHE_BLOOM_CAPACITY = int(os.getenv("TEXT_CACHE_BLOOM_CAPACITY", "500000"))
+TEXT_CACHE_BLOOM_FP = float(os.getenv("TEXT_CACHE_BLOOM_FP", "0.01"))
+# Background compaction keeps text_cache under a row/byte budget (LFU with aging).
+TEXT_CACHE_MAX_ROWS = int(os.getenv("TEXT_CACHE_MAX_ROWS", "200000"))
+TEXT_CACHE_MAX_BYTES = int(os.getenv("TEXT_CACHE_MAX_MB", "1024")) * 1024 * 1024
+TEXT_CACHE_COMPACT_SEC = int(os.getenv("TEXT_CACHE_COMPACT_SEC", "3600"))
+TEXT_CACHE_AGING_HOURS = int(os.getenv("TEXT_CACHE_AGING_HOURS", "24"))
+TEXT_CACHE_HIT_FLUSH_SEC = int(os.getenv("TEXT_CACHE_HIT_FLUSH_SEC", "30"))
+# Expired text_cache rows are kept this many extra days and served (then refreshed in
+# the background) while DeepSeek is down or slow. 0 disables.
+TEXT_CACHE_STALE_DAYS = int(os.getenv("TEXT_CACHE_STALE_DAYS", "30"))
+# Study/grade/EGE keys are built from the normalized prompt (cache.normalize).
+# While old entries are still live, misses are retried under the pre-normalization key.
+CACHE_KEY_LEGACY_FALLBACK = os.getenv("CACHE_KEY_LEGACY_FALLBACK", "1") == "1"
+
+# Near-duplicate study/EGE questions (MinHash/LSH over prompt shingles). Numbers and
+# formulas must match exactly; the rest must have estimated Jaccard >= NEAR_DUP_THRESHOLD.
+ENABLE_NEAR_DUP_CACHE = os.getenv("ENABLE_NEAR_DUP_CACHE", "1") == "1"
+NEAR_DUP_THRESHOLD = float(os.getenv("NEAR_DUP_THRESHOLD", "0.75"))
+NEAR_DUP_PERMUTATIONS = int(os.getenv("NEAR_DUP_PERMUTATIONS", "64"))
+NEAR_DUP_BANDS = int(os.getenv("NEAR_DUP_BANDS", "16"))
+NEAR_DUP_MAX_ENTRIES = int(os.getenv("NEAR_DUP_MAX_ENTRIES", "50000"))
+
+# Streaming answers (opt-in): post a placeholder and edit it as tokens arrive.
+# Telegram allows roughly one edit per second per chat, so edits are throttled.
+ENABLE_STREAMING = os.getenv("ENABLE_STREAMING", "0") == "1"
+STREAM_EDIT_INTERVAL_SEC = float(os.getenv("STREAM_EDIT_INTERVAL_SEC", "1.2"))
 
 
 # Telegram Stars
@@ -41,6 +136,18 @@ PLANS = {
     "ultra": {"name": {"ru": "ULTRA", "en": "ULTRA"},     "price_stars": 499,  "daily_text": 1200, "daily_img": 100},
 }
 
+# Upstream LLM scheduler: bounded concurrent DeepSeek calls, one lane per plan.
+# Weights drive weighted fair queuing (higher = served sooner when backlogged).
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "48"))
+LLM_LANE_WEIGHTS = {"free": 1, "start": 4, "start_first": 4, "pro": 8, "ultra": 16}
+LLM_LANE_MAX_WAIT_SEC = {
+    "free": int(os.getenv("LLM_FREE_MAX_WAIT_SEC", "45")),
+    "start": int(os.getenv("LLM_PAID_MAX_WAIT_SEC", "90")),
+    "start_first": int(os.getenv("LLM_PAID_MAX_WAIT_SEC", "90")),
+    "pro": int(os.getenv("LLM_PAID_MAX_WAIT_SEC", "90")),
+    "ultra": int(os.getenv("LLM_PAID_MAX_WAIT_SEC", "90")),
+}
+
 
 TOPUPS = {
     # 🔥 Weekly deal (best conversion in RU)
@@ -76,6 +183,18 @@ ENABLE_TWO_LEVEL_ANSWERS = os.getenv("ENABLE_TWO_LEVEL_ANSWERS", "1") == "1"
 EARLY_PAYWALL_TRIGGER_COUNT = int(os.getenv("EARLY_PAYWALL_TRIGGER_COUNT", "2"))
 MAX_TEXT_LEN = int(os.getenv("MAX_TEXT_LEN", "4000"))
 
+# Homework photos: download the smallest Telegram size with shorter side >= VISION_MIN_SIDE,
+# then downscale to VISION_MAX_SIDE, recompress and strip metadata before upload.
+VISION_MIN_SIDE = int(os.getenv("VISION_MIN_SIDE", "720"))
+VISION_MAX_SIDE = int(os.getenv("VISION_MAX_SIDE", "1280"))
+VISION_JPEG_QUALITY = int(os.getenv("VISION_JPEG_QUALITY", "80"))
+VISION_PREP_WORKERS = int(os.getenv("VISION_PREP_WORKERS", "2"))
+
+# Near-duplicate photo cache: max Hamming distance between 64-bit dHashes to reuse
+# a cached analysis (same mode, lang and caption only). 0 disables.
+VISION_PHASH_MAX_DISTANCE = int(os.getenv("VISION_PHASH_MAX_DISTANCE", "6"))
+VISION_PHASH_MAX_ENTRIES = int(os.getenv("VISION_PHASH_MAX_ENTRIES", "200000"))
+
 REVENUE_DAYS_DEFAULT = int(os.getenv("REVENUE_DAYS_DEFAULT", "7"))
 
 
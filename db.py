@@ -1,184 +1,1008 @@
+import asyncio
+import datetime as dt
+import functools
+import hashlib
+import os
+import re
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2.extras import Json, RealDictCursor, execute_values
+from psycopg2.pool import ThreadedConnectionPool
+
+from config import PLANS, DATABASE_URL, DB_POOL_MIN, DB_POOL_MAX, DB_STATEMENT_TIMEOUT_MS, DB_HEALTHCHECK_IDLE_SEC
+
+
+# ----------------
+# CONNECTION POOL
+# ----------------
+# Every query function borrows a connection with `with _conn() as conn:` and must
+# commit its own writes; whatever is left open is rolled back on return to the pool.
+_pool: ThreadedConnectionPool | None = None
+_pool_lock = threading.Lock()
+_last_used: dict[int, float] = {}  # id(conn) -> monotonic time it was returned
+
+
+def _get_pool() -> ThreadedConnectionPool:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadedConnectionPool(
+                    DB_POOL_MIN, DB_POOL_MAX, dsn=DATABASE_URL,
+                    cursor_factory=RealDictCursor,
+                    options=f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}",
+                    connect_timeout=10,
+                )
+    return _pool
+
+
+def _healthy(conn) -> bool:
+    if conn.closed:
+        return False
+    last = _last_used.get(id(conn))
+    if last is not None and time.monotonic() - last < DB_HEALTHCHECK_IDLE_SEC:
+        return True
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+
+@contextmanager
+def _conn():
+    pool = _get_pool()
+    conn = pool.getconn()
+    if not _healthy(conn):
+        _last_used.pop(id(conn), None)
+        pool.putconn(conn, close=True)
+        conn = pool.getconn()
+    broken = False
+    try:
+        yield conn
+    except psycopg2.OperationalError:
+        broken = True
+        raise
+    finally:
+        broken = broken or conn.closed != 0
+        if not broken:
+            try:
+                if conn.status != psycopg2.extensions.STATUS_READY:
+                    conn.rollback()
+            except psycopg2.Error:
+                broken = True
+        if broken:
+            _last_used.pop(id(conn), None)
+        else:
+            _last_used[id(conn)] = time.monotonic()
+        pool.putconn(conn, close=broken)
+
+
+def close_pool() -> None:
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+            _last_used.clear()
+
+
+# ----------------
+# ASYNC ACCESS
+# ----------------
+# Query functions are blocking. From the bot's event loop call them as
+# `await db.aio.get_user(uid)` (or `await db.run(fn, ...)`): they run in a dedicated
+# thread pool sized to the connection pool, so a slow query never stalls other chats
+# and DB work never queues behind other to_thread users.
+_executor = ThreadPoolExecutor(max_workers=max(1, DB_POOL_MAX), thread_name_prefix="db")
+
+
+async def run(fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(fn, *args, **kwargs))
+
+
+class _Async:
+    """db.aio.<name>(...) is an awaitable version of db.<name>(...)."""
+
+    def __getattr__(self, name):
+        fn = globals().get(name)
+        if name.startswith("_") or not callable(fn):
+            raise AttributeError(name)
+
+        async def call(*args, **kwargs):
+            return await run(fn, *args, **kwargs)
+
+        call.__name__ = name
+        return call
+
+
+aio = _Async()
+
+
+def shutdown() -> None:
+    _executor.shutdown(wait=True)
+    close_pool()
+
+
+# ----------------
+# RESPONSE COMPRESSION
+# ----------------
+# Answer bodies (responses.body, and response_z on rows from before the shared
+# store) are BYTEA: 1 codec byte + payload.
+#   0 = raw UTF-8 (short answers), 1 = zlib, 2 = zlib with the preset dictionary below.
+# The dictionary is part of the format: never edit it, add a new codec instead.
+_CODEC_RAW, _CODEC_ZLIB, _CODEC_ZDICT = 0, 1, 2
+_COMPRESS_MIN_BYTES = 160
+_ZDICT = (
+    "Предмет: Subject: математика алгебра геометрия физика химия биология русский язык литература "
+    "история обществознание информатика английский язык "
+    "Балл: /10 Короткий вердикт Ошибки и почему это ошибки Как исправить (конкретные шаги) "
+    "похожих задания для тренировки "
+    "1) краткий план/стратегия 2) теория по теме 3) решение/объяснение по шагам "
+    "4) проверка и типичные ошибки 5) мини-тренировка (2-3 похожих задания) "
+    "Шаг 1: Шаг 2: Шаг 3: Ответ: Решение: Дано: Найти: Проверка: Итак, следовательно, "
+    "поэтому получаем подставим найдём уравнение корни функция значение выражение "
+    "это значит, что например, то есть в этом случае обратите внимание "
+    "Частая ошибка — Типичные ошибки: Проверим: Задание 1. Задание 2. Задание 3. "
+).encode("utf-8")
+
+
+def _pack_text(text: str) -> bytes:
+    data = (text or "").encode("utf-8")
+    if len(data) < _COMPRESS_MIN_BYTES:
+        return bytes([_CODEC_RAW]) + data
+    c = zlib.compressobj(level=6, zdict=_ZDICT)
+    return bytes([_CODEC_ZDICT]) + c.compress(data) + c.flush()
+
+
+def _unpack_text(blob) -> str:
+    blob = bytes(blob)
+    codec, payload = blob[0], blob[1:]
+    if codec == _CODEC_RAW:
+        return payload.decode("utf-8")
+    if codec == _CODEC_ZLIB:
+        return zlib.decompress(payload).decode("utf-8")
+    if codec == _CODEC_ZDICT:
+        d = zlib.decompressobj(zdict=_ZDICT)
+        return (d.decompress(payload) + d.flush()).decode("utf-8")
+    raise ValueError(f"unknown response codec {codec}")
+
+
+def _with_response(row):
+    """Fills row["response"] from the shared body (response_body) or an inline
+    response_z; older rows keep plain TEXT."""
+    if row is not None:
+        body = row.pop("response_body", None)
+        blob = row.pop("response_z", None)
+        if body is not None:
+            row["response"] = _unpack_text(body)
+        elif blob is not None:
+            row["response"] = _unpack_text(blob)
+    return row
+
+
+def _put_response(cur, text: str) -> bytes:
+    """Stores an answer body once (content-addressed) and returns its hash.
+
+    last_ref is refreshed at most every 10 minutes (popular answers are not
+    re-locked on every hit); gc_responses keeps anything touched within its grace
+    period, which is longer, so a reference about to be committed stays valid.
+    """
+    h = hashlib.sha256((text or "").encode("utf-8")).digest()
+    cur.execute("""
+    INSERT INTO responses (hash, body) VALUES (%s, %s)
+    ON CONFLICT (hash) DO UPDATE SET last_ref = CURRENT_TIMESTAMP
+    WHERE responses.last_ref < NOW() - INTERVAL '10 minutes'
+    """, (psycopg2.Binary(h), psycopg2.Binary(_pack_text(text))))
+    return h
+
+
+# Stored answer size whichever column holds it (t = text_cache, r = responses).
+_RESPONSE_BYTES = "COALESCE(octet_length(r.body), octet_length(t.response_z), octet_length(t.response))"
+
+
+# ----------------
+# SCHEMA MIGRATIONS
+# ----------------
+# migrations/NNNN_name.sql, applied in order and recorded in schema_version.
+# A file runs in one transaction together with its schema_version row, unless its
+# first line is "-- migrate: no-transaction" (e.g. CREATE INDEX CONCURRENTLY): then
+# each statement runs on its own, so such files must be idempotent.
+# Never edit an applied migration; add a new file instead.
+_MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+_NO_TRANSACTION = "-- migrate: no-transaction"
+
+
+def _migration_files():
+    """[(version, name, path)] sorted by version."""
+    files = []
+    for fname in os.listdir(_MIGRATIONS_DIR):
+        m = re.fullmatch(r"(\d+)_(\w+)\.sql", fname)
+        if m:
+            files.append((int(m.group(1)), m.group(2), os.path.join(_MIGRATIONS_DIR, fname)))
+    files.sort()
+    if len({v for v, _, _ in files}) != len(files):
+        raise RuntimeError("duplicate migration version in " + _MIGRATIONS_DIR)
+    return files
+
+
+def _statements(sql: str):
+    """Splits a no-transaction migration on statement-ending semicolons."""
+    return [st.strip() for st in re.split(r";\s*$", sql, flags=re.M) if re.sub(r"--[^\n]*", "", st).strip()]
+
+
+def schema_version() -> int:
+    """Highest applied migration (0 on a fresh database). One cheap query, no locks."""
+    with _conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT to_regclass('schema_version') IS NOT NULL AS present")
+            if not cur.fetchone()["present"]:
+                return 0
+            cur.execute("SELECT COALESCE(MAX(version), 0) AS v FROM schema_version")
+            return int(cur.fetchone()["v"])
+
+
+def migrate() -> list:
+    """Applies pending migrations; returns the names applied.
+
+    When the schema is current this is a single SELECT: no DDL, no locks on hot
+    tables. Otherwise one replica migrates under a session advisory lock while
+    the others wait for it and then find nothing left to do.
+    """
+    files = _migration_files()
+    if not files or schema_version() >= files[-1][0]:
+        return []
+    applied = []
+    with _conn() as conn:
+        with conn.cursor() as cur:
+            # DDL can wait on locks held by a running instance during a deploy.
+            cur.execute("SET statement_timeout = 0")
+            cur.execute("SELECT pg_advisory_lock(hashtext('schema_migrations'))")
+            try:
+                cur.execute("""
+                CREATE TABLE IF NOT EXISTS schema_version (
+                  version INT PRIMARY KEY,
+                  name TEXT NOT NULL,
+                  applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                );""")
+                conn.commit()
+                cur.execute("SELECT version FROM schema_version")
+                done = {r["version"] for r in cur.fetchall()}
+                conn.commit()
+                for version, name, path in files:
+                    if version in done:
+                        continue
+                    with open(path, encoding="utf-8") as f:
+                        sql = f.read()
+                    if sql.lstrip().startswith(_NO_TRANSACTION):
+                        conn.autocommit = True
+                        try:
+                            for statement in _statements(sql):
+                                cur.execute(statement)
+                        finally:
+                            conn.autocommit = False
+                    else:
+                        cur.execute(sql)
+                    cur.execute("INSERT INTO schema_version (version, name) VALUES (%s, %s)", (version, name))
+                    conn.commit()
+                    applied.append(f"{version:04d}_{name}")
+            finally:
+                conn.rollback()
+                cur.execute("SELECT pg_advisory_unlock(hashtext('schema_migrations'))")
+                cur.execute("RESET statement_timeout")
+                conn.commit()
+    return applied
+
+
 def init_db():
+    """Brings the schema up to date (see migrate)."""
+    return migrate()
+
+
+def get_text_cache(key: str, ttl_days: int = 60):
     with _conn() as conn:
         with conn.cursor() as cur:
+            cur.execute("""
+            SELECT t.key, t.response, t.response_z, r.body AS response_body, t.model, t.tpl, t.created_at, t.hits,
+                   EXTRACT(EPOCH FROM (LOCALTIMESTAMP - t.created_at)) AS age_sec
+            FROM text_cache t
+            LEFT JOIN responses r ON r.hash = t.response_hash
+            WHERE t.key = %s AND t.created_at > NOW() - (%s * INTERVAL '1 day')
+            """, (key, ttl_days))
+            return _with_response(cur.fetchone())
 
-            # ----------------
-            # USERS
-            # ----------------
+
+def top_text_cache(limit: int = 1000, ttl_days: int = 60):
+    """Most-hit live text_cache rows (for warming the in-process tier)."""
+    with _conn() as conn:
+        with conn.cursor() as cur:
             cur.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-              user_id BIGINT PRIMARY KEY,
-              lang TEXT DEFAULT 'en',
-              plan TEXT DEFAULT 'free',
-              sub_until TIMESTAMP NULL,
-              inviter_id BIGINT NULL,
-              ref_balance INT DEFAULT 0,
-              payout_last_ts TIMESTAMP NULL,
-              has_paid BOOLEAN DEFAULT FALSE,
-              trial_used BOOLEAN DEFAULT FALSE,
-              first_purchase_used BOOLEAN DEFAULT FALSE,
-              grade_photo_trial_used BOOLEAN DEFAULT FALSE,
-              paywall_count INT DEFAULT 0,
-              created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            );""")
-
-            # Ensure migration-safe fields
-            cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS paywall_count INT DEFAULT 0;")
-            cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS grade_photo_trial_used BOOLEAN DEFAULT FALSE;")
-
-
-            # ----------------
-            # DAILY USAGE
-            # ----------------
+            SELECT t.key, t.response, t.response_z, r.body AS response_body, t.model, t.tpl, t.created_at, t.hits,
+                   EXTRACT(EPOCH FROM (LOCALTIMESTAMP - t.created_at)) AS age_sec
+            FROM text_cache t
+            LEFT JOIN responses r ON r.hash = t.response_hash
+            WHERE t.created_at > NOW() - (%s * INTERVAL '1 day')
+            ORDER BY t.hits DESC, t.last_hit DESC
+            LIMIT %s
+            """, (ttl_days, limit))
+            return [_with_response(r) for r in cur.fetchall()]
+
+
+def set_text_cache(key: str, response: str, model: str | None = None, phash: int | None = None, phash_scope: str | None = None,
+                   minhash: bytes | None = None, lsh_scope: str | None = None, tpl: str | None = None):
+    with _conn() as conn:
+        with conn.cursor() as cur:
+            h = _put_response(cur, response)
             cur.execute("""
-            CREATE TABLE IF NOT EXISTS daily_usage (
-              user_id BIGINT NOT NULL,
-              day DATE NOT NULL,
-              text_used INT DEFAULT 0,
-              img_used INT DEFAULT 0,
-              text_bonus INT DEFAULT 0,
-              img_bonus INT DEFAULT 0,
-              song_used INT DEFAULT 0,
-              song_bonus INT DEFAULT 0,
-              PRIMARY KEY (user_id, day)
-            );""")
-
-
-            # ----------------
-            # PAYMENTS
-            # ----------------
+            INSERT INTO text_cache (key, response, response_hash, model, tpl, phash, phash_scope, minhash, lsh_scope)
+            VALUES (%s, NULL, %s, %s, %s, %s, %s, %s, %s)
+            ON CONFLICT (key) DO UPDATE SET
+              response = NULL,
+              response_z = NULL,
+              response_hash = EXCLUDED.response_hash,
+              model = EXCLUDED.model,
+              tpl = EXCLUDED.tpl,
+              phash = COALESCE(EXCLUDED.phash, text_cache.phash),
+              phash_scope = COALESCE(EXCLUDED.phash_scope, text_cache.phash_scope),
+              minhash = COALESCE(EXCLUDED.minhash, text_cache.minhash),
+              lsh_scope = COALESCE(EXCLUDED.lsh_scope, text_cache.lsh_scope),
+              created_at = CURRENT_TIMESTAMP
+            """, (key, psycopg2.Binary(h), model, tpl, phash, phash_scope,
+                  psycopg2.Binary(minhash) if minhash is not None else None, lsh_scope))
+        conn.commit()
+
+
+def text_cache_template_counts():
+    with _conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT tpl, COUNT(*) AS n FROM text_cache GROUP BY tpl")
+            return cur.fetchall()
+
+
+def invalidate_text_cache(template: str | None, version: str | None = None) -> int:
+    """Deletes cached answers of a prompt template (all versions or one);
+    template=None deletes entries written before templates existed."""
+    with _conn() as conn:
+        with conn.cursor() as cur:
+            if template is None:
+                cur.execute("DELETE FROM text_cache WHERE tpl IS NULL")
+            elif version:
+                cur.execute("DELETE FROM text_cache WHERE tpl = %s", (f"{template}@{version}",))
+            else:
+                cur.execute("DELETE FROM text_cache WHERE tpl LIKE %s", (template.replace("_", r"\_").replace("%", r"\%") + "@%",))
+            deleted = cur.rowcount
+        conn.commit()
+    return deleted
+
+
+def add_cache_migration(template: str, from_version: str):
+    with _conn() as conn:
+        with conn.cursor() as cur:
             cur.execute("""
-            CREATE TABLE IF NOT EXISTS payments (
-              id SERIAL PRIMARY KEY,
-              user_id BIGINT NOT NULL,
-              kind TEXT NOT NULL,
-              payload TEXT NOT NULL,
-              stars INT NOT NULL,
-              created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            );""")
-
-
-            # ----------------
-            # USER HISTORY
-            # ----------------
+            INSERT INTO cache_migrations (template, from_version) VALUES (%s, %s)
+            ON CONFLICT DO NOTHING
+            """, (template, from_version))
+        conn.commit()
+
+
+def list_cache_migrations():
+    with _conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT template, from_version FROM cache_migrations ORDER BY created_at")
+            return [(r["template"], r["from_version"]) for r in cur.fetchall()]
+
+
+def iter_text_cache_keys(batch: int = 10000, within_sec: float | None = None):
+    """Streams text_cache keys through a server-side cursor (only those written
+    in the last within_sec seconds, if given)."""
+    with _conn() as conn:
+        with conn.cursor(name="text_cache_keys") as cur:
+            cur.itersize = batch
+            if within_sec is None:
+                cur.execute("SELECT key FROM text_cache")
+            else:
+                cur.execute("SELECT key FROM text_cache WHERE created_at > NOW() - (%s * INTERVAL '1 second')", (within_sec,))
+            for row in cur:
+                yield row["key"]
+
+
+def add_text_cache_hits(rows):
+    """Applies buffered hits: rows of (key, hits, stale_hits, last_hit)."""
+    if not rows:
+        return
+    with _conn() as conn:
+        with conn.cursor() as cur:
+            execute_values(cur, """
+            UPDATE text_cache t
+            SET hits = t.hits + v.n, stale_hits = t.stale_hits + v.s, last_hit = GREATEST(t.last_hit, v.ts)
+            FROM (VALUES %s) AS v(key, n, s, ts)
+            WHERE t.key = v.key
+            """, rows, template="(%s, %s::int, %s::int, %s::timestamp)")
+        conn.commit()
+
+
+def compact_text_cache(ttl_days: int, max_rows: int, max_bytes: int, age_hits: bool = False, batch: int = 5000):
+    """Keeps text_cache within TTL and a row/byte budget. Returns deleted row count.
+
+    Eviction is LFU with aging: lowest (hits, last_hit) first; with age_hits the
+    counters are halved first so old popularity fades. Deletes run in batches.
+    """
+    deleted = 0
+    with _conn() as conn:
+        with conn.cursor() as cur:
+            # One compaction at a time across bot instances.
+            cur.execute("SELECT pg_try_advisory_xact_lock(hashtext('text_cache_compaction')) AS locked")
+            if not cur.fetchone()["locked"]:
+                return 0
+
+            while True:
+                cur.execute("""
+                DELETE FROM text_cache WHERE key IN (
+                  SELECT key FROM text_cache
+                  WHERE created_at < NOW() - (%s * INTERVAL '1 day')
+                  LIMIT %s
+                )""", (ttl_days, batch))
+                deleted += cur.rowcount
+                if cur.rowcount < batch:
+                    break
+
+            if age_hits:
+                cur.execute("UPDATE text_cache SET hits = hits / 2 WHERE hits > 0;")
+
+            cur.execute(f"""
+            SELECT COUNT(*) AS n, COALESCE(SUM({_RESPONSE_BYTES}), 0) AS bytes
+            FROM text_cache t LEFT JOIN responses r ON r.hash = t.response_hash
+            """)
+            row = cur.fetchone()
+            excess_rows = max(int(row["n"]) - max_rows, 0)
+            excess_bytes = max(int(row["bytes"]) - max_bytes, 0)
+            if excess_rows or excess_bytes:
+                cur.execute(f"""
+                DELETE FROM text_cache WHERE key IN (
+                  SELECT key FROM (
+                    SELECT t.key,
+                           ROW_NUMBER() OVER w AS rn,
+                           SUM({_RESPONSE_BYTES}) OVER w - {_RESPONSE_BYTES} AS bytes_before
+                    FROM text_cache t LEFT JOIN responses r ON r.hash = t.response_hash
+                    WINDOW w AS (ORDER BY t.hits, t.last_hit, t.key)
+                  ) e
+                  WHERE e.rn <= %s OR e.bytes_before < %s
+                )""", (excess_rows, excess_bytes))
+                deleted += cur.rowcount
+
+            if deleted:
+                cur.execute("""
+                DELETE FROM image_cache ic
+                WHERE ic.text_key IS NOT NULL
+                  AND NOT EXISTS (SELECT 1 FROM text_cache t WHERE t.key = ic.text_key)
+                """)
+        conn.commit()
+    return deleted
+
+
+def load_vision_phashes(ttl_days: int = 60, limit: int = 200000):
+    """(key, phash_scope, phash) of live vision entries, oldest first."""
+    with _conn() as conn:
+        with conn.cursor() as cur:
             cur.execute("""
-            CREATE TABLE IF NOT EXISTS user_history (
-              id SERIAL PRIMARY KEY,
-              user_id BIGINT NOT NULL,
-              kind TEXT NOT NULL,
-              subject TEXT NULL,
-              prompt TEXT NOT NULL,
-              response TEXT NOT NULL,
-              created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            );""")
-
-            cur.execute("ALTER TABLE user_history ADD COLUMN IF NOT EXISTS subject TEXT NULL;")
-
-
-            # ----------------
-            # PAYOUTS
-            # ----------------
+            SELECT key, phash_scope, phash FROM (
+              SELECT key, phash_scope, phash, created_at
+              FROM text_cache
+              WHERE phash IS NOT NULL AND created_at > NOW() - (%s * INTERVAL '1 day')
+              ORDER BY created_at DESC
+              LIMIT %s
+            ) t ORDER BY created_at
+            """, (ttl_days, limit))
+            return [(r["key"], r["phash_scope"], r["phash"]) for r in cur.fetchall()]
+
+
+def load_text_minhashes(ttl_days: int = 60, limit: int = 50000):
+    """(key, lsh_scope, minhash, age_sec) of live near-duplicate entries, oldest first."""
+    with _conn() as conn:
+        with conn.cursor() as cur:
             cur.execute("""
-            CREATE TABLE IF NOT EXISTS payout_requests (
-              id SERIAL PRIMARY KEY,
-              user_id BIGINT NOT NULL,
-              amount INT NOT NULL,
-              status TEXT NOT NULL DEFAULT 'new',
-              admin_note TEXT NULL,
-              created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-              updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            );""")
-
-
-            # ----------------
-            # ACTIVITY COUNTS (NEW SYSTEM)
-            # ----------------
+            SELECT key, lsh_scope, minhash, age_sec FROM (
+              SELECT key, lsh_scope, minhash, created_at,
+                     EXTRACT(EPOCH FROM (LOCALTIMESTAMP - created_at)) AS age_sec
+              FROM text_cache
+              WHERE minhash IS NOT NULL AND created_at > NOW() - (%s * INTERVAL '1 day')
+              ORDER BY created_at DESC
+              LIMIT %s
+            ) t ORDER BY created_at
+            """, (ttl_days, limit))
+            return [(r["key"], r["lsh_scope"], r["minhash"], r["age_sec"]) for r in cur.fetchall()]
+
+
+def recent_history_prompts(days: int = 30, kinds=("text", "grade", "ege")):
+    """Recorded prompts in arrival order (for offline cache-key replay)."""
+    with _conn() as conn:
+        with conn.cursor() as cur:
             cur.execute("""
-            CREATE TABLE IF NOT EXISTS activity_counts (
-              user_id BIGINT NOT NULL,
-              day DATE NOT NULL,
-              mode TEXT NOT NULL,
-              exam TEXT NULL,
-              subject TEXT NULL,
-              cnt INT DEFAULT 0,
-              PRIMARY KEY (user_id, day, mode, exam, subject)
-            );""")
-
-
-            # ----------------
-            # OFFER EVENTS
-            # ----------------
+            SELECT kind, prompt FROM user_history
+            WHERE created_at > NOW() - (%s * INTERVAL '1 day') AND kind = ANY(%s)
+            ORDER BY created_at, id
+            """, (days, list(kinds)))
+            return cur.fetchall()
+
+
+def get_image_cache_response(key: str, ttl_days: int = 60):
+    """Cached vision response for a Telegram file key, bumping hit stats; None on miss."""
+    with _conn() as conn:
+        with conn.cursor() as cur:
             cur.execute("""
-            CREATE TABLE IF NOT EXISTS offer_events (
-              id BIGSERIAL PRIMARY KEY,
-              user_id BIGINT NOT NULL,
-              ts TIMESTAMP DEFAULT NOW(),
-              event TEXT NOT NULL,
-              offer_key TEXT NOT NULL,
-              variant TEXT NULL,
-              meta JSONB NULL
-            );""")
-
-
-            # ----------------
-            # AB TESTING
-            # ----------------
+            UPDATE image_cache ic
+            SET hits = ic.hits + 1, last_hit = CURRENT_TIMESTAMP
+            FROM text_cache t
+            LEFT JOIN responses r ON r.hash = t.response_hash
+            WHERE ic.key = %s AND t.key = ic.text_key
+              AND t.created_at > NOW() - (%s * INTERVAL '1 day')
+            RETURNING t.response, t.response_z, r.body AS response_body
+            """, (key, ttl_days))
+            row = _with_response(cur.fetchone())
+        conn.commit()
+    return row["response"] if row else None
+
+
+def set_image_cache(key: str, telegram_file_id: str, text_key: str):
+    with _conn() as conn:
+        with conn.cursor() as cur:
             cur.execute("""
-            CREATE TABLE IF NOT EXISTS ab_assignments (
-              user_id BIGINT NOT NULL,
-              experiment TEXT NOT NULL,
-              variant TEXT NOT NULL,
-              created_at TIMESTAMP DEFAULT NOW(),
-              PRIMARY KEY (user_id, experiment)
-            );""")
+            INSERT INTO image_cache (key, telegram_file_id, text_key)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (key) DO UPDATE SET
+              telegram_file_id = EXCLUDED.telegram_file_id,
+              text_key = EXCLUDED.text_key,
+              last_hit = CURRENT_TIMESTAMP
+            """, (key, telegram_file_id, text_key))
+        conn.commit()
+
+
+def add_usage_rows(rows):
+    """Upserts aggregated usage rows (day, user_id, mode, model, calls, prompt, completion, cache_hit, cost_usd)."""
+    if not rows:
+        return
+    with _conn() as conn:
+        with conn.cursor() as cur:
+            execute_values(cur, """
+            INSERT INTO usage_ledger
+              (day, user_id, mode, model, calls, prompt_tokens, completion_tokens, cache_hit_tokens, cost_usd)
+            VALUES %s
+            ON CONFLICT (day, user_id, mode, model) DO UPDATE SET
+              calls = usage_ledger.calls + EXCLUDED.calls,
+              prompt_tokens = usage_ledger.prompt_tokens + EXCLUDED.prompt_tokens,
+              completion_tokens = usage_ledger.completion_tokens + EXCLUDED.completion_tokens,
+              cache_hit_tokens = usage_ledger.cache_hit_tokens + EXCLUDED.cache_hit_tokens,
+              cost_usd = usage_ledger.cost_usd + EXCLUDED.cost_usd
+            """, rows)
+        conn.commit()
+
+
+def cost_and_revenue_today():
+    """Returns (api_cost_usd, revenue_stars) for the current UTC day."""
+    with _conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+            SELECT
+              (SELECT COALESCE(SUM(cost_usd), 0) FROM usage_ledger WHERE day = CURRENT_DATE) AS cost_usd,
+              (SELECT COALESCE(SUM(stars), 0) FROM payments WHERE created_at >= CURRENT_DATE) AS stars
+            """)
+            row = cur.fetchone()
+    return float(row["cost_usd"]), int(row["stars"])
+
 
+# ----------------
+# REQUEST CONTEXT
+# ----------------
+def load_request_context(user_id: int, experiments=("paywall_trigger",), focus_days: int = 14) -> dict:
+    """Everything a message handler needs about a user, in one round trip.
 
+    Returns {"plan", "limits" (PLANS entry), "text_left", "photo_left",
+    "usage" (today's daily_usage, zeros if none), "user" (None if unknown),
+    "promo" (active or None), "focus" ({mode, exam, subject} or None),
+    "winners" ({experiment: winner} for the requested experiments)}.
+    A lapsed subscription counts as free.
+    """
+    with _conn() as conn:
+        with conn.cursor() as cur:
             cur.execute("""
-            CREATE TABLE IF NOT EXISTS experiment_winners (
-              experiment TEXT PRIMARY KEY,
-              winner TEXT NOT NULL,
-              updated_at TIMESTAMP DEFAULT NOW()
-            );""")
+            SELECT
+              u.user_id IS NOT NULL AS known,
+              CASE WHEN u.sub_until IS NOT NULL AND u.sub_until < NOW() THEN 'free'
+                   ELSE COALESCE(u.plan, 'free') END AS plan,
+              u.lang, u.sub_until, u.has_paid, u.trial_used, u.first_purchase_used,
+              u.grade_photo_trial_used, u.paywall_count,
+              COALESCE(d.text_used, 0) AS text_used, COALESCE(d.img_used, 0) AS img_used,
+              COALESCE(d.text_bonus, 0) AS text_bonus, COALESCE(d.img_bonus, 0) AS img_bonus,
+              p.promo_kind, p.target_plan, p.expires_at AS promo_expires_at,
+              f.mode AS focus_mode, f.exam AS focus_exam, f.subject AS focus_subject,
+              (SELECT COALESCE(jsonb_object_agg(w.experiment, w.winner), '{}'::jsonb)
+               FROM experiment_winners w WHERE w.experiment = ANY(%(experiments)s)) AS winners
+            FROM (SELECT %(uid)s::bigint AS user_id) k
+            LEFT JOIN users u ON u.user_id = k.user_id
+            LEFT JOIN daily_usage d ON d.user_id = k.user_id AND d.day = CURRENT_DATE
+            LEFT JOIN promos p ON p.user_id = k.user_id AND p.expires_at > NOW()
+            LEFT JOIN LATERAL (
+              SELECT a.mode, a.exam, a.subject
+              FROM activity_counts a
+              WHERE a.user_id = k.user_id AND a.day > CURRENT_DATE - %(focus_days)s
+              GROUP BY a.mode, a.exam, a.subject
+              ORDER BY SUM(a.cnt) DESC
+              LIMIT 1
+            ) f ON TRUE
+            """, {"uid": user_id, "experiments": list(experiments), "focus_days": focus_days})
+            r = cur.fetchone()
+
+    plan = r["plan"] if r["plan"] in PLANS else "free"
+    limits = PLANS[plan]
+    usage = {k: int(r[k]) for k in ("text_used", "img_used", "text_bonus", "img_bonus")}
+    return {
+        "plan": plan,
+        "limits": limits,
+        "text_left": int(limits.get("daily_text", 0)) + usage["text_bonus"] - usage["text_used"],
+        "photo_left": int(limits.get("daily_img", 0)) + usage["img_bonus"] - usage["img_used"],
+        "usage": usage,
+        "user": {k: r[k] for k in ("lang", "sub_until", "has_paid", "trial_used", "first_purchase_used",
+                                   "grade_photo_trial_used", "paywall_count")} if r["known"] else None,
+        "promo": {"promo_kind": r["promo_kind"], "target_plan": r["target_plan"],
+                  "expires_at": r["promo_expires_at"]} if r["promo_kind"] else None,
+        "focus": {"mode": r["focus_mode"], "exam": r["focus_exam"], "subject": r["focus_subject"]} if r["focus_mode"] else None,
+        "winners": r["winners"] or {},
+    }
+
+
+# ----------------
+# QUOTA
+# ----------------
+# kind -> (used column, bonus column, PLANS limit key)
+_QUOTA_COLUMNS = {
+    "text": ("text_used", "text_bonus", "daily_text"),
+    "photo": ("img_used", "img_bonus", "daily_img"),
+}
+
+
+def consume_quota(user_id: int, plan: str, kind: str, n: int = 1):
+    """Atomically takes n units of today's text/photo quota (plan limit + bonus).
+
+    One statement: concurrent messages from the same user serialize on the
+    daily_usage row and cannot both pass the check. Returns
+    {"day", "text_left", "photo_left"} after consuming, or None when the quota
+    is exhausted (nothing consumed).
+    """
+    used, bonus, limit_key = _QUOTA_COLUMNS[kind]
+    limits = PLANS.get(plan) or PLANS["free"]
+    with _conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(f"""
+            INSERT INTO daily_usage AS d (user_id, day, {used})
+            SELECT %(uid)s, CURRENT_DATE, %(n)s
+            WHERE %(n)s <= %(limit)s
+               OR EXISTS (SELECT 1 FROM daily_usage WHERE user_id = %(uid)s AND day = CURRENT_DATE)
+            ON CONFLICT (user_id, day) DO UPDATE SET {used} = d.{used} + EXCLUDED.{used}
+            WHERE d.{used} + EXCLUDED.{used} <= %(limit)s + d.{bonus}
+            RETURNING d.day,
+                      %(text_limit)s + d.text_bonus - d.text_used AS text_left,
+                      %(img_limit)s + d.img_bonus - d.img_used AS photo_left
+            """, {"uid": user_id, "n": n, "limit": int(limits.get(limit_key, 0)),
+                  "text_limit": int(limits.get("daily_text", 0)), "img_limit": int(limits.get("daily_img", 0))})
+            row = cur.fetchone()
+        conn.commit()
+    return row
 
 
-            # ----------------
-            # PROMOS
-            # ----------------
+def refund_quota(user_id: int, kind: str, day, n: int = 1) -> None:
+    """Gives back units taken by consume_quota (e.g. the generation failed)."""
+    used = _QUOTA_COLUMNS[kind][0]
+    with _conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(f"""
+            UPDATE daily_usage SET {used} = GREATEST({used} - %s, 0)
+            WHERE user_id = %s AND day = %s
+            """, (n, user_id, day))
+        conn.commit()
+
+
+# ----------------
+# ANALYTICS (batched writes from the analytics write-behind buffer)
+# ----------------
+def add_activity_rows(rows):
+    """Upserts aggregated activity counters: rows of (user_id, day, mode, exam, subject, cnt).
+    exam/subject are part of the primary key, so missing values are stored as ''."""
+    if not rows:
+        return
+    with _conn() as conn:
+        with conn.cursor() as cur:
+            execute_values(cur, """
+            INSERT INTO activity_counts (user_id, day, mode, exam, subject, cnt)
+            VALUES %s
+            ON CONFLICT (user_id, day, mode, exam, subject) DO UPDATE SET
+              cnt = activity_counts.cnt + EXCLUDED.cnt
+            """, [(uid, day, mode, exam or "", subject or "", cnt) for uid, day, mode, exam, subject, cnt in rows])
+        conn.commit()
+
+
+def add_offer_events(rows):
+    """Inserts offer events: rows of (user_id, ts, event, offer_key, variant, meta dict or None)."""
+    if not rows:
+        return
+    with _conn() as conn:
+        with conn.cursor() as cur:
+            execute_values(cur, """
+            INSERT INTO offer_events (user_id, ts, event, offer_key, variant, meta)
+            VALUES %s
+            """, [(uid, ts, event, offer_key, variant, Json(meta) if meta is not None else None)
+                  for uid, ts, event, offer_key, variant, meta in rows])
+        conn.commit()
+
+
+# ----------------
+# HISTORY
+# ----------------
+def add_history(user_id: int, kind: str, prompt: str, response: str, subject: str | None = None):
+    with _conn() as conn:
+        with conn.cursor() as cur:
+            h = _put_response(cur, response)
             cur.execute("""
-            CREATE TABLE IF NOT EXISTS promos (
-              user_id BIGINT PRIMARY KEY,
-              promo_kind TEXT NOT NULL,
-              target_plan TEXT NOT NULL,
-              expires_at TIMESTAMP NOT NULL,
-              created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            );""")
-
-
-            # ----------------
-            # TEXT CACHE
-            # ----------------
+            INSERT INTO user_history (user_id, kind, subject, prompt, response_hash)
+            VALUES (%s, %s, %s, %s, %s)
+            """, (user_id, kind, subject, prompt, psycopg2.Binary(h)))
+        conn.commit()
+
+
+def add_history_rows(rows):
+    """Batched add_history: rows of (user_id, kind, prompt, response, subject, created_at).
+    Each distinct answer body is stored once."""
+    if not rows:
+        return
+    bodies = {}
+    hashes = []
+    for row in rows:
+        data = (row[3] or "").encode("utf-8")
+        h = hashlib.sha256(data).digest()
+        bodies.setdefault(h, row[3])
+        hashes.append(h)
+    with _conn() as conn:
+        with conn.cursor() as cur:
+            execute_values(cur, """
+            INSERT INTO responses (hash, body) VALUES %s
+            ON CONFLICT (hash) DO UPDATE SET last_ref = CURRENT_TIMESTAMP
+            WHERE responses.last_ref < NOW() - INTERVAL '10 minutes'
+            """, [(psycopg2.Binary(h), psycopg2.Binary(_pack_text(text))) for h, text in bodies.items()])
+            execute_values(cur, """
+            INSERT INTO user_history (user_id, kind, subject, prompt, response_hash, created_at)
+            VALUES %s
+            """, [(uid, kind, subject, prompt, psycopg2.Binary(h), ts)
+                  for (uid, kind, prompt, _, subject, ts), h in zip(rows, hashes)])
+        conn.commit()
+
+
+def list_history(user_id: int, limit: int = 10):
+    return list_history_filtered(user_id, subject="__all__", limit=limit)
+
+
+# History screens show the newest rows. Each query is a UNION ALL of the recent
+# partitions (pruned by the created_at bound) and everything older, under one
+# LIMIT: Append runs its branches in order, so the older branch (a probe of every
+# old partition) is only executed when the recent window holds fewer rows.
+_HISTORY_RECENT_DAYS = 90
+
+
+def list_history_filtered(user_id: int, subject: str | None = "__all__", limit: int = 10):
+    with _conn() as conn:
+        with conn.cursor() as cur:
             cur.execute("""
-            CREATE TABLE IF NOT EXISTS text_cache (
-              key TEXT PRIMARY KEY,
-              response TEXT NOT NULL,
-              model TEXT NULL,
-              created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-              last_hit TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-              hits INT DEFAULT 0
-            );""")
-
-
-            # ----------------
-            # IMAGE CACHE (legacy safe)
-            # ----------------
+            SELECT * FROM (
+              (SELECT h.id, h.kind, h.subject, h.prompt, h.response, h.response_z, r.body AS response_body, h.created_at
+               FROM user_history h
+               LEFT JOIN responses r ON r.hash = h.response_hash
+               WHERE h.user_id = %(uid)s AND (%(subject)s = '__all__' OR h.subject = %(subject)s)
+                 AND h.created_at > NOW() - (%(days)s * INTERVAL '1 day')
+               ORDER BY h.created_at DESC
+               LIMIT %(limit)s)
+              UNION ALL
+              (SELECT h.id, h.kind, h.subject, h.prompt, h.response, h.response_z, r.body AS response_body, h.created_at
+               FROM user_history h
+               LEFT JOIN responses r ON r.hash = h.response_hash
+               WHERE h.user_id = %(uid)s AND (%(subject)s = '__all__' OR h.subject = %(subject)s)
+                 AND h.created_at <= NOW() - (%(days)s * INTERVAL '1 day')
+               ORDER BY h.created_at DESC
+               LIMIT %(limit)s)
+            ) h
+            LIMIT %(limit)s
+            """, {"uid": user_id, "subject": subject or "__all__", "days": _HISTORY_RECENT_DAYS, "limit": limit})
+            return [_with_response(r) for r in cur.fetchall()]
+
+
+def list_history_subjects(user_id: int, limit: int = 8):
+    with _conn() as conn:
+        with conn.cursor() as cur:
             cur.execute("""
-            CREATE TABLE IF NOT EXISTS image_cache (
-              key TEXT PRIMARY KEY,
-              telegram_file_id TEXT NOT NULL,
-              created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-              last_hit TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-              hits INT DEFAULT 0
-            );""")
+            WITH recent AS (
+              SELECT subject, MAX(created_at) AS last_at
+              FROM user_history
+              WHERE user_id = %(uid)s AND subject IS NOT NULL AND subject <> ''
+                AND created_at > NOW() - (%(days)s * INTERVAL '1 day')
+              GROUP BY subject
+            )
+            SELECT * FROM (
+              (SELECT subject, last_at FROM recent ORDER BY last_at DESC LIMIT %(limit)s)
+              UNION ALL
+              (SELECT subject, MAX(created_at) AS last_at
+               FROM user_history
+               WHERE user_id = %(uid)s AND subject IS NOT NULL AND subject <> ''
+                 AND created_at <= NOW() - (%(days)s * INTERVAL '1 day')
+                 AND subject NOT IN (SELECT subject FROM recent)
+               GROUP BY subject
+               ORDER BY last_at DESC
+               LIMIT %(limit)s)
+            ) s
+            LIMIT %(limit)s
+            """, {"uid": user_id, "days": _HISTORY_RECENT_DAYS, "limit": limit})
+            return cur.fetchall()
+
+
+def gc_responses(grace_minutes: int = 60, batch: int = 5000) -> int:
+    """Deletes answer bodies no text_cache or user_history row references.
+
+    Bodies touched within the grace period are kept (a writer may be about to
+    commit its reference).
+    """
+    deleted = 0
+    with _conn() as conn:
+        with conn.cursor() as cur:
+            while True:
+                cur.execute("""
+                DELETE FROM responses WHERE hash IN (
+                  SELECT r.hash FROM responses r
+                  WHERE r.last_ref < NOW() - (%s * INTERVAL '1 minute')
+                    AND NOT EXISTS (SELECT 1 FROM text_cache t WHERE t.response_hash = r.hash)
+                    AND NOT EXISTS (SELECT 1 FROM user_history h WHERE h.response_hash = r.hash)
+                  LIMIT %s
+                )""", (grace_minutes, batch))
+                deleted += cur.rowcount
+                conn.commit()
+                if cur.rowcount < batch:
+                    break
+    return deleted
+
+
+# ----------------
+# PARTITIONS (monthly user_history / offer_events, see migrations/0003)
+# ----------------
+_PARTITIONED = ("user_history", "offer_events")
+
 
+def _add_months(d: dt.date, n: int) -> dt.date:
+    m = d.year * 12 + d.month - 1 + n
+    return dt.date(m // 12, m % 12 + 1, 1)
 
+
+def _partitions(cur, table: str):
+    """[(name, upper bound date or None)] of a partitioned table; None = DEFAULT/MAXVALUE."""
+    cur.execute("""
+    SELECT c.relname AS name, pg_get_expr(c.relpartbound, c.oid) AS bound
+    FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = to_regclass(%s)
+    """, (table,))
+    out = []
+    for r in cur.fetchall():
+        m = re.search(r"TO \('(\d{4}-\d{2}-\d{2})", r["bound"] or "")
+        out.append((r["name"], dt.date.fromisoformat(m.group(1)) if m else None))
+    return out
+
+
+def ensure_partitions(months_ahead: int = 2) -> list:
+    """Creates monthly partitions up to months_ahead past the current month; returns names created.
+
+    Months already covered (e.g. by the attached legacy partition) are skipped.
+    """
+    created = []
+    this_month = dt.date.today().replace(day=1)
+    with _conn() as conn:
+        with conn.cursor() as cur:
+            for table in _PARTITIONED:
+                covered = max((hi for _, hi in _partitions(cur, table) if hi), default=None)
+                conn.commit()
+                for i in range(months_ahead + 1):
+                    lo, hi = _add_months(this_month, i), _add_months(this_month, i + 1)
+                    if covered and lo < covered:
+                        continue
+                    name = f"{table}_p{lo:%Y%m}"
+                    # Takes a short exclusive lock on the parent: give up rather than queue behind traffic.
+                    cur.execute("SET LOCAL lock_timeout = '5s'")
+                    cur.execute(f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {table} FOR VALUES FROM (%s) TO (%s)", (lo, hi))
+                    conn.commit()
+                    created.append(name)
+    return created
+
+
+def apply_retention(table: str, keep_months: int, mode: str = "drop") -> list:
+    """Removes partitions of `table` whose rows are all older than keep_months full months.
+
+    mode "drop" deletes them; "detach" keeps them as standalone tables for archiving
+    (pg_dump, then DROP). Returns the affected partition names.
+    """
+    if table not in _PARTITIONED or keep_months <= 0:
+        return []
+    cutoff = _add_months(dt.date.today().replace(day=1), -keep_months)
+    done = []
+    with _conn() as conn:
+        with conn.cursor() as cur:
+            old = [name for name, hi in _partitions(cur, table) if hi and hi <= cutoff]
+            conn.commit()
+            for name in old:
+                cur.execute("SET LOCAL lock_timeout = '5s'")
+                if mode == "detach":
+                    cur.execute(f"ALTER TABLE {table} DETACH PARTITION {name}")
+                else:
+                    cur.execute(f"DROP TABLE {name}")
+                conn.commit()
+                done.append(name)
+    return done
+
+
+# ----------------
+# BACKFILL: inline answers (TEXT response / response_z) -> shared responses store
+# ----------------
+def _backfill_batch(table: str, pk: str, batch: int) -> int:
+    with _conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(f"""
+            SELECT {pk} AS pk, response, response_z FROM {table}
+            WHERE response_hash IS NULL AND (response IS NOT NULL OR response_z IS NOT NULL)
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+            """, (batch,))
+            rows = [(r["pk"], psycopg2.Binary(_put_response(cur, _with_response(r)["response"]))) for r in cur.fetchall()]
+            if rows:
+                execute_values(cur, f"""
+                UPDATE {table} t SET response_hash = v.h, response = NULL, response_z = NULL
+                FROM (VALUES %s) AS v(pk, h)
+                WHERE t.{pk} = v.pk
+                """, rows)
         conn.commit()
+    return len(rows)
+
+
+def job_done(name: str) -> bool:
+    with _conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1 FROM maintenance_jobs WHERE name = %s", (name,))
+            return cur.fetchone() is not None
+
+
+def mark_job_done(name: str) -> None:
+    with _conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("INSERT INTO maintenance_jobs (name) VALUES (%s) ON CONFLICT (name) DO NOTHING", (name,))
+        conn.commit()
+
+
+def backfill_response_store(batch: int = 500, pause_sec: float = 0.2, stop: threading.Event | None = None) -> int:
+    """Moves inline answers into the shared responses table in small transactions.
+    Idempotent and resumable; run VACUUM on both tables afterwards to return the space.
+
+    Runs once: completion is recorded in maintenance_jobs. Setting `stop` ends it
+    between batches (it resumes on the next start).
+    """
+    if job_done("response_store_backfill"):
+        return 0
+    stop = stop or threading.Event()
+    total = 0
+    for table, pk in (("text_cache", "key"), ("user_history", "id")):
+        while not stop.is_set():
+            n = _backfill_batch(table, pk, batch)
+            total += n
+            if n < batch:
+                break
+            stop.wait(pause_sec)
+    if not stop.is_set():
+        mark_job_done("response_store_backfill")
+    return total
@@ -64,6 +64,9 @@ T = {
     "revenue": "💰 Доход",
     "paid_ok": "✅ Оплата получена! Начислил.",
     "error_generic": "Упс, что-то пошло не так. Попробуй ещё раз.",
+    "queued_position": "⏳ Сейчас много запросов. Ты в очереди: позиция {n}. Ответ придёт сам.",
+    "queue_busy": "⏳ Сервис перегружен, не успели ответить. Попробуй ещё раз через минуту.",
+    "upstream_down": "🛠 ИИ временно недоступен. Лимит не списан — попробуй через пару минут.",
     "media_not_configured": "⚠️ Медиа-провайдер не настроен. Добавь ключи/endpoint в Railway Variables.",
     "help": "ℹ️ Как пользоваться:\n\n📚 Учёба: пиши задачу/вопрос или пришли фото ДЗ — я разберу и помогу.\n✅ Проверка и оценка: пришли своё решение (текст/фото) — я поставлю балл и укажу ошибки.\n📝 ОГЭ/ЕГЭ: выбери экзамен и предмет, дальше кнопки помогут учиться.\n😄/🎲 Отвлечься: факты и мини-игры.\n\n⭐ Подписка даёт большие лимиты.\n🛒 Докупить — если лимит закончился.",
     "photo_limit_msg": "📸 Лимит фото-разборов на сегодня закончился.\n\nХочешь продолжить — можно докупить пакеты фото-разборов или оформить подписку.",
@@ -122,6 +125,9 @@ T = {
     "revenue": "💰 Revenue",
     "paid_ok": "✅ Payment received! Credited.",
     "error_generic": "Oops, something went wrong. Please try again.",
+    "queued_position": "⏳ We're busy right now. You're in the queue: position {n}. The answer will arrive automatically.",
+    "queue_busy": "⏳ The service is overloaded and couldn't answer in time. Please try again in a minute.",
+    "upstream_down": "🛠 The AI is temporarily unavailable. Your quota was not charged — try again in a couple of minutes.",
     "media_not_configured": "⚠️ Media provider is not configured. Add endpoint/keys in Railway Variables.",
     "help": "ℹ️ How to use:\n\n📚 Study: send a task/question or upload a homework photo — I’ll explain and help.\n✅ Check & grade: send your solution (text/photo) — I’ll score it and show mistakes.\n📝 OGE/EGE: pick exam + subject, then use action buttons to study.\n🎲 Chill: facts and mini-games.\n\n⭐ Subscription increases daily limits.\n🛒 Top-ups add extra answers/photo checks instantly.",
  
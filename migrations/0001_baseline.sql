@@ -0,0 +1,225 @@
+-- Baseline: the schema init_db() used to (re)create on every start. Idempotent, so it
+-- also applies cleanly to databases created before migrations existed.
+
+-- ----------------
+-- USERS
+-- ----------------
+CREATE TABLE IF NOT EXISTS users (
+  user_id BIGINT PRIMARY KEY,
+  lang TEXT DEFAULT 'en',
+  plan TEXT DEFAULT 'free',
+  sub_until TIMESTAMP NULL,
+  inviter_id BIGINT NULL,
+  ref_balance INT DEFAULT 0,
+  payout_last_ts TIMESTAMP NULL,
+  has_paid BOOLEAN DEFAULT FALSE,
+  trial_used BOOLEAN DEFAULT FALSE,
+  first_purchase_used BOOLEAN DEFAULT FALSE,
+  grade_photo_trial_used BOOLEAN DEFAULT FALSE,
+  paywall_count INT DEFAULT 0,
+  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Ensure migration-safe fields
+ALTER TABLE users ADD COLUMN IF NOT EXISTS paywall_count INT DEFAULT 0;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS grade_photo_trial_used BOOLEAN DEFAULT FALSE;
+
+-- ----------------
+-- DAILY USAGE
+-- ----------------
+CREATE TABLE IF NOT EXISTS daily_usage (
+  user_id BIGINT NOT NULL,
+  day DATE NOT NULL,
+  text_used INT DEFAULT 0,
+  img_used INT DEFAULT 0,
+  text_bonus INT DEFAULT 0,
+  img_bonus INT DEFAULT 0,
+  song_used INT DEFAULT 0,
+  song_bonus INT DEFAULT 0,
+  PRIMARY KEY (user_id, day)
+);
+
+-- ----------------
+-- PAYMENTS
+-- ----------------
+CREATE TABLE IF NOT EXISTS payments (
+  id SERIAL PRIMARY KEY,
+  user_id BIGINT NOT NULL,
+  kind TEXT NOT NULL,
+  payload TEXT NOT NULL,
+  stars INT NOT NULL,
+  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- ----------------
+-- RESPONSES (content-addressed answer bodies shared by text_cache and user_history)
+-- ----------------
+CREATE TABLE IF NOT EXISTS responses (
+  hash BYTEA PRIMARY KEY,
+  body BYTEA NOT NULL,
+  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  last_ref TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- ----------------
+-- USER HISTORY
+-- ----------------
+CREATE TABLE IF NOT EXISTS user_history (
+  id SERIAL PRIMARY KEY,
+  user_id BIGINT NOT NULL,
+  kind TEXT NOT NULL,
+  subject TEXT NULL,
+  prompt TEXT NOT NULL,
+  response TEXT NOT NULL,
+  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+ALTER TABLE user_history ADD COLUMN IF NOT EXISTS subject TEXT NULL;
+-- Compressed answers (see _pack_text); TEXT response kept only for old rows
+ALTER TABLE user_history ADD COLUMN IF NOT EXISTS response_z BYTEA NULL;
+ALTER TABLE user_history ALTER COLUMN response DROP NOT NULL;
+ALTER TABLE user_history ADD COLUMN IF NOT EXISTS response_hash BYTEA NULL;
+CREATE INDEX IF NOT EXISTS user_history_response_hash_idx ON user_history (response_hash);
+
+-- ----------------
+-- PAYOUTS
+-- ----------------
+CREATE TABLE IF NOT EXISTS payout_requests (
+  id SERIAL PRIMARY KEY,
+  user_id BIGINT NOT NULL,
+  amount INT NOT NULL,
+  status TEXT NOT NULL DEFAULT 'new',
+  admin_note TEXT NULL,
+  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- ----------------
+-- ACTIVITY COUNTS (NEW SYSTEM)
+-- ----------------
+CREATE TABLE IF NOT EXISTS activity_counts (
+  user_id BIGINT NOT NULL,
+  day DATE NOT NULL,
+  mode TEXT NOT NULL,
+  exam TEXT NULL,
+  subject TEXT NULL,
+  cnt INT DEFAULT 0,
+  PRIMARY KEY (user_id, day, mode, exam, subject)
+);
+
+-- ----------------
+-- OFFER EVENTS
+-- ----------------
+CREATE TABLE IF NOT EXISTS offer_events (
+  id BIGSERIAL PRIMARY KEY,
+  user_id BIGINT NOT NULL,
+  ts TIMESTAMP DEFAULT NOW(),
+  event TEXT NOT NULL,
+  offer_key TEXT NOT NULL,
+  variant TEXT NULL,
+  meta JSONB NULL
+);
+
+-- ----------------
+-- AB TESTING
+-- ----------------
+CREATE TABLE IF NOT EXISTS ab_assignments (
+  user_id BIGINT NOT NULL,
+  experiment TEXT NOT NULL,
+  variant TEXT NOT NULL,
+  created_at TIMESTAMP DEFAULT NOW(),
+  PRIMARY KEY (user_id, experiment)
+);
+
+CREATE TABLE IF NOT EXISTS experiment_winners (
+  experiment TEXT PRIMARY KEY,
+  winner TEXT NOT NULL,
+  updated_at TIMESTAMP DEFAULT NOW()
+);
+
+-- ----------------
+-- PROMOS
+-- ----------------
+CREATE TABLE IF NOT EXISTS promos (
+  user_id BIGINT PRIMARY KEY,
+  promo_kind TEXT NOT NULL,
+  target_plan TEXT NOT NULL,
+  expires_at TIMESTAMP NOT NULL,
+  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- ----------------
+-- TEXT CACHE
+-- ----------------
+CREATE TABLE IF NOT EXISTS text_cache (
+  key TEXT PRIMARY KEY,
+  response TEXT NOT NULL,
+  model TEXT NULL,
+  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  last_hit TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  hits INT DEFAULT 0
+);
+
+-- Compressed answers (see _pack_text); TEXT response kept only for old rows
+ALTER TABLE text_cache ADD COLUMN IF NOT EXISTS response_z BYTEA NULL;
+ALTER TABLE text_cache ALTER COLUMN response DROP NOT NULL;
+ALTER TABLE text_cache ADD COLUMN IF NOT EXISTS response_hash BYTEA NULL;
+CREATE INDEX IF NOT EXISTS text_cache_response_hash_idx ON text_cache (response_hash);
+
+-- Answers served past their TTL while the upstream was down/slow (see TEXT_CACHE_STALE_DAYS)
+ALTER TABLE text_cache ADD COLUMN IF NOT EXISTS stale_hits INT DEFAULT 0;
+
+-- Prompt template tag ("name@version", see ai/prompts.py) for selective invalidation
+ALTER TABLE text_cache ADD COLUMN IF NOT EXISTS tpl TEXT NULL;
+CREATE INDEX IF NOT EXISTS text_cache_tpl_idx ON text_cache (tpl text_pattern_ops);
+CREATE TABLE IF NOT EXISTS cache_migrations (
+  template TEXT NOT NULL,
+  from_version TEXT NOT NULL,
+  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (template, from_version)
+);
+
+-- Eviction scans: TTL purge by age, LFU-with-aging by (hits, last_hit)
+CREATE INDEX IF NOT EXISTS text_cache_created_idx ON text_cache (created_at);
+CREATE INDEX IF NOT EXISTS text_cache_lfu_idx ON text_cache (hits, last_hit);
+
+-- Perceptual hash of the photo for vision entries (near-duplicate lookup)
+ALTER TABLE text_cache ADD COLUMN IF NOT EXISTS phash BIGINT NULL;
+ALTER TABLE text_cache ADD COLUMN IF NOT EXISTS phash_scope TEXT NULL;
+CREATE INDEX IF NOT EXISTS text_cache_phash_idx ON text_cache (created_at) WHERE phash IS NOT NULL;
+
+-- MinHash signature of the normalized prompt for near-duplicate study/EGE questions
+ALTER TABLE text_cache ADD COLUMN IF NOT EXISTS minhash BYTEA NULL;
+ALTER TABLE text_cache ADD COLUMN IF NOT EXISTS lsh_scope TEXT NULL;
+CREATE INDEX IF NOT EXISTS text_cache_minhash_idx ON text_cache (created_at) WHERE minhash IS NOT NULL;
+
+-- ----------------
+-- USAGE LEDGER (API tokens & cost per user/mode/model/day)
+-- ----------------
+CREATE TABLE IF NOT EXISTS usage_ledger (
+  day DATE NOT NULL,
+  user_id BIGINT NOT NULL,
+  mode TEXT NOT NULL,
+  model TEXT NOT NULL,
+  calls INT DEFAULT 0,
+  prompt_tokens BIGINT DEFAULT 0,
+  completion_tokens BIGINT DEFAULT 0,
+  cache_hit_tokens BIGINT DEFAULT 0,
+  cost_usd NUMERIC(14,6) DEFAULT 0,
+  PRIMARY KEY (day, user_id, mode, model)
+);
+
+-- ----------------
+-- IMAGE CACHE (legacy safe)
+-- ----------------
+CREATE TABLE IF NOT EXISTS image_cache (
+  key TEXT PRIMARY KEY,
+  telegram_file_id TEXT NOT NULL,
+  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  last_hit TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  hits INT DEFAULT 0
+);
+
+-- Telegram file_unique_id -> vision text_cache entry (skip re-downloads of forwarded photos)
+ALTER TABLE image_cache ADD COLUMN IF NOT EXISTS text_key TEXT NULL;
+CREATE INDEX IF NOT EXISTS image_cache_text_key_idx ON image_cache (text_key);
@@ -0,0 +1,8 @@
+-- migrate: no-transaction
+-- Indexes for the history screen, revenue stats, offer analytics and the payout queue.
+-- Built CONCURRENTLY so a deploy never blocks writes to these tables.
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS user_history_user_created_idx ON user_history (user_id, created_at DESC);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS payments_created_idx ON payments (created_at);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS offer_events_ts_idx ON offer_events (ts);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS payout_requests_status_idx ON payout_requests (status);
@@ -0,0 +1,61 @@
+-- Monthly range partitioning for the append-only user_history and offer_events tables.
+-- Existing rows are not copied: the old table is attached as one partition covering
+-- everything before next month (one validation scan). Later months get their own
+-- partitions from db.ensure_partitions(); db.apply_retention() drops or detaches whole
+-- partitions instead of DELETEing rows. A DEFAULT partition catches rows for months
+-- without a partition (only if maintenance has not run for a long time).
+
+DO $$
+DECLARE
+  boundary DATE := (date_trunc('month', now()) + INTERVAL '1 month')::date;
+BEGIN
+  IF (SELECT relkind FROM pg_class WHERE oid = 'user_history'::regclass) = 'r' THEN
+    ALTER TABLE user_history RENAME TO user_history_legacy;
+    ALTER INDEX IF EXISTS user_history_response_hash_idx RENAME TO user_history_legacy_response_hash_idx;
+    ALTER INDEX IF EXISTS user_history_user_created_idx RENAME TO user_history_legacy_user_created_idx;
+    UPDATE user_history_legacy SET created_at = 'epoch' WHERE created_at IS NULL;
+    ALTER TABLE user_history_legacy ALTER COLUMN created_at SET NOT NULL;
+
+    CREATE TABLE user_history (
+      id INT NOT NULL DEFAULT nextval('user_history_id_seq'),
+      user_id BIGINT NOT NULL,
+      kind TEXT NOT NULL,
+      subject TEXT NULL,
+      prompt TEXT NOT NULL,
+      response TEXT NULL,
+      created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+      response_z BYTEA NULL,
+      response_hash BYTEA NULL,
+      PRIMARY KEY (id, created_at)
+    ) PARTITION BY RANGE (created_at);
+    ALTER SEQUENCE user_history_id_seq OWNED BY user_history.id;
+    CREATE INDEX user_history_response_hash_idx ON user_history (response_hash);
+    CREATE INDEX user_history_user_created_idx ON user_history (user_id, created_at DESC);
+
+    EXECUTE format('ALTER TABLE user_history ATTACH PARTITION user_history_legacy FOR VALUES FROM (MINVALUE) TO (%L)', boundary);
+    CREATE TABLE user_history_default PARTITION OF user_history DEFAULT;
+  END IF;
+
+  IF (SELECT relkind FROM pg_class WHERE oid = 'offer_events'::regclass) = 'r' THEN
+    ALTER TABLE offer_events RENAME TO offer_events_legacy;
+    ALTER INDEX IF EXISTS offer_events_ts_idx RENAME TO offer_events_legacy_ts_idx;
+    UPDATE offer_events_legacy SET ts = 'epoch' WHERE ts IS NULL;
+    ALTER TABLE offer_events_legacy ALTER COLUMN ts SET NOT NULL;
+
+    CREATE TABLE offer_events (
+      id BIGINT NOT NULL DEFAULT nextval('offer_events_id_seq'),
+      user_id BIGINT NOT NULL,
+      ts TIMESTAMP NOT NULL DEFAULT NOW(),
+      event TEXT NOT NULL,
+      offer_key TEXT NOT NULL,
+      variant TEXT NULL,
+      meta JSONB NULL,
+      PRIMARY KEY (id, ts)
+    ) PARTITION BY RANGE (ts);
+    ALTER SEQUENCE offer_events_id_seq OWNED BY offer_events.id;
+    CREATE INDEX offer_events_ts_idx ON offer_events (ts);
+
+    EXECUTE format('ALTER TABLE offer_events ATTACH PARTITION offer_events_legacy FOR VALUES FROM (MINVALUE) TO (%L)', boundary);
+    CREATE TABLE offer_events_default PARTITION OF offer_events DEFAULT;
+  END IF;
+END $$;
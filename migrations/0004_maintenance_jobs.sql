@@ -0,0 +1,6 @@
+-- One-off background jobs (e.g. the response store backfill) record completion here
+-- so they are not rescanned on every start.
+CREATE TABLE IF NOT EXISTS maintenance_jobs (
+  name TEXT PRIMARY KEY,
+  finished_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
@@ -1,8 +1,10 @@
-
-def should_reduce_limits(api_cost_today: float, revenue_today: float) -> bool:
+def should_reduce_limits(api_cost_today: float, revenue_today: float, min_cost: float = 0.0) -> bool:
     """
     If costs approach revenue, tighten FREE limits.
+    Spend at or below min_cost never tightens them (e.g. right after midnight).
     """
+    if api_cost_today <= min_cost:
+        return False
     if revenue_today == 0:
         return True
     ratio = api_cost_today / revenue_today